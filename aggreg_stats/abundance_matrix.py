@@ -0,0 +1,348 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import ast
+import struct
+import sys
+import zipfile
+from array import array
+from itertools import compress
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from output_backends import AggregStatsOutput, publish
+from sample_results import TAX_FLAG_BITS, SampleOutput, SampleResults
+from tax_index import UNASSIGNED, get_tax_index
+from util import get_logger
+
+_NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# numpy dtype of each array typecode used here (always little endian, as written by `_npy_bytes`)
+_NPY_DESCR = {"H": "<u2", "I": "<u4", "i": "<i4", "q": "<i8", "Q": "<u8", "d": "<f8"}
+_NPY_TYPECODES = {descr: typecode for typecode, descr in _NPY_DESCR.items()}
+
+logger = get_logger(__name__)
+
+
+def _npy_bytes(descr: str, shape: Tuple[int, ...], data: bytes) -> bytes:
+    """`data` as a version 1.0 .npy file"""
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': {shape!r}, }}"
+    # the header is padded so the data is 64 byte aligned
+    header += " " * (63 - (len(_NPY_MAGIC) + 2 + len(header)) % 64) + "\n"
+
+    return _NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1") + data
+
+
+def _npy_array(values: array) -> bytes:
+    if sys.byteorder == "big" and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return _npy_bytes(_NPY_DESCR[values.typecode], (len(values),), values.tobytes())
+
+
+def _npy_strings(values: Sequence[str]) -> bytes:
+    width = max((len(value) for value in values), default=1) or 1
+
+    return _npy_bytes(
+        f"<U{width}", (len(values),), b"".join(value.ljust(width, "\0").encode("utf-32-le") for value in values)
+    )
+
+
+def _read_npy(data: bytes):
+    """Array (or list of strings, or bytes for 0-d byte strings) stored in a .npy file written by `_npy_bytes`"""
+    if not data.startswith(b"\x93NUMPY"):
+        raise ValueError("Not a .npy file")
+
+    header_len, = struct.unpack_from("<H", data, len(_NPY_MAGIC))
+    start = len(_NPY_MAGIC) + 2 + header_len
+    header = ast.literal_eval(data[len(_NPY_MAGIC) + 2:start].decode("latin1"))
+    descr = header["descr"]
+    body = data[start:]
+
+    if descr.startswith("|S"):
+        return body.rstrip(b"\0")
+    if descr.startswith("<U"):
+        width = int(descr[2:])
+        text = body.decode("utf-32-le")
+        return [text[idx:idx + width].rstrip("\0") for idx in range(0, len(text), width)]
+
+    values = array(_NPY_TYPECODES[descr])
+    values.frombytes(body)
+    if sys.byteorder == "big" and values.itemsize > 1:
+        values.byteswap()
+
+    return values
+
+
+class AbundanceMatrix(object):
+    """
+    Output size of each taxid in each sample, as a sparse samples × taxids matrix
+
+    Stored in CSR form: the cells of row `r` are `indptr[r]:indptr[r + 1]` of `indices` (column numbers, in increasing
+    order), `data` (summed output sizes) and `flag_masks` (the VirMap tax flags of any of the entries summed into the
+    cell, see TAX_FLAG_BITS). Column `c` is taxid `tax_ids[c]`, and columns are in increasing taxid order.
+    """
+
+    def __init__(
+            self, samples: List[str], tax_ids: array, indptr: array, indices: array, data: array, flag_masks: array
+    ):
+        self.samples = samples
+        self.tax_ids = tax_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.flag_masks = flag_masks
+
+        self._rows = {sample: idx for idx, sample in enumerate(samples)}
+        self._columns = {tax_id: idx for idx, tax_id in enumerate(tax_ids)}
+        self._csc: Optional[Tuple[array, array, array]] = None
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[SampleResults]) -> "AbundanceMatrix":
+        builder = AbundanceMatrixBuilder()
+        for sample in samples:
+            builder.add_output(sample.run_name, sample.final_output)
+
+        return builder.build()
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.samples), len(self.tax_ids)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.data)
+
+    def _row_cells(self, row: int) -> Tuple[int, int]:
+        return self.indptr[row], self.indptr[row + 1]
+
+    def row(self, sample: str) -> Dict[int, int]:
+        """{taxid: size} of a sample"""
+        start, end = self._row_cells(self._rows[sample])
+        tax_ids = self.tax_ids
+
+        return {tax_ids[col]: value for col, value in zip(self.indices[start:end], self.data[start:end])}
+
+    def column(self, tax_id: int) -> Dict[str, int]:
+        """{sample: size} of every sample with output for `tax_id`"""
+        col = self._columns.get(tax_id)
+        if col is None:
+            return {}
+
+        col_ptr, cells, rows = self._build_csc()
+        samples = self.samples
+        data = self.data
+
+        return {samples[rows[cell]]: data[cell] for cell in cells[col_ptr[col]:col_ptr[col + 1]]}
+
+    def iter_columns(self) -> Iterator[Tuple[int, array, array]]:
+        """(taxid, rows, sizes) of each column, the rows in increasing order"""
+        col_ptr, cells, rows = self._build_csc()
+        data = self.data
+        for col, tax_id in enumerate(self.tax_ids):
+            col_cells = cells[col_ptr[col]:col_ptr[col + 1]]
+            yield tax_id, array("i", map(rows.__getitem__, col_cells)), array(data.typecode, map(data.__getitem__, col_cells))
+
+    def _build_csc(self) -> Tuple[array, array, array]:
+        """Column pointers, the cells of each column in row order and the row of each cell, built on first use"""
+        if self._csc is None:
+            rows = array("i", bytes(4 * self.nnz))
+            for row in range(len(self.samples)):
+                start, end = self._row_cells(row)
+                rows[start:end] = array("i", [row]) * (end - start)
+
+            num_columns = len(self.tax_ids)
+            col_ptr = array("q", bytes(8 * (num_columns + 1)))
+            for col in self.indices:
+                col_ptr[col + 1] += 1
+            for col in range(num_columns):
+                col_ptr[col + 1] += col_ptr[col]
+
+            fill = array("q", col_ptr)
+            cells = array("q", bytes(8 * self.nnz))
+            for cell, col in enumerate(self.indices):
+                cells[fill[col]] = cell
+                fill[col] += 1
+
+            self._csc = col_ptr, cells, rows
+
+        return self._csc
+
+    def select_rows(self, samples: Iterable[str]) -> "AbundanceMatrix":
+        """The matrix of only `samples`, in the order given"""
+        builder = AbundanceMatrixBuilder(self.data.typecode)
+        tax_ids = self.tax_ids
+        for sample in samples:
+            start, end = self._row_cells(self._rows[sample])
+            builder.add_row(
+                sample, [tax_ids[col] for col in self.indices[start:end]], self.data[start:end], self.flag_masks[start:end]
+            )
+
+        return builder.build()
+
+    def select_columns(self, tax_ids: Iterable[int]) -> "AbundanceMatrix":
+        """The matrix of only `tax_ids` (dropping any without output in any sample)"""
+        keep = {self._columns[tax_id] for tax_id in tax_ids if tax_id in self._columns}
+
+        return self._filter_cells([col in keep for col in self.indices])
+
+    def with_flag(self, flag: str) -> "AbundanceMatrix":
+        """The matrix of only the cells with VirMap tax flag `flag`"""
+        bit = TAX_FLAG_BITS[flag]
+
+        return self._filter_cells([bool(mask & bit) for mask in self.flag_masks])
+
+    def _filter_cells(self, selected: List[bool]) -> "AbundanceMatrix":
+        builder = AbundanceMatrixBuilder(self.data.typecode)
+        tax_ids = self.tax_ids
+        for row, sample in enumerate(self.samples):
+            start, end = self._row_cells(row)
+            row_selected = selected[start:end]
+            builder.add_row(
+                sample,
+                [tax_ids[col] for col in compress(self.indices[start:end], row_selected)],
+                compress(self.data[start:end], row_selected),
+                compress(self.flag_masks[start:end], row_selected),
+            )
+
+        return builder.build()
+
+    def rollup(self, rank: str) -> "AbundanceMatrix":
+        """Sizes summed by the ancestor of each taxid at `rank` (UNASSIGNED for those without one)"""
+        table = get_tax_index().rank_ancestors(rank)
+        ancestors = [table[tax_id] if tax_id < len(table) else UNASSIGNED for tax_id in self.tax_ids]
+
+        builder = AbundanceMatrixBuilder(self.data.typecode)
+        for row, sample in enumerate(self.samples):
+            start, end = self._row_cells(row)
+            builder.add_row(
+                sample, [ancestors[col] for col in self.indices[start:end]], self.data[start:end], self.flag_masks[start:end]
+            )
+
+        return builder.build()
+
+    def row_totals(self) -> array:
+        """Total output size of each sample"""
+        return array(self.data.typecode, (sum(self.data[slice(*self._row_cells(row))]) for row in range(len(self.samples))))
+
+    def normalized(self) -> "AbundanceMatrix":
+        """Relative abundance, each sample's sizes divided by its total output size"""
+        data = array("d", bytes(8 * self.nnz))
+        for row, total in enumerate(self.row_totals()):
+            start, end = self._row_cells(row)
+            if total:
+                data[start:end] = array("d", (value / total for value in self.data[start:end]))
+
+        return AbundanceMatrix(self.samples, self.tax_ids, self.indptr, self.indices, data, self.flag_masks)
+
+    def save(self, filename: str):
+        """
+        Save as a compressed .npz file
+
+        The file can also be read with `scipy.sparse.load_npz` (giving the matrix without the sample or taxid labels), or
+        `numpy.load`.
+        """
+        arrays = {
+            "format": _npy_bytes("|S3", (), b"csr"),
+            "shape": _npy_array(array("q", self.shape)),
+            "indptr": _npy_array(self.indptr),
+            "indices": _npy_array(self.indices),
+            "data": _npy_array(self.data),
+            "flag_masks": _npy_array(self.flag_masks),
+            "tax_ids": _npy_array(self.tax_ids),
+            "samples": _npy_strings(self.samples),
+            "flags": _npy_strings(sorted(TAX_FLAG_BITS, key=TAX_FLAG_BITS.get)),
+        }
+
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as f:
+            for name, data in arrays.items():
+                f.writestr(f"{name}.npy", data)
+
+    @classmethod
+    def load(cls, filename: str) -> "AbundanceMatrix":
+        with zipfile.ZipFile(filename, "r") as f:
+            arrays = {name[:-4]: _read_npy(f.read(name)) for name in f.namelist() if name.endswith(".npy")}
+
+        if arrays.get("format") != b"csr":
+            raise ValueError(f"{filename!r} isn't a CSR abundance matrix")
+
+        # flag bits are assigned by sorted name, so only need remapping if the known flags have changed
+        flag_masks = arrays["flag_masks"]
+        saved_bits = {flag: 1 << idx for idx, flag in enumerate(arrays["flags"])}
+        if saved_bits != TAX_FLAG_BITS:
+            flag_masks = array("H", (
+                sum(TAX_FLAG_BITS.get(flag, 0) for flag, bit in saved_bits.items() if mask & bit) for mask in flag_masks
+            ))
+
+        return cls(
+            arrays["samples"], arrays["tax_ids"], arrays["indptr"], arrays["indices"], arrays["data"], flag_masks
+        )
+
+
+class AbundanceMatrixBuilder(object):
+    """Builds an AbundanceMatrix a row at a time, summing the sizes (and combining the flags) of repeated taxids"""
+
+    def __init__(self, typecode: str = "Q"):
+        self.samples: List[str] = []
+        self.indptr = array("q", [0])
+        # taxid of each cell until the columns are known
+        self.cell_tax_ids = array("I")
+        self.data = array(typecode)
+        self.flag_masks = array("H")
+
+    def add_row(self, sample: str, tax_ids: Iterable[int], sizes: Iterable, flag_masks: Iterable[int]):
+        cells: Dict[int, List] = {}
+        for tax_id, size, mask in zip(tax_ids, sizes, flag_masks):
+            cell = cells.get(tax_id)
+            if cell is None:
+                cells[tax_id] = [size, mask]
+            else:
+                cell[0] += size
+                cell[1] |= mask
+
+        row_tax_ids = sorted(cells)
+        self.samples.append(sample)
+        self.cell_tax_ids.extend(row_tax_ids)
+        self.data.extend(cells[tax_id][0] for tax_id in row_tax_ids)
+        self.flag_masks.extend(cells[tax_id][1] for tax_id in row_tax_ids)
+        self.indptr.append(len(self.cell_tax_ids))
+
+    def add_output(self, sample: str, output: SampleOutput):
+        self.add_row(sample, output.tax_ids, output.sizes, output.flag_masks)
+
+    def build(self) -> AbundanceMatrix:
+        tax_ids = array("I", sorted(set(self.cell_tax_ids)))
+        columns = {tax_id: idx for idx, tax_id in enumerate(tax_ids)}
+        indices = array("i", map(columns.__getitem__, self.cell_tax_ids))
+
+        return AbundanceMatrix(self.samples, tax_ids, self.indptr, indices, self.data, self.flag_masks)
+
+
+class AbundanceMatrixOutput(AggregStatsOutput):
+    """The samples × taxids abundance matrix, saved as a .npz file"""
+
+    def __init__(self, out_fn: str, streaming: bool = False):
+        super().__init__(out_fn)
+        self.builder = AbundanceMatrixBuilder()
+
+    def add_sample(self, sample: SampleResults):
+        self.num_samples += 1
+        self.builder.add_output(sample.run_name, sample.final_output)
+
+    def finish(self):
+        logger.info("Saving abundance matrix")
+        matrix = self.builder.build()
+        matrix.save(self.tmp_fn)
+        logger.info("Abundance matrix of %d samples × %d taxids, %d non-zero", *matrix.shape, matrix.nnz)
+
+        publish(self.tmp_fn, self.out_fn)
@@ -12,27 +12,79 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
 from collections import Counter
-from typing import Iterable
+from typing import Dict, Optional
 
 import xlsxwriter
 
 from constants import *
-from sample_results import SampleResults
+import tax_db
+from analyse_times import ProfileNode, write_flame_graph
+from analyse_times.iterate_improve import CYCLE_TIMINGS
+from analyse_times.profile import percentile
+from abundance_matrix import AbundanceMatrixBuilder
+from error_scanner import ERROR_CLASSIFIER
+from output_backends import SUMMARY_COLUMNS, AggregStatsOutput, publish, sample_summary
+from sample_results import TAX_FLAG_BITS, SampleOutput, SampleResults
+from scaling import (
+    CANDIDATE_THREADS, MIN_EFFICIENCY, OVERALL_STAGE, SERIAL_MAX_RATIO, SERIAL_MIN_THREADS, ScalingModel,
+    idle_core_seconds,
+)
+from similarity import SampleDistances, find_shared_taxa
+from tax_index import ROLLUP_RANKS, UNASSIGNED, rollup_sample
 from util import get_logger
 
 logger = get_logger(__name__)
 
 
-class AggregStatsWorkbook:
-    def __init__(self, out_fn: str):
+class AggregStatsWorkbook(AggregStatsOutput):
+    """
+    The aggregated statistics workbook
+
+    Samples are added with `add_sample` (or all at once with `process`). When `streaming`, the workbook is written in
+    xlsxwriter's constant memory mode: each sample's taxonomy sheet is written as soon as the sample is added, rather
+    than its output being kept. What the other sheets need is still kept for every sample until `finish`: the summary
+    and timing rows, the rank roll-ups, the values of the merged timing tree and the iterative improvement cycles (and
+    the abundance matrix with `similarity`), so memory use still grows with the batch, if far more slowly. With
+    `similarity`, the distances between samples, clusters
+    of similar samples and taxids shared suspiciously are added as well. `in_flight` lists the runs still in progress,
+    with the last stage each completed.
+    """
+
+    SIMILARITY_SHEETS = ("Clusters", "Shared taxa", "Bray-Curtis", "Jaccard")
+    # Largest number of samples written as a distance matrix, one column per sample
+    MAX_DISTANCE_MATRIX_SAMPLES = 16383
+
+    def __init__(
+            self,
+            out_fn: str,
+            streaming: bool = False,
+            similarity: bool = False,
+            in_flight: Optional[Dict[str, Optional[str]]] = None,
+    ):
+        super().__init__(out_fn)
+        self.streaming = streaming
+        self._sheets = {}
+        self.similarity = similarity
+        self.in_flight = in_flight or {}
+        self.matrix_builder = AbundanceMatrixBuilder()
+
         self.all_walltimes = {}
         self.all_cputimes = {}
         self.all_cpuratios = {}
         self.all_tax_data = {}
         self.all_summary = {}
+        self.all_rollups = {rank: {} for rank in ROLLUP_RANKS}
+        # number of error lines, and samples with any, by (category, rule or message)
+        self.pattern_lines = Counter()
+        self.pattern_samples = Counter()
+        self.profile = ProfileNode("All samples")
+        self.all_threads = {}
+        self.all_cycles = {}
+        self.scaling = ScalingModel()
 
-        self.workbook = xlsxwriter.Workbook(out_fn)
+        self.workbook = xlsxwriter.Workbook(self.tmp_fn, {"constant_memory": streaming})
 
         self.color_scale = {
             "type": "3_color_scale",
@@ -62,68 +114,65 @@ class AggregStatsWorkbook:
         self.header_height = 50
         self.time_fmt_hrs = self.workbook.add_format({"num_format": "[hh]:mm:ss"})
         self.time_fmt = self.workbook.add_format({"num_format": "mm:ss"})
+        # the same, applied by conditional formats
+        self.time_fmt_hrs_cond = self.workbook.add_format({"num_format": "[hh]:mm:ss"})
+        self.time_fmt_cond = self.workbook.add_format({"num_format": "mm:ss"})
+
+    def add_worksheet(self, name: str):
+        """The sheet called `name`, created up front when streaming as sheets can't be reordered later"""
+        ws = self._sheets.pop(name, None)
+        if ws is None:
+            ws = self.workbook.add_worksheet(name)
+
+        return ws
 
     def write_sample_dict(
             self, ws, row: int, col: int, data, headers, no_time: bool = False
     ) -> int:
         ws.set_column(0, 0, 25)
-        # ws.set_column(col+1, col+len(headers), 9)
+        last_row = row + len(data)
+        last_col = col + len(headers) - 1
+        if not no_time:
+            # rows are written whole without formats, times of an hour or more are shown in hours
+            ws.conditional_format(
+                row + 1, col + 1, last_row, last_col,
+                {"type": "cell", "criteria": ">=", "value": 3600 / 86400, "format": self.time_fmt_hrs_cond},
+            )
+            ws.conditional_format(
+                row + 1, col + 1, last_row, last_col,
+                {"type": "cell", "criteria": "<", "value": 3600 / 86400, "format": self.time_fmt_cond},
+            )
         ws.set_row(row, self.header_height)
-        for idx, header in enumerate(headers):
-            ws.write(row, col + idx, header, self.header_fmt)
-
+        ws.write_row(row, col, headers, self.header_fmt)
+        for idx in range(len(headers)):
             ws.conditional_format(
                 row + 1,
                 col + idx,
-                row + len(data),
+                last_row,
                 col + idx,
                 self.inverse_color_scale if not no_time else self.color_scale,
             )
 
         for row_idx, sample in enumerate(sorted(data.keys())):
-            ws.write(row + 1 + row_idx, col, sample)
-
-            for col_idx, cell_data in enumerate(data[sample]):
-                if not no_time:
-                    if cell_data is None:
-                        ws.write(
-                            row + 1 + row_idx,
-                            col + 1 + col_idx,
-                            '-',
-                        )
-                    else:
-                        cell_fmt = self.time_fmt_hrs if cell_data >= 3600 else self.time_fmt
-                        ws.write(
-                            row + 1 + row_idx,
-                            col + 1 + col_idx,
-                            cell_data / 86400,
-                            cell_fmt,
-                        )
-                else:
-                    ws.write(row + 1 + row_idx, col + 1 + col_idx, cell_data)
-
-        return row_idx + row + 1
+            if no_time:
+                cells = data[sample]
+            else:
+                cells = ['-' if cell_data is None else cell_data / 86400 for cell_data in data[sample]]
+            ws.write_row(row + 1 + row_idx, col, [sample, *cells])
+
+        return last_row
 
     def dump_summary(self):
         green_format = self.workbook.add_format({"bg_color": "#33CC33"})
         red_format = self.workbook.add_format({"bg_color": "#CC3333"})
         orange_format = self.workbook.add_format({"bg_color": "#ff860d"})
 
-        ws_summary = self.workbook.add_worksheet("Summary")
+        ws_summary = self.add_worksheet("Summary")
         ws_summary.set_row(0, self.header_height)
         ws_summary.write_row(
             0,
             0,
-            [
-                "Sample",
-                "Benign errors",
-                "Unexpected errors",
-                "Killed count",
-                "Output seqs",
-                "Unique taxids",
-                "Generic virus outputs",
-                *sorted(VIRMAP_TAX_FLAGS)
-            ],
+            ["Sample", *SUMMARY_COLUMNS],
             self.header_fmt,
         )
         ws_summary.set_column(0, 0, 25)
@@ -181,6 +230,15 @@ class AggregStatsWorkbook:
             6,
             {"type": "cell", "criteria": ">=", "value": 3, "format": red_format, },
         )
+        # die errors
+        die_col = 1 + SUMMARY_COLUMNS.index("Die errors")
+        ws_summary.conditional_format(
+            1,
+            die_col,
+            len(self.all_summary),
+            die_col,
+            {"type": "cell", "criteria": "!=", "value": 0, "format": red_format, },
+        )
         # ws_summary.conditional_format(
         #     1,
         #     6,
@@ -190,14 +248,9 @@ class AggregStatsWorkbook:
         # )
 
         for idx, sample in enumerate(sorted(self.all_summary)):
-            summary = self.all_summary[sample]
-            flag_counts = summary[-1]
-
             # ws_summary.set_column(3, 8, 20)
             ws_summary.write(idx + 1, 0, sample)
-            ws_summary.write_row(idx + 1, 1, summary[:-1])
-            for flag_idx, flag in enumerate(sorted(VIRMAP_TAX_FLAGS)):
-                ws_summary.write(idx + 1, 1 + len(summary) - 1 + flag_idx, flag_counts[flag])
+            ws_summary.write_row(idx + 1, 1, self.all_summary[sample])
 
             # output seqs vs uniq
             ws_summary.conditional_format(
@@ -213,15 +266,34 @@ class AggregStatsWorkbook:
                 },
             )
 
+        # lines of each category by rule or message, below the samples
+        row = len(self.all_summary) + 2
+        ws_summary.write_row(row, 0, ["Rule or message", "Category", "Lines", "Samples"], self.header_fmt)
+        for idx, ((category, label), lines) in enumerate(
+                sorted(self.pattern_lines.items(), key=lambda x: (-x[1], x[0]))
+        ):
+            ws_summary.write_row(row + 1 + idx, 0, [label, category, lines, self.pattern_samples[category, label]])
+
+    def dump_in_flight(self):
+        if not self.in_flight:
+            return
+
+        ws = self.add_worksheet("In flight")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, ["Run", "Last completed stage"], self.header_fmt)
+        ws.set_column(0, 1, 25)
+        for row, run_name in enumerate(sorted(self.in_flight)):
+            ws.write_row(row + 1, 0, [run_name, self.in_flight[run_name] or "-"])
+
     def dump_time_stats(self):
         if any(y for x in self.all_walltimes.values() for y in x):
-            ws_walltimes = self.workbook.add_worksheet("Walltimes")
+            ws_walltimes = self.add_worksheet("Walltimes")
             self.write_sample_dict(
                 ws_walltimes, 0, 0, self.all_walltimes, ("Sample",) + TIME_CATEGORIES
             )
 
         if any(y for x in self.all_cpuratios.values() for y in x):
-            ws_cpuratio = self.workbook.add_worksheet("CPU ratio")
+            ws_cpuratio = self.add_worksheet("CPU ratio")
             self.write_sample_dict(
                 ws_cpuratio,
                 0,
@@ -232,87 +304,402 @@ class AggregStatsWorkbook:
             )
 
         if any(y for x in self.all_cputimes.values() for y in x):
-            ws_cputime = self.workbook.add_worksheet("CPU time")
+            ws_cputime = self.add_worksheet("CPU time")
             self.write_sample_dict(
                 ws_cputime, 0, 0, self.all_cputimes, ("Sample",) + TIME_CATEGORIES
             )
 
-    def dump_tax_stats(self):
-        all_seq_flags = sorted(list(VIRMAP_TAX_FLAGS))
-        num_seq_flags = len(all_seq_flags)
-        tax_column_headers = ["tax id", "size", *all_seq_flags, "taxonomy"]
+    def dump_efficiency(self):
+        """Core time allocated to each stage but left idle, by the thread count of each run"""
+        if not self.all_threads:
+            return
+
+        samples = sorted(self.all_threads)
+        all_idle = {
+            sample: [
+                idle_core_seconds(self.all_threads[sample], walltime, cputime)
+                for walltime, cputime in zip(self.all_walltimes[sample], self.all_cputimes[sample])
+            ]
+            for sample in samples
+        }
+        # the overall time includes the time between stages, so isn't part of the batch total
+        stages = [idx for idx, stage in enumerate(TIME_CATEGORIES) if stage != OVERALL_STAGE]
+        stage_idle = {idx: sum(all_idle[sample][idx] or 0 for sample in samples) for idx in range(len(TIME_CATEGORIES))}
+        batch_idle = sum(stage_idle[idx] for idx in stages)
 
-        for sample in sorted(self.all_tax_data):
-            tax_data = self.all_tax_data[sample]
-
-            ws = self.workbook.add_worksheet(sample[:31])
-            ws.write_row(0, 0, tax_column_headers)
-            ws.set_column(0, 8, 8)
-            ws.set_column(9, 12, 20)
-            for idx, tax_entry in enumerate(tax_data):
-                tax_id, size, seq_flags = tax_entry[0:3]
-                taxonomy = tax_entry[3]
-
-                ws.write(idx + 1, 0, int(tax_id))
-                ws.write(idx + 1, 1, int(size))
-                for flag_idx, flag in enumerate(all_seq_flags):
-                    if flag in seq_flags:
-                        ws.write(idx + 1, 2 + flag_idx, 1)
-
-                ws.write_row(idx + 1, 2 + num_seq_flags, taxonomy)
-            # row = self.write_sample_dict(
-            #     ws, 0, 0, self.all_walltimes, ("Sample",) + TIME_CATEGORIES
-            # )
-
-            ws.autofilter(0, 0, len(tax_data), len(tax_column_headers) + 4)
-
-    def process(self, samples: Iterable[SampleResults]):
-        logger.info("Building workbook")
+        red_format = self.workbook.add_format({"bg_color": "#CC3333"})
 
-        for sample in samples:
-            logger.debug(sample)
+        ws = self.add_worksheet("Efficiency")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, [
+            "Stage", "Runs", "Idle core time", "Share of idle core time", "Median CPU ratio", "Median threads",
+            "Median efficiency", "Serial bottleneck",
+        ], self.header_fmt)
+        ws.set_column(0, 0, 25)
 
-            walltimes, cputimes, cpuratios = sample.simple_timing_info
-            self.all_walltimes[sample.run_name] = walltimes
-            self.all_cputimes[sample.run_name] = cputimes
-            self.all_cpuratios[sample.run_name] = cpuratios
-            tax_data = self.all_tax_data[sample.run_name] = []
-            flag_counts = Counter()
-            summary = self.all_summary[sample.run_name] = [0, 0, 0, 0, 0, 0, flag_counts]
+        for row, idx in enumerate([*stages, TIME_CATEGORIES.index(OVERALL_STAGE)]):
+            runs = [
+                (self.all_threads[sample], self.all_cpuratios[sample][idx])
+                for sample in samples
+                if all_idle[sample][idx] is not None and self.all_cpuratios[sample][idx] is not None
+            ]
+            median_ratio = percentile([ratio for _, ratio in runs], 50)
+            median_threads = percentile([threads for threads, _ in runs], 50)
+            serial = (
+                    TIME_CATEGORIES[idx] != OVERALL_STAGE
+                    and median_ratio is not None
+                    and median_ratio <= SERIAL_MAX_RATIO
+                    and median_threads >= SERIAL_MIN_THREADS
+            )
 
-            # ["Benign errors", "Critcal errors", "Killed count", "Output sequences", "Unique output taxids"],
+            ws.write_row(row + 1, 0, [TIME_CATEGORIES[idx], len(runs)])
+            ws.write(row + 1, 2, stage_idle[idx] / 86400, self.time_fmt_hrs)
+            if TIME_CATEGORIES[idx] != OVERALL_STAGE and batch_idle:
+                ws.write(row + 1, 3, stage_idle[idx] / batch_idle)
+            ws.write_row(row + 1, 4, [
+                median_ratio,
+                median_threads,
+                percentile([ratio / threads for threads, ratio in runs], 50),
+            ])
+            if serial:
+                ws.write(row + 1, 7, "yes", red_format)
+
+        row = len(TIME_CATEGORIES) + 1
+        ws.write(row, 0, "All stages", self.header_fmt)
+        ws.write(row, 2, batch_idle / 86400, self.time_fmt_hrs)
+        ws.conditional_format(1, 3, len(stages), 3, self.inverse_color_scale)
+
+        # idle core time of each sample and stage
+        self.write_sample_dict(ws, row + 2, 0, all_idle, ("Sample",) + TIME_CATEGORIES)
+
+    def dump_stage_profile(self):
+        """Every stage and sub-stage over all samples, by decreasing walltime not spent in a sub-stage"""
+        ws = self.add_worksheet("Stage profile")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, [
+            "Stage", "Depth", "Samples", "Total self walltime",
+            "Median walltime", "p90 walltime", "Max walltime", "Total walltime",
+            "Median CPU time", "p90 CPU time", "Max CPU time", "Total CPU time",
+            "Median CPU ratio", "p90 CPU ratio", "Max CPU ratio",
+        ], self.header_fmt)
+        ws.set_column(0, 0, 50)
+        ws.set_column(3, 11, 10, self.time_fmt_hrs)
+
+        hotspots = self.profile.hotspots()
+        for row, (path, node) in enumerate(hotspots):
+            walltime = node.walltime
+            cpu_time = node.cpu_time
+            cpu_ratio = node.cpu_ratio
+            ws.write_row(row + 1, 0, [
+                " > ".join(path),
+                len(path),
+                walltime.count,
+                node.self_walltime / 86400,
+                *(None if value is None else value / 86400 for value in (walltime.median, walltime.p90, walltime.max, walltime.total)),
+                *(None if value is None else value / 86400 for value in (cpu_time.median, cpu_time.p90, cpu_time.max, cpu_time.total)),
+                cpu_ratio.median,
+                cpu_ratio.p90,
+                cpu_ratio.max,
+            ])
+
+        ws.autofilter(0, 0, len(hotspots), 14)
+
+    def dump_thread_scaling(self):
+        """Amdahl's law fitted to each stage over the thread counts of the runs, and the thread counts suiting each run"""
+        if not self.all_threads:
+            return
+
+        ws = self.add_worksheet("Thread scaling")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, [
+            "Stage", "Runs", "Thread counts", "Serial fraction", "Max speedup", "Observed efficiency",
+            *(f"Efficiency at {threads} threads" for threads in CANDIDATE_THREADS),
+        ], self.header_fmt)
+        ws.set_column(0, 0, 25)
 
-            for line in sample.warnings_and_errors:
-                line = line.strip()
+        for row, stage in enumerate(self.scaling.stages.values()):
+            max_speedup = stage.max_speedup
+            ws.write_row(row + 1, 0, [
+                stage.stage,
+                stage.runs,
+                ", ".join(map(str, stage.thread_counts)),
+                stage.serial_fraction,
+                max_speedup if max_speedup != float("inf") else None,
+                stage.observed_efficiency,
+                *map(stage.efficiency, CANDIDATE_THREADS),
+            ])
+        last_row = len(self.scaling.stages)
+        ws.conditional_format(1, 6, last_row, 5 + len(CANDIDATE_THREADS), self.color_scale)
+
+        # the thread counts suiting the amount of work in each run
+        row = last_row + 2
+        ws.set_row(row, self.header_height)
+        ws.write_row(row, 0, [
+            "Sample", "Threads", "Work (CPU time)", "Predicted walltime", "Predicted efficiency",
+            f"Max efficient threads (≥{MIN_EFFICIENCY:.0%} efficiency)", "Walltime at max efficient",
+            "Fastest threads", "Walltime at fastest",
+        ], self.header_fmt)
+
+        # runs which logged no CPU times have no work to base a recommendation on
+        works = {sample: self.scaling.run_work(self.all_cputimes[sample]) for sample in sorted(self.all_threads)}
+        works = {sample: work for sample, work in works.items() if work}
+        if works:
+            works["Median sample"] = {
+                stage: percentile([work.get(stage, 0) for work in works.values()], 50) for stage in TIME_CATEGORIES
+            }
+        for sample, work in works.items():
+            recommendation = self.scaling.recommend(work)
+            if recommendation is None:
+                continue
+
+            row += 1
+            threads = self.all_threads.get(sample)
+            predicted_walltime = self.scaling.predict_walltime(work, threads) if threads else None
+            ws.write_row(row, 0, [sample, threads])
+            ws.write(row, 2, recommendation.work / 86400, self.time_fmt_hrs)
+            if predicted_walltime:
+                ws.write(row, 3, predicted_walltime / 86400, self.time_fmt_hrs)
+                ws.write(row, 4, recommendation.work / (threads * predicted_walltime))
+            ws.write(row, 5, recommendation.max_efficient)
+            ws.write(row, 6, recommendation.walltimes[recommendation.max_efficient] / 86400, self.time_fmt_hrs)
+            ws.write(row, 7, recommendation.fastest)
+            ws.write(row, 8, recommendation.walltimes[recommendation.fastest] / 86400, self.time_fmt_hrs)
+
+    def dump_iteration_cycles(self):
+        """Time taken by each cycle of iterative improvement, against the counts showing how far the contigs converged"""
+        if not self.all_cycles:
+            return
+
+        count_names = sorted({name for cycles in self.all_cycles.values() for cycle in cycles for name in cycle.counts})
+
+        ws = self.add_worksheet("Iterative improvement")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, [
+            "Sample", "Cycle", "Cycle time", *CYCLE_TIMINGS,
+            *(header for name in count_names for header in (name, f"Change in {name}")),
+        ], self.header_fmt)
+        ws.set_column(0, 0, 25)
+        ws.set_column(2, 2 + len(CYCLE_TIMINGS), 10, self.time_fmt)
+
+        row = 0
+        for sample in sorted(self.all_cycles):
+            previous_counts = {}
+            for cycle in self.all_cycles[sample]:
+                row += 1
+                timings = dict(cycle.timings)
+                ws.write_row(row, 0, [
+                    sample,
+                    cycle.number,
+                    *(None if time is None else float(time) / 86400 for time in (
+                        cycle.time, *(timings.get(name) for name in CYCLE_TIMINGS)
+                    )),
+                ])
+                for idx, name in enumerate(count_names):
+                    count = cycle.counts.get(name)
+                    previous = previous_counts.get(name)
+                    ws.write_row(row, 3 + len(CYCLE_TIMINGS) + 2 * idx, [
+                        count,
+                        None if count is None or previous is None else count - previous,
+                    ])
+                previous_counts.update(cycle.counts)
+
+        ws.autofilter(0, 0, row, 2 + len(CYCLE_TIMINGS) + 2 * len(count_names))
+
+    def write_profile_flame_graph(self):
+        """The timing trees of all samples merged into one flame graph, written alongside the workbook"""
+        flame_fn = f"{os.path.splitext(self.out_fn)[0]}_flame.html"
+        write_flame_graph(f"{flame_fn}.tmp", os.path.basename(self.out_fn), self.profile.to_json())
+        publish(f"{flame_fn}.tmp", flame_fn)
+
+    def dump_rank_rollups(self):
+        for rank, rollups in self.all_rollups.items():
+            samples = sorted(rollups)
+
+            totals = Counter()
+            for sample in samples:
+                totals.update(rollups[sample])
+
+            ws = self.add_worksheet(self.rollup_sheet_name(rank))
+            ws.set_row(0, self.header_height)
+            ws.write_row(0, 0, ["tax id", rank, "total", *samples], self.header_fmt)
+            ws.set_column(1, 1, 25)
+
+            for idx, (tax_id, total) in enumerate(sorted(totals.items(), key=lambda x: (-x[1], x[0]))):
+                name = "unassigned" if tax_id == UNASSIGNED else tax_db.names.get(tax_id, "")
+                ws.write_row(idx + 1, 0, [tax_id, name, total, *(rollups[sample][tax_id] for sample in samples)])
+
+            ws.autofilter(0, 0, len(totals), 2 + len(samples))
+
+    def dump_similarity(self):
+        matrix = self.matrix_builder.build()
+        samples = matrix.samples
+        distances = SampleDistances(matrix)
+        clusters = distances.clusters()
+
+        ws = self.add_worksheet("Clusters")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, ["Sample", "Cluster", "Cluster size", "Nearest sample", "Bray-Curtis", "Jaccard"], self.header_fmt)
+        ws.set_column(0, 0, 25)
+        ws.set_column(3, 3, 25)
+        cluster_sizes = Counter(clusters)
+        for row, idx in enumerate(sorted(range(len(samples)), key=lambda idx: (clusters[idx], samples[idx]))):
+            nearest = distances.nearest(idx)
+            ws.write_row(row + 1, 0, [
+                samples[idx],
+                clusters[idx],
+                cluster_sizes[clusters[idx]],
+                *((samples[nearest], distances.bray_curtis(idx, nearest), distances.jaccard(idx, nearest))
+                  if nearest is not None else ()),
+            ])
+        ws.autofilter(0, 0, len(samples), 5)
+
+        ws = self.add_worksheet("Shared taxa")
+        ws.set_row(0, self.header_height)
+        ws.write_row(0, 0, ["tax id", "name", "reason", "source sample", "source size", "samples", "sample names"], self.header_fmt)
+        ws.set_column(1, 3, 25)
+        shared_taxa = find_shared_taxa(matrix)
+        for row, taxon in enumerate(shared_taxa):
+            ws.write_row(row + 1, 0, [
+                taxon.tax_id,
+                tax_db.names.get(taxon.tax_id, ""),
+                taxon.reason,
+                taxon.source,
+                taxon.source_size,
+                len(taxon.samples),
+                ", ".join(taxon.samples),
+            ])
+        ws.autofilter(0, 0, len(shared_taxa), 6)
+
+        for name, distance in (("Bray-Curtis", distances.bray_curtis), ("Jaccard", distances.jaccard)):
+            ws = self.add_worksheet(name)
+            if len(samples) > self.MAX_DISTANCE_MATRIX_SAMPLES:
+                logger.warning("Too many samples to write the %s distance matrix", name)
+                continue
+
+            ws.set_row(0, self.header_height)
+            ws.write_row(0, 0, ["Sample", *samples], self.header_fmt)
+            ws.set_column(0, 0, 25)
+            for x in range(len(samples)):
+                ws.write_row(x + 1, 0, [samples[x], *(distance(x, y) for y in range(len(samples)))])
+            ws.conditional_format(1, 1, len(samples), len(samples), {
+                "type": "2_color_scale", "min_color": "#ff860d", "max_color": "#ffffff",
+            })
+
+    @staticmethod
+    def rollup_sheet_name(rank: str) -> str:
+        return f"{rank.capitalize()} roll-up"
 
-                if any(map(lambda x: x.search(line), BENIGN_ERRORS)):
-                    summary[0] += 1  # benign
-                else:
-                    summary[1] += 1  # critical
-                    # logger.warning(f'Critical error in {sample.run_name!r}: {line!r}')
+    def dump_tax_stats(self):
+        for sample in sorted(self.all_tax_data):
+            self.write_tax_sheet(sample, self.all_tax_data[sample])
+
+    def write_tax_sheet(self, sample: str, tax_data: SampleOutput):
+        all_seq_flags = sorted(list(VIRMAP_TAX_FLAGS))
+        tax_column_headers = ["tax id", "size", *all_seq_flags, "taxonomy"]
 
-                if "Killed" in line:
-                    summary[2] += 1  # killed
+        ws = self.workbook.add_worksheet(sample[:31])
+        ws.write_row(0, 0, tax_column_headers)
+        ws.set_column(0, 8, 8)
+        ws.set_column(9, 12, 20)
+        flag_bits = [TAX_FLAG_BITS[flag] for flag in all_seq_flags]
+        for idx, (tax_id, size, flag_mask) in enumerate(zip(tax_data.tax_ids, tax_data.sizes, tax_data.flag_masks)):
+            ws.write_row(idx + 1, 0, [
+                tax_id,
+                size,
+                *(1 if flag_mask & bit else None for bit in flag_bits),
+                *tax_data.lineages[tax_id],
+            ])
+        # row = self.write_sample_dict(
+        #     ws, 0, 0, self.all_walltimes, ("Sample",) + TIME_CATEGORIES
+        # )
 
-            # Extract results
-            for entry in sample.final_output:
-                tax_data.append([entry.tax_id, entry.tax_size, entry.flags, entry.taxonomy])
+        ws.autofilter(0, 0, len(tax_data), len(tax_column_headers) + 4)
 
-            summary[3] = len(tax_data)
-            summary[4] = len(set(map(lambda x: x[0], tax_data)))
-            summary[5] = len(list(filter(lambda x: x[0] == 10239, tax_data)))
+    def begin(self):
+        logger.info("Building workbook")
 
+        if self.streaming:
+            for name in (
+                    "Summary", *(("In flight",) if self.in_flight else ()), "Walltimes", "CPU ratio", "CPU time", "Efficiency", "Stage profile", "Thread scaling",
+                    "Iterative improvement",
+                    *map(self.rollup_sheet_name, ROLLUP_RANKS),
+            ):
+                self._sheets[name] = self.workbook.add_worksheet(name)
+            if self.similarity:
+                for name in self.SIMILARITY_SHEETS:
+                    self._sheets[name] = self.workbook.add_worksheet(name)
+
+    def add_sample(self, sample: SampleResults):
+        logger.debug(sample)
+        self.num_samples += 1
+
+        walltimes, cputimes, cpuratios = sample.simple_timing_info
+        self.all_walltimes[sample.run_name] = walltimes
+        self.all_cputimes[sample.run_name] = cputimes
+        self.all_cpuratios[sample.run_name] = cpuratios
+        self.profile.add(sample.detailed_timing_info)
+        if sample.iteration_cycles:
+            self.all_cycles[sample.run_name] = sample.iteration_cycles
+        if sample.threads:
+            self.all_threads[sample.run_name] = sample.threads
+            self.scaling.add_run(sample.threads, walltimes, cputimes)
+        tax_data = sample.final_output
+        self.all_summary[sample.run_name] = sample_summary(sample)
+
+        _, pattern_counts = ERROR_CLASSIFIER.count(sample.error_hits)
+        self.pattern_lines.update(pattern_counts)
+        self.pattern_samples.update(pattern_counts.keys())
+
+        for rank, totals in rollup_sample(sample, ROLLUP_RANKS).items():
+            self.all_rollups[rank][sample.run_name] = totals
+
+        if self.similarity:
+            self.matrix_builder.add_output(sample.run_name, tax_data)
+
+        if self.streaming:
+            self.write_tax_sheet(sample.run_name, tax_data)
+        else:
+            self.all_tax_data[sample.run_name] = tax_data
+
+    def finish(self):
         logger.info("Adding summary")
         self.dump_summary()
+        self.dump_in_flight()
 
         logger.info("Adding time stats")
         self.dump_time_stats()
 
+        logger.info("Adding efficiency")
+        self.dump_efficiency()
+
+        logger.info("Adding stage profile")
+        self.dump_stage_profile()
+
+        logger.info("Adding thread scaling")
+        self.dump_thread_scaling()
+
+        logger.info("Adding iterative improvement cycles")
+        self.dump_iteration_cycles()
+
+        logger.info("Adding rank roll-ups")
+        self.dump_rank_rollups()
+
+        if self.similarity:
+            logger.info("Adding sample similarity")
+            self.dump_similarity()
+
         logger.info("Adding taxonomy stats")
         self.dump_tax_stats()
 
+        # sheets created up front but left without data
+        for ws in self._sheets.values():
+            ws.hide()
+
         logger.info("Saving workbook")
         self.close()
 
+        self.write_profile_flame_graph()
+
     def close(self):
         self.workbook.close()
+        publish(self.tmp_fn, self.out_fn)
@@ -12,5 +12,7 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+from .iterate_improve import IterateImproveExtractor, IterationCycle
 from .node import Node
-from .run_info import build_timing_tree, dump_timing_tree
+from .profile import ProfileNode, merge_timing_trees
+from .run_info import TimingTreeExtractors, build_timing_tree, dump_timing_tree, write_flame_graph
@@ -0,0 +1,92 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+from log_scanner import LineExtractor
+
+PAT_CYCLE_START = re.compile(r"^Cycle (\d+) started", re.IGNORECASE)
+PAT_CYCLE_END = re.compile(r"^([\d.]+) seconds for cycle (\d+)\s*$", re.IGNORECASE)
+PAT_CYCLE_TIMING = re.compile(r"(.*?):?[\t ]*([\d.]+) seconds", re.IGNORECASE)
+# Counts logged during a cycle, showing how far the contigs have converged
+PAT_CYCLE_COUNT = re.compile(r"^(\d+) (contigs? [\w ]*?)\s*$", re.IGNORECASE)
+PAT_IMPROVE_TOTAL = re.compile(r"Overall improve time: ([\d.]+) seconds", re.IGNORECASE)
+
+# Timings logged during a cycle which are kept as sub-stages of the cycle
+CYCLE_TIMINGS = (
+    "finished reading SAM after",
+    "Total time",
+    "THREADING took",
+    "Overall pileup time",
+)
+
+
+class IterationCycle(object):
+    """A cycle of VirMap's iterative improvement, with the timings and counts logged during it"""
+
+    def __init__(self, number: int):
+        self.number = number
+        self.time: Optional[str] = None
+        self.timings: List[Tuple[str, str]] = []
+        self.counts: Dict[str, int] = {}
+
+    def __repr__(self) -> str:
+        return f"IterationCycle(number={self.number}, time={self.time}, timings={self.timings}, counts={self.counts})"
+
+
+class IterateImproveExtractor(LineExtractor):
+    """
+    Splits an .iterateImprove.err log into its cycles, line by line
+
+    A cycle runs from its "Cycle N started" line to the matching "X seconds for cycle N" line. Cycles which never finish
+    (e.g. the run was killed) are dropped.
+    """
+
+    def __init__(self):
+        self.cycles: List[IterationCycle] = []
+        self.total_time: Optional[str] = None
+        self._cycle: Optional[IterationCycle] = None
+
+    def feed(self, line_no: int, line: str):
+        if line.startswith(("Cycle", "cycle")):
+            match = PAT_CYCLE_START.match(line)
+            if match:
+                self._cycle = IterationCycle(int(match.group(1)))
+                return
+
+        if "seconds" in line:
+            if self._cycle is not None:
+                match = PAT_CYCLE_END.match(line)
+                if match and int(match.group(2)) == self._cycle.number:
+                    self._cycle.time = match.group(1)
+                    self.cycles.append(self._cycle)
+                    self._cycle = None
+                    return
+
+                match = PAT_CYCLE_TIMING.match(line)
+                if match and match.group(1) in CYCLE_TIMINGS:
+                    self._cycle.timings.append((match.group(1), match.group(2)))
+                    return
+
+            match = PAT_IMPROVE_TOTAL.search(line)
+            if match:
+                self.total_time = match.group(1)
+        elif self._cycle is not None and line[:1].isdigit():
+            match = PAT_CYCLE_COUNT.match(line)
+            if match:
+                self._cycle.counts[match.group(2)] = int(match.group(1))
+
+    def finish(self):
+        self._cycle = None
@@ -0,0 +1,171 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import math
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from analyse_times.node import Node
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """The `q`th percentile of `values`, interpolating linearly between the closest ranks"""
+    if not values:
+        return None
+
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lower = math.floor(pos)
+    upper = math.ceil(pos)
+
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def _float(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class StageStats(NamedTuple):
+    """Distribution of one measure of a stage over the samples which logged it"""
+    count: int
+    median: Optional[float]
+    p90: Optional[float]
+    max: Optional[float]
+    total: Optional[float]
+
+    @classmethod
+    def of(cls, values: Sequence[float]) -> "StageStats":
+        return cls(
+            len(values),
+            percentile(values, 50),
+            percentile(values, 90),
+            max(values, default=None),
+            sum(values) if values else None,
+        )
+
+
+class ProfileNode(object):
+    """
+    A stage of the timing trees of many samples, merged by name
+
+    Stages logged more than once under the same parent by a sample (e.g. repeated diamond phases) are summed, so there's
+    at most one value of each measure per sample.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.walltimes: List[float] = []
+        self.cpu_seconds: List[float] = []
+        self.cpu_ratios: List[float] = []
+        self.children: Dict[str, "ProfileNode"] = {}
+
+    def add(self, node: Node):
+        """Merge a sample's (sub)tree rooted at `node` into this one"""
+        self._add_values([node])
+
+    def _add_values(self, nodes: List[Node]):
+        walltimes = [value for value in map(_float, (node.time for node in nodes)) if value is not None]
+        cpu_seconds = [value for value in map(_float, (node.cpu_seconds for node in nodes)) if value is not None]
+        if walltimes:
+            self.walltimes.append(sum(walltimes))
+        if cpu_seconds:
+            self.cpu_seconds.append(sum(cpu_seconds))
+        if len(nodes) == 1 and _float(nodes[0].cpu_ratio) is not None:
+            self.cpu_ratios.append(_float(nodes[0].cpu_ratio))
+        elif walltimes and cpu_seconds and sum(walltimes):
+            self.cpu_ratios.append(sum(cpu_seconds) / sum(walltimes))
+
+        by_name: Dict[str, List[Node]] = {}
+        for node in nodes:
+            for child in node.children:
+                if child.name is not None:
+                    by_name.setdefault(child.name, []).append(child)
+
+        for name, children in by_name.items():
+            profile_child = self.children.get(name)
+            if profile_child is None:
+                profile_child = self.children[name] = ProfileNode(name)
+            profile_child._add_values(children)
+
+    @property
+    def walltime(self) -> StageStats:
+        return StageStats.of(self.walltimes)
+
+    @property
+    def cpu_time(self) -> StageStats:
+        return StageStats.of(self.cpu_seconds)
+
+    @property
+    def cpu_ratio(self) -> StageStats:
+        return StageStats.of(self.cpu_ratios)
+
+    @property
+    def self_walltime(self) -> float:
+        """Total walltime over every sample not accounted for by any sub-stage"""
+        return max(0.0, sum(self.walltimes) - sum(sum(child.walltimes) for child in self.children.values()))
+
+    def walk(self, path: Tuple[str, ...] = ()) -> Iterator[Tuple[Tuple[str, ...], "ProfileNode"]]:
+        """(path, node) of every stage below this one, depth first"""
+        for child in self.children.values():
+            child_path = path + (child.name,)
+            yield child_path, child
+            yield from child.walk(child_path)
+
+    def hotspots(self) -> List[Tuple[Tuple[str, ...], "ProfileNode"]]:
+        """Every stage below this one, by decreasing total walltime not spent in any sub-stage"""
+        return sorted(self.walk(), key=lambda x: (-x[1].self_walltime, x[0]))
+
+    def to_json(self):
+        """Flame graph data, each stage sized by its total walltime over every sample"""
+        stats = self.walltime
+        name = self.name
+        if stats.count:
+            name += f", median {stats.median:.1f}s, p90 {stats.p90:.1f}s, max {stats.max:.1f}s over {stats.count} samples"
+
+        obj = {"name": name, "value": stats.total or 0}
+        if self.children:
+            obj["children"] = [child.to_json() for child in self.children.values()]
+
+        return obj
+
+
+def flatten_timing_tree(tree: Node) -> Dict[Tuple[str, ...], float]:
+    """{path: walltime} of every stage below the root of a sample's timing tree, summing repeated stages"""
+    flat: Dict[Tuple[str, ...], float] = {}
+
+    def visit(node: Node, path: Tuple[str, ...]):
+        for child in node.children:
+            if child.name is None:
+                continue
+
+            child_path = path + (child.name,)
+            walltime = _float(child.time)
+            if walltime is not None:
+                flat[child_path] = flat.get(child_path, 0.0) + walltime
+            visit(child, child_path)
+
+    visit(tree, ())
+
+    return flat
+
+
+def merge_timing_trees(trees: Sequence[Node]) -> ProfileNode:
+    """Merge the detailed timing trees of many samples"""
+    profile = ProfileNode("root")
+    for tree in trees:
+        profile.add(tree)
+
+    return profile
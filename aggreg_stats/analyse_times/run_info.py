@@ -16,139 +16,115 @@ import json
 import os
 import re
 
+from analyse_times.iterate_improve import IterateImproveExtractor
 from analyse_times.node import Node
+from log_scanner import LogScanner, RegexExtractor
 
 PAT_BBMAP = re.compile(r"^(.*?):\s+([\d.]+) seconds", re.IGNORECASE | re.MULTILINE)
 PAT_DIAMOND = re.compile(
     r"^(.*?)...\s+\[([\d.]+)s\]$|^(Total time) = ([\d.]+)s$",
     re.IGNORECASE | re.MULTILINE,
 )
-PAT_ITER_CYCLES = re.compile(
-    r"(^Cycle (\d+) started(?:.*\n)*(\d+) seconds for cycle \2)$",
-    re.IGNORECASE | re.MULTILINE,
-)
-PAT_ITER_IMP_TOTAL = re.compile(r"Overall improve time: (\d+) seconds", re.IGNORECASE)
-PAT_TIME_SECONDS = re.compile(r"(.*?):?[\t ]*([\d.]+) seconds", re.IGNORECASE)
 PAT_PBS_WALLTIME = re.compile(r"Walltime Used: (\d+:\d+:\d+)")
 
 
-def build_timing_tree(sample):
-    from sample_results import SampleResults
-    assert isinstance(sample, SampleResults)
+class TimingTreeExtractors(object):
+    """Registers the extractors for every file the detailed timing tree is built from"""
 
-    pat_time = re.compile(
-        "TIME "
-        + sample.name
-        + r" (.*?): ([\d.]+) seconds, ([\d.]+) CPU seconds, ([\d.]+) CPU ratio",
-        re.IGNORECASE,
-    )
+    def __init__(self, scanner: LogScanner, sample):
+        pat_time = re.compile(
+            "TIME "
+            + re.escape(sample.name)
+            + r" (.*?): ([\d.]+) seconds, ([\d.]+) CPU seconds, ([\d.]+) CPU ratio",
+            re.IGNORECASE,
+        )
+
+        self.time = scanner.register(f"{sample.prefix}.log", RegexExtractor(pat_time), required=True)
+        self.bbmap = scanner.register(sample.prefix + ".bbmap.err", RegexExtractor(PAT_BBMAP))
+        self.build_super_scaffolds = scanner.register(
+            sample.tmp_prefix + ".buildSuperScaffolds.err", RegexExtractor(PAT_DIAMOND)
+        )
+        self.filter = scanner.register(sample.tmp_prefix + ".filter.err", RegexExtractor(PAT_DIAMOND))
+        self.iterate_improve = scanner.register(
+            sample.tmp_prefix + ".iterateImprove.err", IterateImproveExtractor()
+        )
+        self.diamond_full = scanner.register(sample.prefix + ".diamondBlastx.err", RegexExtractor(PAT_DIAMOND))
+
+        self.pbs_walltime = None
+        if sample.pbs_log_filename:
+            self.pbs_walltime = scanner.register(sample.pbs_log_filename, RegexExtractor(PAT_PBS_WALLTIME))
 
-    tree = Node("root")
-    with open(f"{sample.prefix}.log", "r") as f:
-        for match in pat_time.finditer(f.read()):
+    @staticmethod
+    def _diamond_nodes(root: Node, extractor: RegexExtractor):
+        for match in extractor.matches:
+            if match.group(3):
+                root.replace_with(Node(match.group(3), match.group(4)))
+            else:
+                root.append(Node(match.group(1), match.group(2)))
+
+    def build(self) -> Node:
+        tree = Node("root")
+        for match in self.time.matches:
             n = Node(match.group(1), match.group(2), match.group(3), match.group(4))
             if n.name.startswith("Overall"):
                 tree.replace_with(n)
             else:
                 if n.name == "bbmap to virus":
                     bb_root = n.append(Node("bb_root"))
-                    with open(sample.prefix + ".bbmap.err", "r") as bb_f:
-                        for bb_match in PAT_BBMAP.finditer(bb_f.read()):
-                            bb_node = Node(bb_match.group(1), bb_match.group(2))
-                            if bb_node.name == "Total time":
-                                bb_root.replace_with(bb_node)
-                            else:
-                                bb_root.append(bb_node)
+                    for bb_match in self.bbmap.matches:
+                        bb_node = Node(bb_match.group(1), bb_match.group(2))
+                        if bb_node.name == "Total time":
+                            bb_root.replace_with(bb_node)
+                        else:
+                            bb_root.append(bb_node)
                 elif n.name == "diamond to virus":
-                    bss_root = n.append(Node("bss_root"))
-
-                    with open(
-                            sample.tmp_prefix + ".buildSuperScaffolds.err", "r"
-                    ) as bss_f:
-                        for bss_match in PAT_DIAMOND.finditer(bss_f.read()):
-                            if bss_match.group(3):
-                                bss_root.replace_with(
-                                    Node(bss_match.group(3), bss_match.group(4))
-                                )
-                            else:
-                                bss_root.append(
-                                    Node(bss_match.group(1), bss_match.group(2))
-                                )
+                    self._diamond_nodes(n.append(Node("bss_root")), self.build_super_scaffolds)
                 elif n.name == "diamond filter map":
-                    dfm_root = n.append(Node("dfm_root"))
-
-                    with open(sample.tmp_prefix + ".filter.err", "r") as dfm_f:
-                        for dfm_match in PAT_DIAMOND.finditer(dfm_f.read()):
-                            if dfm_match.group(3):
-                                dfm_root.replace_with(
-                                    Node(dfm_match.group(3), dfm_match.group(4))
-                                )
-                            else:
-                                dfm_root.append(
-                                    Node(dfm_match.group(1), dfm_match.group(2))
-                                )
+                    self._diamond_nodes(n.append(Node("dfm_root")), self.filter)
                 elif n.name == "iterative improvement":
-                    ii_root = n
-
-                    with open(sample.tmp_prefix + ".iterateImprove.err", "r") as ii_f:
-                        ii_data = ii_f.read()
-                        # ii_root.time = PAT_ITER_IMP_TOTAL.search(ii_data).group(1)
-
-                        for ii_cycle in PAT_ITER_CYCLES.finditer(ii_data):
-                            ii_cyc_num, ii_cyc_time, ii_cyc = (
-                                ii_cycle.group(2),
-                                ii_cycle.group(3),
-                                ii_cycle.group(1),
-                            )
-
-                            ii_node = ii_root.append(
-                                Node(f"Cycle {ii_cyc_num}", ii_cyc_time)
-                            )
-
-                            for ii_match in PAT_TIME_SECONDS.finditer(ii_cyc):
-                                iit_name, iit_time = (
-                                    ii_match.group(1),
-                                    ii_match.group(2),
-                                )
-                                if iit_name not in {
-                                    "finished reading SAM after",
-                                    "Total time",
-                                    "THREADING took",
-                                    "Overall pileup time",
-                                }:
-                                    continue
-
-                                ii_node.append(Node(iit_name, iit_time))
+                    for cycle in self.iterate_improve.cycles:
+                        cycle_node = n.append(Node(f"Cycle {cycle.number}", cycle.time))
+                        for name, time in cycle.timings:
+                            cycle_node.append(Node(name, time))
                 elif n.name == "diamond full":
                     df_root = n
 
-                    with open(sample.prefix + ".diamondBlastx.err", "r") as df_f:
-                        for df_match in PAT_DIAMOND.finditer(df_f.read()):
-                            df_root.append(
-                                Node(df_match.group(1), df_match.group(2))
-                            )
+                    for df_match in self.diamond_full.matches:
+                        df_root.append(
+                            Node(df_match.group(1), df_match.group(2))
+                        )
 
                 tree.append(n)
 
-    if tree.time is None and sample.pbs_log_filename:
-        # try to find used walltime appended by pbs
-        with open(sample.pbs_log_filename, "r") as f:
-            match = PAT_PBS_WALLTIME.search(f.read())
-            if match is not None:
-                tree.name = "root - DID NOT COMPLETE"
-                tree.time = sum(
-                    int(x) * 60 ** exponent
-                    for exponent, x in enumerate(match.group(1).split(":")[::-1])
-                )
+        if tree.time is None and self.pbs_walltime is not None and self.pbs_walltime.matches:
+            # try to find used walltime appended by pbs
+            match = self.pbs_walltime.matches[0]
+            tree.name = "root - DID NOT COMPLETE"
+            tree.time = sum(
+                int(x) * 60 ** exponent
+                for exponent, x in enumerate(match.group(1).split(":")[::-1])
+            )
 
-    return tree
+        return tree
+
+
+def build_timing_tree(sample):
+    from sample_results import SampleResults
+    assert isinstance(sample, SampleResults)
+
+    return sample.log_scan.timing_tree.build()
 
 
 def dump_timing_tree(dest_dir: str, sample):
     from sample_results import SampleResults
     assert isinstance(sample, SampleResults)
 
-    json_tree = json.dumps(sample.detailed_timing_info.to_json(), indent=2)
+    write_flame_graph(os.path.join(dest_dir, f"flame.html"), sample.run_name, sample.detailed_timing_info.to_json())
+
+
+def write_flame_graph(filename: str, title: str, data):
+    """Write an interactive flame graph of `data` (as produced by `Node.to_json`)"""
+    json_tree = json.dumps(data, indent=2)
 
     with open(os.path.join(os.path.dirname(__file__), "flame_template.html"), "r") as f:
         html_template = f.read()
@@ -163,12 +139,12 @@ def dump_timing_tree(dest_dir: str, sample):
         r"{\s*TEMPLATE_JS_TITLE\s*}", re.IGNORECASE | re.MULTILINE
     )
 
-    with open(os.path.join(dest_dir, f"flame.html"), "w") as f:
-        html_template = template_title.sub(sample.run_name, html_template)
+    with open(filename, "w") as f:
+        html_template = template_title.sub(title, html_template)
         html_template = template_js_title.sub(
-            json.dumps(sample.run_name), html_template
+            json.dumps(title), html_template
         )
-        html_template = template_data.sub(json_tree, html_template)
+        html_template = template_data.sub(lambda _: json_tree, html_template)
         f.write(html_template)
 
 
@@ -0,0 +1,147 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import fcntl
+import fnmatch
+import gzip
+import os
+import shutil
+from collections import Counter
+from typing import Collection, Iterable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from util import get_logger
+
+# Files copied to the per-sample output by default: logs, err files and results, but not intermediate data
+ARCHIVE_INCLUDE = ("*.log", "*.err", "*.txt", "*.final.fa", "*.dot")
+ARCHIVE_LINK_MODES = ("copy", "reflink", "hardlink")
+# Smallest file compressed when compression is enabled
+ARCHIVE_COMPRESS_MIN_SIZE = 16 << 20
+
+# ioctl cloning a whole file (linux/fs.h)
+_FICLONE = 0x40049409
+_COPY_BUFFER_SIZE = 1 << 20
+
+logger = get_logger(__name__)
+
+
+class ArchivePolicy(object):
+    """
+    Which files of a sample are archived and how
+
+    `include` and `exclude` are globs matched against both the filename and the path relative to the directory being
+    archived. With the `reflink` link mode files are cloned where the filesystem supports it, with `hardlink` they are
+    hard linked where possible (so the archive shares the original files), and both fall back to copying. With
+    `compress`, files of at least `compress_min_size` bytes are compressed with zstd (or gzip, if the zstandard module
+    isn't installed) instead.
+    """
+
+    def __init__(
+            self,
+            include: Iterable[str] = ARCHIVE_INCLUDE,
+            exclude: Iterable[str] = (),
+            link: str = "reflink",
+            compress: bool = False,
+            compress_min_size: int = ARCHIVE_COMPRESS_MIN_SIZE,
+    ):
+        if link not in ARCHIVE_LINK_MODES:
+            raise ValueError(f"Unknown link mode {link!r}")
+
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.link = link
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+
+    def selects(self, rel_path: str) -> bool:
+        name = os.path.basename(rel_path)
+
+        def matches(patterns):
+            return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+        return matches(self.include) and not matches(self.exclude)
+
+
+def _reflink(src: str, dst: str):
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+
+
+def _compress(src: str, dst: str) -> str:
+    """Compress `src` to `dst` plus the compressor's extension, returns the filename written"""
+    if zstandard is not None:
+        dst += ".zst"
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            zstandard.ZstdCompressor().copy_stream(f_src, f_dst, read_size=_COPY_BUFFER_SIZE)
+    else:
+        dst += ".gz"
+        with open(src, "rb") as f_src, gzip.open(dst, "wb", compresslevel=6) as f_dst:
+            shutil.copyfileobj(f_src, f_dst, _COPY_BUFFER_SIZE)
+
+    return dst
+
+
+def archive_file(src: str, dst: str, policy: ArchivePolicy) -> str:
+    """Archive a single file, returns how it was archived"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # never write through a hard link left by a previous archive
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if policy.compress and os.path.getsize(src) >= policy.compress_min_size:
+        shutil.copystat(src, _compress(src, dst))
+        return "compressed"
+
+    if policy.link == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlinked"
+        except OSError:
+            pass
+
+    if policy.link in ("reflink", "hardlink"):
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            return "reflinked"
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    return "copied"
+
+
+def archive_tree(
+        src_dir: str, dst_dir: str, policy: ArchivePolicy, skip: Collection[str] = ()
+) -> Counter:
+    """Archive the files of `src_dir` selected by `policy` (other than those in `skip`) into `dst_dir`"""
+    methods = Counter()
+    if not os.path.isdir(src_dir):
+        return methods
+
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            src = os.path.join(dirpath, fn)
+            rel_path = os.path.relpath(src, src_dir)
+            if src in skip or not policy.selects(rel_path):
+                continue
+
+            methods[archive_file(src, os.path.join(dst_dir, rel_path), policy)] += 1
+
+    return methods
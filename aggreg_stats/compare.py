@@ -0,0 +1,367 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import logging
+import math
+import os
+import random
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import xlsxwriter
+
+from analyse_times.profile import flatten_timing_tree, percentile
+from constants import TIME_CATEGORIES
+from sample_results import SampleResults, find_sample_dirs
+from util import get_logger
+
+# Number of resamples used for the confidence interval of each median ratio
+DEFAULT_BOOTSTRAP = 2000
+DEFAULT_ALPHA = 0.05
+# Smallest change in the median ratio reported as a regression (or improvement), as a fraction
+DEFAULT_MIN_CHANGE = 0.05
+# Largest number of pairs for which the exact distribution of the Wilcoxon statistic is used
+WILCOXON_EXACT_MAX_PAIRS = 25
+
+logger = get_logger(__name__)
+
+
+def wilcoxon_signed_rank(differences: Sequence[float]) -> Optional[float]:
+    """
+    Two-sided p-value of the Wilcoxon signed-rank test that `differences` are centred on 0
+
+    Zero differences are dropped. The exact distribution is used for small samples without ties, otherwise the normal
+    approximation with tie and continuity corrections. None if every difference is zero.
+    """
+    differences = [d for d in differences if d != 0]
+    n = len(differences)
+    if not n:
+        return None
+
+    # average ranks of the absolute differences
+    order = sorted(range(n), key=lambda idx: abs(differences[idx]))
+    ranks = [0.0] * n
+    tie_sizes = []
+    start = 0
+    while start < n:
+        end = start
+        while end + 1 < n and abs(differences[order[end + 1]]) == abs(differences[order[start]]):
+            end += 1
+        for idx in range(start, end + 1):
+            ranks[order[idx]] = (start + end) / 2 + 1
+        tie_sizes.append(end - start + 1)
+        start = end + 1
+
+    w_plus = sum(rank for rank, d in zip(ranks, differences) if d > 0)
+    has_ties = any(size > 1 for size in tie_sizes)
+
+    if n <= WILCOXON_EXACT_MAX_PAIRS and not has_ties:
+        # number of subsets of the ranks 1..n with each sum
+        max_sum = n * (n + 1) // 2
+        counts = [1] + [0] * max_sum
+        for rank in range(1, n + 1):
+            for total in range(max_sum, rank - 1, -1):
+                counts[total] += counts[total - rank]
+
+        w = int(w_plus)
+        lower = sum(counts[:w + 1])
+        upper = sum(counts[w:])
+
+        return min(1.0, 2 * min(lower, upper) / 2 ** n)
+
+    mean = n * (n + 1) / 4
+    variance = n * (n + 1) * (2 * n + 1) / 24 - sum(size ** 3 - size for size in tie_sizes) / 48
+    if variance <= 0:
+        return 1.0
+    z = (abs(w_plus - mean) - 0.5) / math.sqrt(variance)
+
+    return min(1.0, math.erfc(max(0.0, z) / math.sqrt(2)))
+
+
+def min_pairs_for_alpha(alpha: float) -> int:
+    """Fewest pairs for which the two-sided Wilcoxon p-value can be below `alpha`, i.e. 2 / 2 ** n < alpha"""
+    pairs = 1
+    while 2 / 2 ** pairs >= alpha:
+        pairs += 1
+
+    return pairs
+
+
+def bootstrap_median_ci(
+        values: Sequence[float], resamples: int, alpha: float, rng: random.Random
+) -> Tuple[Optional[float], Optional[float]]:
+    """Percentile bootstrap confidence interval of the median of `values`"""
+    if len(values) < 2:
+        return None, None
+
+    n = len(values)
+    medians = sorted(
+        percentile([values[rng.randrange(n)] for _ in range(n)], 50) for _ in range(resamples)
+    )
+
+    return percentile(medians, 100 * alpha / 2), percentile(medians, 100 * (1 - alpha / 2))
+
+
+class StageComparison(NamedTuple):
+    """How one measure of a stage changed between the paired baseline and candidate samples"""
+    stage: str
+    measure: str
+    pairs: int
+    baseline_median: Optional[float]
+    candidate_median: Optional[float]
+    median_ratio: Optional[float]
+    ci_low: Optional[float]
+    ci_high: Optional[float]
+    p_value: Optional[float]
+    verdict: str
+    # why no verdict could be reached, if it couldn't
+    note: str = ""
+
+
+def sample_timings(sample: SampleResults) -> Dict[Tuple[str, str], float]:
+    """{(stage, measure): seconds} of every stage and sub-stage a sample logged"""
+    timings = {}
+
+    walltimes, cputimes, _ = sample.simple_timing_info
+    for stage, walltime, cputime in zip(TIME_CATEGORIES, walltimes, cputimes):
+        if walltime is not None:
+            timings[stage, "walltime"] = walltime
+        if cputime is not None:
+            timings[stage, "CPU time"] = cputime
+
+    # sub-stages only come from the detailed tree, the top level stages are covered above
+    for path, walltime in flatten_timing_tree(sample.detailed_timing_info).items():
+        if len(path) > 1:
+            timings[" > ".join(path), "walltime"] = walltime
+
+    return timings
+
+
+def compare_stage(
+        stage: str,
+        measure: str,
+        pairs: List[Tuple[float, float]],
+        resamples: int = DEFAULT_BOOTSTRAP,
+        alpha: float = DEFAULT_ALPHA,
+        min_change: float = DEFAULT_MIN_CHANGE,
+        rng: Optional[random.Random] = None,
+) -> StageComparison:
+    """Compare (baseline, candidate) values of a stage, pairs with a zero baseline can't give a ratio and are dropped"""
+    rng = rng if rng is not None else random.Random(0)
+    pairs = [(baseline, candidate) for baseline, candidate in pairs if baseline > 0 and candidate > 0]
+
+    ratios = [candidate / baseline for baseline, candidate in pairs]
+    median_ratio = percentile(ratios, 50)
+    ci_low, ci_high = bootstrap_median_ci(ratios, resamples, alpha, rng)
+    p_value = wilcoxon_signed_rank([math.log(ratio) for ratio in ratios])
+
+    # below this even the exact test can't reach alpha, and the normal approximation used for ties isn't trustworthy
+    note = ""
+    if len(pairs) < min_pairs_for_alpha(alpha):
+        note = f"too few pairs for p < {alpha:g}"
+
+    verdict = ""
+    if not note and p_value is not None and p_value < alpha and ci_low is not None:
+        if ci_low > 1 and median_ratio >= 1 + min_change:
+            verdict = "slower"
+        elif ci_high < 1 and median_ratio <= 1 - min_change:
+            verdict = "faster"
+
+    return StageComparison(
+        stage,
+        measure,
+        len(pairs),
+        percentile([baseline for baseline, _ in pairs], 50),
+        percentile([candidate for _, candidate in pairs], 50),
+        median_ratio,
+        ci_low,
+        ci_high,
+        p_value,
+        verdict,
+        note,
+    )
+
+
+def pair_samples(
+        baseline: Iterable[SampleResults], candidate: Iterable[SampleResults]
+) -> List[Tuple[SampleResults, SampleResults]]:
+    """Pair runs of the same sample (by VirMap sample name), the most recent run of each in either set is used"""
+
+    def by_name(samples):
+        named = {}
+        for sample in sorted(samples, key=lambda s: s.run_name):
+            named[sample.name] = sample
+        return named
+
+    baseline = by_name(baseline)
+    candidate = by_name(candidate)
+
+    for name in sorted(baseline.keys() ^ candidate.keys()):
+        logger.warning(
+            "Sample %r is only in the %s, skipping it", name, "baseline" if name in baseline else "candidate"
+        )
+
+    return [(baseline[name], candidate[name]) for name in sorted(baseline.keys() & candidate.keys())]
+
+
+def compare_samples(
+        pairs: List[Tuple[SampleResults, SampleResults]],
+        resamples: int = DEFAULT_BOOTSTRAP,
+        alpha: float = DEFAULT_ALPHA,
+        min_change: float = DEFAULT_MIN_CHANGE,
+) -> List[StageComparison]:
+    """Compare every stage logged by both samples of any pair, regressions first"""
+    values: Dict[Tuple[str, str], List[Tuple[float, float]]] = {}
+    for baseline, candidate in pairs:
+        baseline_timings = sample_timings(baseline)
+        candidate_timings = sample_timings(candidate)
+        for key in baseline_timings.keys() & candidate_timings.keys():
+            values.setdefault(key, []).append((baseline_timings[key], candidate_timings[key]))
+
+    # seeded so reports are reproducible
+    rng = random.Random(0)
+    comparisons = [
+        compare_stage(stage, measure, stage_pairs, resamples, alpha, min_change, rng)
+        for (stage, measure), stage_pairs in sorted(values.items())
+    ]
+
+    verdict_order = {"slower": 0, "faster": 1, "": 2}
+
+    return sorted(
+        comparisons,
+        key=lambda c: (verdict_order[c.verdict], c.p_value if c.p_value is not None else 2.0, c.stage, c.measure),
+    )
+
+
+def write_report(out_fn: str, comparisons: List[StageComparison], pairs: List[Tuple[SampleResults, SampleResults]]):
+    workbook = xlsxwriter.Workbook(out_fn)
+    header_fmt = workbook.add_format({"bold": True, "rotation": 15})
+    ratio_fmt = workbook.add_format({"num_format": "0.000"})
+    time_fmt = workbook.add_format({"num_format": "[hh]:mm:ss"})
+    red_format = workbook.add_format({"bg_color": "#CC3333"})
+    green_format = workbook.add_format({"bg_color": "#33CC33"})
+
+    ws = workbook.add_worksheet("Regressions")
+    ws.set_row(0, 50)
+    ws.write_row(0, 0, [
+        "Stage", "Measure", "Pairs", "Baseline median", "Candidate median", "Median ratio", "CI low", "CI high",
+        "Wilcoxon p", "Verdict", "Note",
+    ], header_fmt)
+    ws.set_column(0, 0, 50)
+    ws.set_column(3, 4, 10, time_fmt)
+    ws.set_column(5, 8, 8, ratio_fmt)
+
+    for row, comparison in enumerate(comparisons):
+        ws.write_row(row + 1, 0, [
+            comparison.stage,
+            comparison.measure,
+            comparison.pairs,
+            *(None if value is None else value / 86400 for value in (comparison.baseline_median, comparison.candidate_median)),
+            comparison.median_ratio,
+            comparison.ci_low,
+            comparison.ci_high,
+            comparison.p_value,
+            comparison.verdict,
+            comparison.note,
+        ])
+    ws.conditional_format(1, 9, len(comparisons), 9, {"type": "cell", "criteria": "==", "value": '"slower"', "format": red_format})
+    ws.conditional_format(1, 9, len(comparisons), 9, {"type": "cell", "criteria": "==", "value": '"faster"', "format": green_format})
+    ws.autofilter(0, 0, len(comparisons), 10)
+
+    ws = workbook.add_worksheet("Pairs")
+    ws.write_row(0, 0, ["Sample", "Baseline run", "Candidate run"], header_fmt)
+    ws.set_column(0, 2, 30)
+    for row, (baseline, candidate) in enumerate(pairs):
+        ws.write_row(row + 1, 0, [baseline.name, baseline.base_dir, candidate.base_dir])
+
+    workbook.close()
+
+
+def load_timing_samples(paths: Iterable[str]) -> List[SampleResults]:
+    """Samples of each path, either a run directory or a directory of runs, loading only their timings"""
+    samples = []
+    for path in paths:
+        directories = find_sample_dirs(path) or [path]
+        for directory in directories:
+            logger.info("Loading sample timings from %r", directory)
+            try:
+                sample = SampleResults(directory)
+                # noinspection PyStatementEffect
+                sample.simple_timing_info
+                # noinspection PyStatementEffect
+                sample.detailed_timing_info
+                # only the timings are needed, drop the raw scan of the logs
+                sample.__dict__.pop("log_scan", None)
+                samples.append(sample)
+            except Exception as e:
+                logger.exception("Failed to load sample %r", directory, exc_info=e)
+
+    return samples
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="main.py compare",
+        description="Compare the stage timings of runs of the same samples between two batches",
+    )
+    parser.add_argument('-b', '--baseline', nargs='+', required=True, help='Run directories, or directories of runs, of the baseline batch')
+    parser.add_argument('-c', '--candidate', nargs='+', required=True, help='Run directories, or directories of runs, of the candidate batch')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Filename for the regression report worksheet')
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA, help=f'Significance level of the Wilcoxon test and confidence intervals (default: {DEFAULT_ALPHA:g})')
+    parser.add_argument('--min-change', type=float, default=DEFAULT_MIN_CHANGE, help=f'Smallest change of the median ratio reported, as a fraction (default: {DEFAULT_MIN_CHANGE:g})')
+    parser.add_argument('--bootstrap', type=int, default=DEFAULT_BOOTSTRAP, help=f'Number of bootstrap resamples for the confidence intervals (default: {DEFAULT_BOOTSTRAP})')
+    parser.add_argument('-v', '--verbose', action='store_const', const=True, help='Show DEBUG level log messages')
+
+    parsed = parser.parse_args(args)
+    if parsed.verbose:
+        from util import console_handler
+        console_handler.setLevel(logging.DEBUG)
+
+    out_fn = os.path.abspath(parsed.output)
+    if not os.path.isdir(os.path.dirname(out_fn)):
+        raise ValueError(f"Destination folder {os.path.dirname(out_fn)!r} doesn't exist!")
+
+    pairs = pair_samples(load_timing_samples(parsed.baseline), load_timing_samples(parsed.candidate))
+    if not pairs:
+        logger.error("No samples in both the baseline and candidate!")
+        return
+
+    logger.info("Comparing %d pairs of runs", len(pairs))
+    comparisons = compare_samples(pairs, parsed.bootstrap, parsed.alpha, parsed.min_change)
+
+    min_pairs = min_pairs_for_alpha(parsed.alpha)
+    if len(pairs) < min_pairs:
+        logger.warning(
+            f"At least {min_pairs} pairs are needed for the Wilcoxon test to reach p < {parsed.alpha:g}, only "
+            f"{len(pairs)} given, so no stage can be reported as slower or faster"
+        )
+    else:
+        too_few = sum(1 for comparison in comparisons if comparison.note)
+        if too_few:
+            logger.warning(
+                f"{too_few} stages were logged by fewer than {min_pairs} pairs, too few to reach p < {parsed.alpha:g}"
+            )
+
+    for comparison in comparisons:
+        if comparison.verdict:
+            logger.info(
+                f"{comparison.stage} {comparison.measure} is {comparison.verdict}: median ratio "
+                f"{comparison.median_ratio:.3f} ({1 - parsed.alpha:.0%} CI {comparison.ci_low:.3f}-{comparison.ci_high:.3f}, "
+                f"p={comparison.p_value:.2g}, {comparison.pairs} pairs)"
+            )
+    if not any(comparison.verdict for comparison in comparisons):
+        logger.info("No significant changes")
+
+    write_report(out_fn, comparisons, pairs)
+    logger.info("Wrote %r", out_fn)
@@ -23,6 +23,10 @@ PAT_TIME = re.compile(
     r"TIME .*? (.*?): ([\d.]+) seconds(?:, ([\d.]+) CPU seconds, ([\d.]+) CPU ratio)?",
     re.IGNORECASE,
 )
+# Thread count virmap_wrapper.sh puts in run names, <sample>_T<threads>_<unixtime>
+PAT_RUN_THREADS = re.compile(r"_T(\d+)_\d+$")
+# Thread count in a PBS log, from the VirMap arguments or the PBS resource usage summary
+PAT_PBS_THREADS = re.compile(r"--threads[= ](\d+)|NCPUs Requested:\s*(\d+)")
 PAT_RESULTS = re.compile(
     r"taxid=(\d+), size=(\d+) \| ([^>\n]*)(?: > ([^>\n]*)(?: > ([^>\n]*)(?: > ([^>\n]*)(?: > ([^>\n]*)(?: > ([^>\n]*)(?: > ([^>\n]*))?)?)?)?)?)?$",
     re.MULTILINE,
@@ -113,3 +117,8 @@ PERL_WARNINGS = {
     "Error detecting",
     "cannot",
 }
+# Messages meaning a process was killed, usually for running out of memory
+OOM_KILLED_MSGS = {
+    "Killed",
+    "exceeded memory allocation",
+}
@@ -0,0 +1,99 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import mmap
+import os
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+from constants import PAT_TAG, PAT_TAX_ID
+
+
+class FinalFaHeader(NamedTuple):
+    """A tagged header line of a VirMap final.fa"""
+    header: str
+    tax_id: int
+    tax_size: int
+    flags: Tuple[str, ...]
+    # byte offset of the first line of the sequence, and the number of bases in it (-1 unless requested)
+    seq_offset: int = -1
+    seq_length: int = -1
+
+
+def iter_final_fa_headers(filename: str, sequences: bool = False) -> Iterator[FinalFaHeader]:
+    """
+    Parse the headers of a final.fa carrying a taxId and size, without copying or decoding the sequences in between
+
+    The file is memory-mapped and searched for each "\\n>", so the sequences are scanned at memchr speed rather than
+    skipped, and every page is still read. With `sequences`, the offset and length of each sequence are recorded as
+    well.
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end_of_data = len(data)
+
+            if data[:1] == b">":
+                start = 0
+            else:
+                start = data.find(b"\n>")
+                start = start + 1 if start != -1 else -1
+
+            while start != -1:
+                header_end = data.find(b"\n", start)
+                if header_end == -1:
+                    header_end = end_of_data
+
+                # the newline ending the sequence, which is the header's own newline for an empty sequence
+                seq_end = data.find(b"\n>", header_end)
+                if seq_end == -1:
+                    seq_end = end_of_data
+
+                header = data[start + 1:header_end].decode("utf-8", errors="replace").strip()
+                tax_match = PAT_TAX_ID.search(header)
+                if tax_match:
+                    seq_offset = seq_length = -1
+                    if sequences:
+                        seq_offset = min(header_end + 1, end_of_data)
+                        seq = data[seq_offset:max(seq_offset, seq_end)]
+                        seq_length = len(seq) - seq.count(b"\n") - seq.count(b"\r")
+
+                    yield FinalFaHeader(
+                        header, int(tax_match.group(1)), int(tax_match.group(2)), tuple(PAT_TAG.findall(header)),
+                        seq_offset, seq_length,
+                    )
+
+                start = seq_end + 1 if seq_end < end_of_data else -1
+
+
+def read_sequence(filename: str, header: FinalFaHeader) -> Optional[str]:
+    """The sequence following `header`, which must have been parsed with `sequences` enabled"""
+    if header.seq_offset < 0:
+        return None
+
+    with open(filename, "rb") as f:
+        f.seek(header.seq_offset)
+        bases = []
+        num_bases = 0
+        while num_bases < header.seq_length:
+            line = f.readline()
+            if not line or line.startswith(b">"):
+                break
+
+            line = line.rstrip(b"\r\n")
+            bases.append(line)
+            num_bases += len(line)
+
+    return b"".join(bases).decode("ascii", errors="replace")
@@ -0,0 +1,115 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Pattern, Union
+
+from util import get_logger
+
+# Number of files read concurrently by a LogScanner
+LOG_SCAN_THREADS = 4
+
+logger = get_logger(__name__)
+
+
+class LineExtractor(object):
+    """Receives every line of the file(s) it is registered for"""
+
+    def feed(self, line_no: int, line: str):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+
+class RegexExtractor(LineExtractor):
+    """Collects every match of a pattern, line by line"""
+
+    def __init__(self, pattern: Pattern):
+        self.pattern = pattern
+        self.matches = []
+
+    def feed(self, line_no: int, line: str):
+        self.matches.extend(self.pattern.finditer(line))
+
+
+class BufferExtractor(object):
+    """Receives the whole content of the file it is registered for, as a bytes-like object"""
+
+    def feed_buffer(self, data):
+        raise NotImplementedError
+
+
+class LogScanner(object):
+    """
+    Reads each registered file exactly once, handing every line to all of the line extractors registered for that file
+    and the mapped file to its buffer extractors
+
+    Files are read concurrently; the extractors of any one file are only ever fed from a single thread.
+    """
+
+    def __init__(self, threads: int = LOG_SCAN_THREADS):
+        self.threads = threads
+        self._extractors: Dict[str, List[Union[LineExtractor, BufferExtractor]]] = {}
+        self._required = set()
+
+    def register(self, filename: str, extractor: Union[LineExtractor, BufferExtractor], required: bool = False):
+        filename = os.path.abspath(filename)
+        self._extractors.setdefault(filename, []).append(extractor)
+        if required:
+            self._required.add(filename)
+
+        return extractor
+
+    def scan(self):
+        for filename in self._required:
+            if not os.path.exists(filename):
+                raise FileNotFoundError(filename)
+
+        if self.threads > 1 and len(self._extractors) > 1:
+            with ThreadPoolExecutor(min(self.threads, len(self._extractors))) as executor:
+                # consume the results so exceptions are re-raised here
+                list(executor.map(self._scan_file, self._extractors.keys()))
+        else:
+            for filename in self._extractors:
+                self._scan_file(filename)
+
+    def _scan_file(self, filename: str):
+        extractors = self._extractors[filename]
+        line_extractors = [extractor for extractor in extractors if isinstance(extractor, LineExtractor)]
+        buffer_extractors = [extractor for extractor in extractors if isinstance(extractor, BufferExtractor)]
+
+        try:
+            f = open(filename, "rb")
+        except FileNotFoundError:
+            logger.debug("Skipping missing log file %r", filename)
+            return
+
+        with f:
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for extractor in buffer_extractors:
+                        extractor.feed_buffer(data)
+
+                    if line_extractors:
+                        data.seek(0)
+                        for line_no, line in enumerate(iter(data.readline, b""), 1):
+                            line = line.decode("utf-8", errors="replace")
+                            for extractor in line_extractors:
+                                extractor.feed(line_no, line)
+
+        for extractor in line_extractors:
+            extractor.finish()
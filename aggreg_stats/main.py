@@ -16,12 +16,30 @@ import argparse
 import logging
 import os
 import sys
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+import pbs_log_index
+from archiver import ARCHIVE_INCLUDE, ARCHIVE_LINK_MODES, ArchivePolicy
 import tax_db
+from abundance_matrix import AbundanceMatrixOutput
 from aggreg_stats_workbook import AggregStatsWorkbook
-from sample_results import SampleResults
+from output_backends import AggregStatsOutput, ParquetOutput, SqliteOutput, TsvOutput, output_filename
+from sample_cache import SampleCache, open_sample_cache
+from sample_results import SampleResults, find_sample_dirs, read_final_fa_taxids
 from util import get_logger
+from watch import DEBOUNCE_MAX_FACTOR, DEFAULT_DEBOUNCE, DEFAULT_POLL_INTERVAL, SamplesDirWatcher
+
+# Minimum number of samples archived at once for --per-sample-output
+ARCHIVE_THREADS = 4
+
+OUTPUT_FORMATS = {
+    "xlsx": AggregStatsWorkbook,
+    "sqlite": SqliteOutput,
+    "tsv": TsvOutput,
+    "parquet": ParquetOutput,
+    "npz": AbundanceMatrixOutput,
+}
 
 logger = get_logger(__name__)
 
@@ -29,21 +47,77 @@ logger = get_logger(__name__)
 class AggregateStatsResults(object):
     def __init__(self):
         self.out_filename: str = None
+        self.formats: List[str] = ["xlsx"]
+        self.similarity = False
         self.samples: List[SampleResults] = []
+        # last completed stage of each run still in progress, by run name, when watching a samples directory
+        self.in_flight: Dict[str, Optional[str]] = {}
+        self.cache: Optional[SampleCache] = None
+        self.jobs: int = 1
+        self.archive_policy = ArchivePolicy()
+        # arguments to load the tax tree again in worker processes which don't inherit it
+        self.tax_tree_args: Tuple[Optional[str], Optional[Set[int]]] = (None, None)
 
     def add_sample_results(self, directory: str):
-        logger.info("Loading sample from %r", directory)
+        self.add_samples([directory])
 
-        try:
-            sample = SampleResults(directory)
+    def add_samples(self, directories: Iterable[str]) -> List[SampleResults]:
+        """Load and add each sample in `directories`, returns the samples added"""
+        added = self.load_samples(directories)
+        self.samples.extend(added)
+
+        return added
+
+    def load_samples(self, directories: Iterable[str]) -> List[SampleResults]:
+        """
+        Load each sample in `directories`, in `jobs` processes if more than one
+
+        Samples are returned in the order given, skipping (and logging) any which fail to load.
+        """
+        directories = list(directories)
+        loaded: List[Optional[SampleResults]] = [None for _ in directories]
+        pending: List[int] = []
+
+        for idx, directory in enumerate(directories):
+            logger.info("Loading sample from %r", directory)
 
-            # Force loading of sample.final.fa so we can skip this sample if there's an error (e.g. it's missing)
-            # noinspection PyStatementEffect
-            sample.final_output
+            try:
+                sample = SampleResults(directory)
 
-            self.samples.append(sample)
-        except Exception as e:
-            logger.exception("Failed to load sample %r", directory, exc_info=e)
+                if self.cache is not None and self.cache.load(sample):
+                    loaded[idx] = sample
+                elif self.jobs <= 1 or len(directories) == 1:
+                    # Force loading of sample.final.fa and the logs so we can skip this sample if there's an error
+                    # (e.g. it's missing)
+                    sample.load()
+                    loaded[idx] = self._loaded(sample)
+                else:
+                    loaded[idx] = sample
+                    pending.append(idx)
+            except Exception as e:
+                logger.exception("Failed to load sample %r", directory, exc_info=e)
+
+        if pending:
+            with ProcessPoolExecutor(
+                    max_workers=min(self.jobs, len(pending)), initializer=_init_worker, initargs=self.tax_tree_args
+            ) as executor:
+                futures = {executor.submit(_load_sample, loaded[idx]): idx for idx in pending}
+
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    try:
+                        loaded[idx] = self._loaded(future.result())
+                    except Exception as e:
+                        loaded[idx] = None
+                        logger.exception("Failed to load sample %r", directories[idx], exc_info=e)
+
+        return [sample for sample in loaded if sample is not None]
+
+    def _loaded(self, sample: SampleResults) -> SampleResults:
+        if self.cache is not None:
+            self.cache.store(sample)
+
+        return sample
 
     def execute(self):
         assert self.out_filename is not None
@@ -51,26 +125,118 @@ class AggregateStatsResults(object):
             logger.error("No samples!")
             return
 
-        aggreg_stats = AggregStatsWorkbook(self.out_filename)
-        aggreg_stats.process(self.samples)
+        for output in self.open_outputs():
+            output.process(self.samples)
+
+    def execute_streaming(self, directories: Iterable[str], per_sample_output: Optional[str] = None):
+        """
+        Load, write and release samples a few at a time, so memory use is bounded by the samples being loaded
+
+        Unlike `execute`, samples aren't kept in `samples`, and the per-sample output is saved as each one is written.
+        """
+        assert self.out_filename is not None
+
+        directories = list(directories)
+        outputs = self.open_outputs(streaming=True)
+        for output in outputs:
+            output.begin()
+
+        batch_size = max(1, self.jobs)
+        for start in range(0, len(directories), batch_size):
+            samples = self.load_samples(directories[start:start + batch_size])
+            for sample in samples:
+                for output in outputs:
+                    output.add_sample(sample)
+
+            if per_sample_output:
+                self.save_samples(per_sample_output, samples)
+
+            for sample in samples:
+                sample.release()
+
+        if not outputs[0].num_samples:
+            logger.error("No samples!")
+
+        for output in outputs:
+            output.finish()
+
+    def open_outputs(self, streaming: bool = False) -> List[AggregStatsOutput]:
+        """An output for each of `formats`, named after `out_filename`"""
+        outputs = []
+        for fmt in self.formats:
+            out_fn = output_filename(self.out_filename, fmt)
+            if fmt == "xlsx":
+                outputs.append(AggregStatsWorkbook(
+                    out_fn, streaming=streaming, similarity=self.similarity, in_flight=self.in_flight
+                ))
+            else:
+                outputs.append(OUTPUT_FORMATS[fmt](out_fn, streaming=streaming))
+
+        return outputs
+
+    def save_samples(self, dest_dir: str, samples: Iterable[SampleResults]):
+        """Save the per-sample output of each of `samples`, several samples at a time"""
+        samples = list(samples)
+        if not samples:
+            return
+
+        def save(sample: SampleResults):
+            try:
+                sample.save(os.path.join(dest_dir, sample.run_name), self.archive_policy)
+            except Exception as e:
+                logger.exception("Failed to save per-sample output for %r", sample.run_name, exc_info=e)
+
+        with ThreadPoolExecutor(max_workers=min(len(samples), max(self.jobs, ARCHIVE_THREADS))) as executor:
+            list(executor.map(save, samples))
 
     def add_sample_dir(self, samples_dir: str):
-        filenames = set(os.listdir(samples_dir))
+        self.add_samples(find_sample_dirs(samples_dir))
+
+
+def _init_worker(taxonomy: Optional[str], taxids: Optional[Set[int]]):
+    # forked workers already share the parent's (memory-mapped) tax tree
+    if tax_db.parents is None and taxonomy is not None:
+        tax_db.load_tax_tree(taxonomy, taxids)
 
-        for filename in filenames:
-            if filename.endswith(".log") and filename[:-4] in filenames:
-                self.add_sample_results(os.path.join(samples_dir, filename[:-4]))
+
+def _load_sample(sample: SampleResults) -> SampleResults:
+    sample.load()
+
+    return sample
 
 
 def main(args):
-    parser = argparse.ArgumentParser()
+    # every other argument is an option, so a leading "compare" can only be the subcommand
+    if args and args[0] == "compare":
+        import compare
+        return compare.main(args[1:])
+
+    parser = argparse.ArgumentParser(
+        description='Aggregate the results and timings of a batch of VirMap runs',
+        epilog='Run "main.py compare -h" for comparing the stage timings of two batches run on the same samples',
+    )
     exclusive = parser.add_mutually_exclusive_group(required=True)
     exclusive.add_argument('-d', '--samples-dir', type=str, help='Directory containing multiple sample outputs')
     exclusive.add_argument('-s', '--sample', nargs='+', type=str, help='Path to one or more sample output directories')
 
     parser.add_argument('-t', '--taxonomy', type=str, help='Directory containing taxonomy files (e.g. nodes.dmp)', required=True)
     parser.add_argument('-o', '--output', type=str, help='Filename for output worksheet', required=True)
+    parser.add_argument('-f', '--format', action='append', choices=tuple(OUTPUT_FORMATS), help='Output format, may be repeated to write several. Formats other than xlsx are named after the output filename, replacing its extension with .sqlite, _tsv, _parquet or .npz (default: xlsx)')
+    parser.add_argument('--similarity', action='store_true', help='Add the distances between samples, clusters of similar samples and taxids shared suspiciously across samples to the workbook')
     parser.add_argument('-p', '--per-sample-output', type=str, help='Directory to output brief logs and misc. info for each sample')
+    parser.add_argument('--archive-include', action='append', metavar='GLOB', help=f'Only copy files matching GLOB to the per-sample output, may be repeated (default: {" ".join(ARCHIVE_INCLUDE)})')
+    parser.add_argument('--archive-exclude', action='append', metavar='GLOB', default=[], help='Never copy files matching GLOB to the per-sample output, may be repeated')
+    parser.add_argument('--archive-link', choices=ARCHIVE_LINK_MODES, default='reflink', help='Clone (reflink) or hard link files into the per-sample output where possible instead of copying them (default: reflink)')
+    parser.add_argument('--archive-compress', action='store_true', help='Compress large files copied to the per-sample output with zstd (or gzip)')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of processes used to load samples and parse the taxonomy dump files (default: load samples one at a time, parse the dump files using every CPU)')
+    parser.add_argument('--no-cache', action='store_true', help='Parse every sample again without reading or updating the sample cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Discard the sample cache in the output folder and parse every sample again')
+    parser.add_argument('--full-taxonomy', action='store_true', help='Load the whole tax tree even when only a few samples are given with -s')
+    parser.add_argument('--streaming', action='store_true', help='Write the workbook a few samples at a time, keeping memory use bounded for very large batches. With --similarity, the taxids and sizes of every sample are still kept until the end')
+    parser.add_argument('--watch', action='store_true', help='Keep watching the samples directory, updating the output as runs complete')
+    parser.add_argument('--poll', action='store_true', help='With --watch, poll the samples directory instead of using inotify (e.g. on network filesystems)')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help=f'Seconds between polls of the samples directory (default: {DEFAULT_POLL_INTERVAL:g})')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE, help=f'With --watch, seconds without any change before updating the output, waiting at most {DEBOUNCE_MAX_FACTOR} times as long while changes continue (default: {DEFAULT_DEBOUNCE:g})')
     parser.add_argument('-v', '--verbose', action='store_const', const=True, help='Show DEBUG level log messages')
 
     parsed = parser.parse_args(args)
@@ -80,26 +246,95 @@ def main(args):
 
     logger.debug('Parsed args: %r', parsed)
 
+    if parsed.watch and not parsed.samples_dir:
+        parser.error("--watch requires -d/--samples-dir")
+    if parsed.watch and parsed.streaming:
+        parser.error("--watch keeps every sample in memory, so can't be used with --streaming")
+    if parsed.streaming and parsed.similarity:
+        logger.warning("--similarity keeps the taxids and sizes of every sample until the end, even with --streaming")
+
+    if parsed.format and "parquet" in parsed.format:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("--format parquet requires the pyarrow module")
+
     agg = AggregateStatsResults()
     agg.out_filename = os.path.abspath(parsed.output)
+    if parsed.format:
+        agg.formats = list(dict.fromkeys(parsed.format))
+    agg.similarity = parsed.similarity
 
     output_folder = os.path.dirname(agg.out_filename)
     if not os.path.exists(output_folder):
         raise ValueError(f"Destination folder {output_folder!r} doesn't exist!")
 
-    tax_db.load_tax_tree(parsed.taxonomy)
+    if parsed.sample and not parsed.full_taxonomy:
+        # only a handful of samples, so only load the lineages they reference
+        taxids = set()
+        for sample in parsed.sample:
+            try:
+                taxids.update(read_final_fa_taxids(sample))
+            except OSError as e:
+                logger.warning("Failed to read taxids from %r: %s", sample, e)
+
+        tax_db.load_tax_tree(parsed.taxonomy, taxids, jobs=parsed.jobs)
+        agg.tax_tree_args = (parsed.taxonomy, taxids)
+    else:
+        tax_db.load_tax_tree(parsed.taxonomy, jobs=parsed.jobs)
+        agg.tax_tree_args = (parsed.taxonomy, None)
+
+    if parsed.jobs:
+        agg.jobs = parsed.jobs
+
+    agg.archive_policy = ArchivePolicy(
+        parsed.archive_include or ARCHIVE_INCLUDE, parsed.archive_exclude, parsed.archive_link, parsed.archive_compress
+    )
+
+    if not parsed.no_cache:
+        agg.cache = open_sample_cache(output_folder, parsed.rebuild_cache)
+
+        pbs_log_index.index_filename = os.path.join(output_folder, pbs_log_index.PBS_LOG_INDEX_FILENAME)
+        if parsed.rebuild_cache and os.path.exists(pbs_log_index.index_filename):
+            os.remove(pbs_log_index.index_filename)
+
+    if parsed.watch:
+        watcher = SamplesDirWatcher(agg, parsed.samples_dir, parsed.per_sample_output)
+        try:
+            watcher.run(parsed.debounce, parsed.poll, parsed.poll_interval)
+        finally:
+            if agg.cache is not None:
+                agg.cache.log_stats()
+                agg.cache.close()
+
+        return
+
+    if parsed.streaming:
+        try:
+            agg.execute_streaming(
+                find_sample_dirs(parsed.samples_dir) if parsed.samples_dir else parsed.sample,
+                parsed.per_sample_output,
+            )
+        finally:
+            if agg.cache is not None:
+                agg.cache.log_stats()
+                agg.cache.close()
+
+        return
 
     if parsed.samples_dir:
         agg.add_sample_dir(parsed.samples_dir)
     else:
-        for sample in parsed.sample:
-            agg.add_sample_results(sample)
+        agg.add_samples(parsed.sample)
+
+    if agg.cache is not None:
+        agg.cache.log_stats()
+        agg.cache.close()
 
     agg.execute()
 
     if parsed.per_sample_output:
-        for sample in agg.samples:
-            sample.save(os.path.join(parsed.per_sample_output, sample.run_name))
+        agg.save_samples(parsed.per_sample_output, agg.samples)
 
 
 if __name__ == '__main__':
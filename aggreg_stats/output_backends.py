@@ -0,0 +1,339 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import os
+import shutil
+import sqlite3
+from typing import Iterable, List, Optional
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from constants import TIME_CATEGORIES, VIRMAP_TAX_FLAGS
+from error_scanner import ERROR_CLASSIFIER
+from sample_results import TAX_FLAG_BITS, SampleResults
+from tax_index import ROLLUP_RANKS, rollup_sample
+from util import get_logger
+
+SUMMARY_COLUMNS = (
+    "Benign errors",
+    "Unexpected errors",
+    "Killed count",
+    "Output seqs",
+    "Unique taxids",
+    "Generic virus outputs",
+    *sorted(VIRMAP_TAX_FLAGS),
+    "Die errors",
+    "Warnings",
+    "Threads",
+)
+# File (or directory) extension of each output format other than the workbook, replacing that of the output filename
+OUTPUT_EXTENSIONS = {"sqlite": ".sqlite", "tsv": "_tsv", "parquet": "_parquet", "npz": ".npz"}
+GENERIC_VIRUS_TAX_ID = 10239
+
+logger = get_logger(__name__)
+
+
+def sample_summary(sample: SampleResults) -> List[int]:
+    """A sample's row of the summary, in the order of SUMMARY_COLUMNS"""
+    categories, _ = ERROR_CLASSIFIER.count(sample.error_hits)
+
+    tax_data = sample.final_output
+    flag_counts = tax_data.flag_counts()
+
+    return [
+        categories["benign"],
+        sum(categories.values()) - categories["benign"],
+        categories["killed"],
+        len(tax_data),
+        len(tax_data.lineages),
+        tax_data.tax_ids.count(GENERIC_VIRUS_TAX_ID),
+        *(flag_counts[flag] for flag in sorted(VIRMAP_TAX_FLAGS)),
+        categories["die"],
+        categories["warning"],
+        sample.threads,
+    ]
+
+
+def column_name(header: str) -> str:
+    """Column name used in the database and columnar outputs for a workbook header"""
+    return header.replace(" ", "_").lower()
+
+
+def output_filename(out_fn: str, fmt: str) -> str:
+    if fmt == "xlsx":
+        return out_fn
+
+    return os.path.splitext(out_fn)[0] + OUTPUT_EXTENSIONS[fmt]
+
+
+def publish(tmp_fn: str, out_fn: str):
+    """Replace `out_fn` (a file or directory) with `tmp_fn`, so readers never see a partial output"""
+    if os.path.isdir(tmp_fn) and os.path.isdir(out_fn):
+        old_fn = f"{out_fn}.old"
+        shutil.rmtree(old_fn, ignore_errors=True)
+        os.replace(out_fn, old_fn)
+        os.replace(tmp_fn, out_fn)
+        shutil.rmtree(old_fn)
+    else:
+        os.replace(tmp_fn, out_fn)
+
+    logger.info("Wrote %r", out_fn)
+
+
+def _remove(fn: str):
+    if os.path.isdir(fn):
+        shutil.rmtree(fn)
+    elif os.path.lexists(fn):
+        os.remove(fn)
+
+
+class AggregStatsOutput(object):
+    """
+    Base of the aggregated statistics outputs
+
+    Outputs are written with `begin`, `add_sample` for each sample, then `finish` (or all at once with `process`). They
+    are written to a temporary file or directory, which replaces `out_fn` once complete.
+    """
+
+    def __init__(self, out_fn: str):
+        self.out_fn = out_fn
+        self.tmp_fn = f"{out_fn}.tmp"
+        self.num_samples = 0
+
+    def begin(self):
+        pass
+
+    def add_sample(self, sample: SampleResults):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def process(self, samples: Iterable[SampleResults]):
+        self.begin()
+        for sample in samples:
+            self.add_sample(sample)
+        self.finish()
+
+    @staticmethod
+    def timing_rows(sample: SampleResults):
+        """(stage, walltime, CPU time, CPU ratio) for each stage the sample logged a time for"""
+        for stage, walltime, cputime, cpuratio in zip(TIME_CATEGORIES, *sample.simple_timing_info):
+            if walltime is not None or cputime is not None or cpuratio is not None:
+                yield stage, walltime, cputime, cpuratio
+
+    @staticmethod
+    def rollup_rows(sample: SampleResults):
+        """(rank, tax id, size) for each taxon the sample's output rolls up to"""
+        for rank, totals in rollup_sample(sample, ROLLUP_RANKS).items():
+            for tax_id, size in sorted(totals.items()):
+                yield rank, tax_id, size
+
+
+class SqliteOutput(AggregStatsOutput):
+    """
+    The aggregated statistics as an indexed SQLite database
+
+    Each sample's taxonomy entries go into a single `taxa` table indexed by tax id and size, so queries across the whole
+    batch (e.g. every sample with a given tax id above some size) don't need to read every sample.
+    """
+
+    def __init__(self, out_fn: str, streaming: bool = False):
+        super().__init__(out_fn)
+        self.db: Optional[sqlite3.Connection] = None
+        self._lineages = set()
+
+    def begin(self):
+        logger.info("Building SQLite database")
+        _remove(self.tmp_fn)
+
+        self.db = sqlite3.connect(self.tmp_fn)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+
+        summary_columns = ", ".join(f'"{column_name(header)}" INTEGER' for header in SUMMARY_COLUMNS)
+        flag_columns = ", ".join(f'"{column_name(flag)}" INTEGER' for flag in sorted(VIRMAP_TAX_FLAGS))
+        self.db.executescript(f"""
+            CREATE TABLE summary (sample TEXT PRIMARY KEY, {summary_columns});
+            CREATE TABLE timings (sample TEXT, stage TEXT, walltime REAL, cputime REAL, cpuratio REAL);
+            CREATE TABLE rollups (sample TEXT, rank TEXT, tax_id INTEGER, size INTEGER);
+            CREATE TABLE taxa (sample TEXT, tax_id INTEGER, size INTEGER, {flag_columns});
+            CREATE TABLE lineages (tax_id INTEGER PRIMARY KEY, lineage TEXT);
+        """)
+
+    def add_sample(self, sample: SampleResults):
+        self.num_samples += 1
+        name = sample.run_name
+        tax_data = sample.final_output
+        flag_bits = [TAX_FLAG_BITS[flag] for flag in sorted(VIRMAP_TAX_FLAGS)]
+
+        with self.db:
+            summary = sample_summary(sample)
+            self.db.execute(f"INSERT INTO summary VALUES (?{', ?' * len(summary)})", [name, *summary])
+            self.db.executemany(
+                "INSERT INTO timings VALUES (?, ?, ?, ?, ?)", ((name, *row) for row in self.timing_rows(sample))
+            )
+            self.db.executemany(
+                "INSERT INTO rollups VALUES (?, ?, ?, ?)", ((name, *row) for row in self.rollup_rows(sample))
+            )
+            self.db.executemany(
+                f"INSERT INTO taxa VALUES (?, ?, ?{', ?' * len(flag_bits)})",
+                (
+                    (name, tax_id, size, *(1 if flag_mask & bit else 0 for bit in flag_bits))
+                    for tax_id, size, flag_mask in zip(tax_data.tax_ids, tax_data.sizes, tax_data.flag_masks)
+                ),
+            )
+
+            new_lineages = [
+                (tax_id, " > ".join(lineage))
+                for tax_id, lineage in tax_data.lineages.items() if tax_id not in self._lineages
+            ]
+            self.db.executemany("INSERT INTO lineages VALUES (?, ?)", new_lineages)
+            self._lineages.update(tax_id for tax_id, _ in new_lineages)
+
+    def finish(self):
+        logger.info("Indexing SQLite database")
+        with self.db:
+            self.db.executescript("""
+                CREATE INDEX taxa_tax_id ON taxa (tax_id, size);
+                CREATE INDEX taxa_sample ON taxa (sample);
+                CREATE INDEX timings_sample ON timings (sample, stage);
+                CREATE INDEX rollups_tax_id ON rollups (rank, tax_id, size);
+                CREATE INDEX rollups_sample ON rollups (sample, rank);
+            """)
+        self.db.close()
+
+        publish(self.tmp_fn, self.out_fn)
+
+
+class TsvOutput(AggregStatsOutput):
+    """The aggregated statistics as a directory of tab separated files, one per table"""
+
+    def __init__(self, out_fn: str, streaming: bool = False):
+        super().__init__(out_fn)
+        self._files = {}
+        self._writers = {}
+        self._summary = {}
+
+    def _writer(self, table: str, header: List[str]):
+        writer = self._writers.get(table)
+        if writer is None:
+            f = self._files[table] = open(os.path.join(self.tmp_fn, f"{table}.tsv"), "w", newline="")
+            writer = self._writers[table] = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(header)
+
+        return writer
+
+    def begin(self):
+        logger.info("Writing TSV files")
+        _remove(self.tmp_fn)
+        os.makedirs(self.tmp_fn)
+
+        self._writer("timings", ["sample", "stage", "walltime", "cputime", "cpuratio"])
+        self._writer("rollups", ["sample", "rank", "tax_id", "size"])
+        self._writer("taxa", ["sample", "tax_id", "size", *map(column_name, sorted(VIRMAP_TAX_FLAGS)), "lineage"])
+
+    def add_sample(self, sample: SampleResults):
+        self.num_samples += 1
+        name = sample.run_name
+        tax_data = sample.final_output
+        flag_bits = [TAX_FLAG_BITS[flag] for flag in sorted(VIRMAP_TAX_FLAGS)]
+
+        self._summary[name] = sample_summary(sample)
+        self._writers["timings"].writerows(
+            (name, stage, *("" if value is None else value for value in values))
+            for stage, *values in self.timing_rows(sample)
+        )
+        self._writers["rollups"].writerows((name, *row) for row in self.rollup_rows(sample))
+        self._writers["taxa"].writerows(
+            (
+                name, tax_id, size, *(1 if flag_mask & bit else 0 for bit in flag_bits),
+                " > ".join(tax_data.lineages[tax_id]),
+            )
+            for tax_id, size, flag_mask in zip(tax_data.tax_ids, tax_data.sizes, tax_data.flag_masks)
+        )
+
+    def finish(self):
+        writer = self._writer("summary", ["sample", *map(column_name, SUMMARY_COLUMNS)])
+        writer.writerows([name, *self._summary[name]] for name in sorted(self._summary))
+
+        for f in self._files.values():
+            f.close()
+
+        publish(self.tmp_fn, self.out_fn)
+
+
+class ParquetOutput(AggregStatsOutput):
+    """
+    The aggregated statistics as a directory of Parquet files
+
+    The taxonomy entries are partitioned by sample (`taxa/sample=<run name>/`), the layout pyarrow and most query engines
+    read as a single dataset. Requires the pyarrow module.
+    """
+
+    def __init__(self, out_fn: str, streaming: bool = False):
+        if pyarrow is None:
+            raise ImportError("Writing Parquet files requires the pyarrow module")
+
+        super().__init__(out_fn)
+        self._summary = {}
+        self._timings = []
+        self._rollups = []
+
+    def begin(self):
+        logger.info("Writing Parquet files")
+        _remove(self.tmp_fn)
+        os.makedirs(os.path.join(self.tmp_fn, "taxa"))
+
+    def add_sample(self, sample: SampleResults):
+        self.num_samples += 1
+        name = sample.run_name
+        tax_data = sample.final_output
+
+        self._summary[name] = sample_summary(sample)
+        self._timings.extend((name, *row) for row in self.timing_rows(sample))
+        self._rollups.extend((name, *row) for row in self.rollup_rows(sample))
+
+        columns = {
+            "tax_id": pyarrow.array(tax_data.tax_ids, pyarrow.uint32()),
+            "size": pyarrow.array(tax_data.sizes, pyarrow.uint64()),
+        }
+        for flag in sorted(VIRMAP_TAX_FLAGS):
+            bit = TAX_FLAG_BITS[flag]
+            columns[column_name(flag)] = pyarrow.array([bool(flag_mask & bit) for flag_mask in tax_data.flag_masks])
+        columns["lineage"] = pyarrow.array([" > ".join(tax_data.lineages[tax_id]) for tax_id in tax_data.tax_ids])
+
+        partition_dir = os.path.join(self.tmp_fn, "taxa", f"sample={name}")
+        os.makedirs(partition_dir, exist_ok=True)
+        pyarrow.parquet.write_table(pyarrow.table(columns), os.path.join(partition_dir, "part-0.parquet"))
+
+    def _write_rows(self, table: str, header: List[str], rows: List):
+        columns = {column: list(values) for column, values in zip(header, zip(*rows))} if rows else {column: [] for column in header}
+        pyarrow.parquet.write_table(pyarrow.table(columns), os.path.join(self.tmp_fn, f"{table}.parquet"))
+
+    def finish(self):
+        self._write_rows(
+            "summary",
+            ["sample", *map(column_name, SUMMARY_COLUMNS)],
+            [[name, *self._summary[name]] for name in sorted(self._summary)],
+        )
+        self._write_rows("timings", ["sample", "stage", "walltime", "cputime", "cpuratio"], self._timings)
+        self._write_rows("rollups", ["sample", "rank", "tax_id", "size"], self._rollups)
+
+        publish(self.tmp_fn, self.out_fn)
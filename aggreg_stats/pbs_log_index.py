@@ -0,0 +1,135 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import os
+import re
+import time
+from typing import Dict, Optional
+
+from util import get_logger
+
+PAT_PBS_LOGFILE = re.compile(r"^.*\.o\d+$")
+PAT_VIRMAP_ARGS_OUTPUT = re.compile(r"Virmap called with: .*--outputDir ([^\s]+)")
+
+PBS_LOG_INDEX_FILENAME = "aggreg_stats_pbs_logs.json"
+# Number of bytes at the start of each PBS log searched for the VirMap arguments
+PBS_LOG_HEAD_SIZE = 8192
+
+logger = get_logger(__name__)
+
+# Where indexes are saved between runs, or None to only keep them in memory
+index_filename: Optional[str] = None
+
+_indexes: Dict[str, "PbsLogIndex"] = {}
+
+
+class PbsLogIndex(object):
+    """Run name to PBS log filename, for every PBS log in a directory"""
+
+    def __init__(self, directory: str, mtime_ns: int, logs: Dict[str, str]):
+        self.directory = directory
+        self.mtime_ns = mtime_ns
+        self.logs = logs
+
+    @classmethod
+    def build(cls, directory: str) -> "PbsLogIndex":
+        logger.info("Indexing PBS logs in %r", directory)
+        start_time = time.time()
+
+        mtime_ns = os.stat(directory).st_mtime_ns
+
+        logs = {}
+        log_mtimes = {}
+        for entry in os.scandir(directory):
+            if not PAT_PBS_LOGFILE.match(entry.name) or not entry.is_file():
+                continue
+
+            try:
+                with open(entry.path, "r", errors="replace") as f:
+                    log_data = f.read(PBS_LOG_HEAD_SIZE)
+                log_mtime = entry.stat().st_mtime_ns
+            except OSError as e:
+                logger.warning("Failed to read PBS log %r: %s", entry.path, e)
+                continue
+
+            log_output = PAT_VIRMAP_ARGS_OUTPUT.search(log_data)
+            if not log_output:
+                continue
+
+            # prefer the most recent log when a run was resubmitted
+            run_name = os.path.basename(log_output.group(1).rstrip("/"))
+            if run_name not in logs or log_mtimes[run_name] < log_mtime:
+                logs[run_name] = os.path.abspath(entry.path)
+                log_mtimes[run_name] = log_mtime
+
+        logger.info(f"Indexed {len(logs)} PBS logs in {time.time() - start_time:.2f}s")
+
+        return cls(directory, mtime_ns, logs)
+
+    def get(self, run_name: str) -> Optional[str]:
+        return self.logs.get(run_name)
+
+
+def _read_saved_indexes() -> Dict[str, dict]:
+    if index_filename is None or not os.path.exists(index_filename):
+        return {}
+
+    try:
+        with open(index_filename, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable PBS log index %r: %s", index_filename, e)
+        return {}
+
+
+def _save_index(index: PbsLogIndex):
+    if index_filename is None:
+        return
+
+    saved = _read_saved_indexes()
+    saved[index.directory] = {"mtime_ns": index.mtime_ns, "logs": index.logs}
+
+    tmp_fn = f"{index_filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_fn, "w") as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+        os.replace(tmp_fn, index_filename)
+    except OSError as e:
+        logger.warning("Failed to save PBS log index %r: %s", index_filename, e)
+
+
+def get_pbs_log_index(directory: str) -> PbsLogIndex:
+    """
+    Index of the PBS logs in `directory`, shared by every sample in it
+
+    Indexes are kept in memory and in `index_filename`, and rebuilt once the modification time of the directory changes.
+    """
+    directory = os.path.abspath(directory)
+    mtime_ns = os.stat(directory).st_mtime_ns
+
+    index = _indexes.get(directory)
+    if index is not None and index.mtime_ns == mtime_ns:
+        return index
+
+    saved = _read_saved_indexes().get(directory)
+    if saved is not None and saved.get("mtime_ns") == mtime_ns:
+        index = PbsLogIndex(directory, mtime_ns, saved["logs"])
+    else:
+        index = PbsLogIndex.build(directory)
+        _save_index(index)
+
+    _indexes[directory] = index
+
+    return index
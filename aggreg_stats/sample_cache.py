@@ -0,0 +1,129 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import os
+import pickle
+import sqlite3
+from typing import Any, Dict, Optional
+
+from sample_results import SampleResults
+from util import get_logger
+
+SAMPLE_CACHE_FILENAME = "aggreg_stats_cache.sqlite"
+# Bump whenever what is parsed out of a sample changes, so existing caches are discarded
+SAMPLE_CACHE_VERSION = 4
+
+# Parsed results stored, final_output is pickled without lineages and resolves them again on load
+_CACHED_PROPERTIES = ("simple_timing_info", "detailed_timing_info", "iteration_cycles", "error_hits", "final_output")
+
+logger = get_logger(__name__)
+
+
+def sample_fingerprint(sample: SampleResults) -> str:
+    """Digest of the path, size and mtime of every file parsed for a sample"""
+    digest = hashlib.sha256(str(SAMPLE_CACHE_VERSION).encode())
+    for fn in [sample.final_fa_filename, sample.virmap_log_filename] + sample.log_filenames:
+        try:
+            st = os.stat(fn)
+            digest.update(f"\0{fn} {st.st_size} {st.st_mtime_ns}".encode())
+        except FileNotFoundError:
+            digest.update(f"\0{fn} missing".encode())
+
+    return digest.hexdigest()
+
+
+class SampleCache(object):
+    """
+    Parsed sample results kept in an SQLite database between runs
+
+    Each sample is keyed on its directory, and only reused while none of the files parsed for it have changed.
+    """
+
+    def __init__(self, filename: str, rebuild: bool = False):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        # fingerprints taken before parsing, so files changing mid-parse are picked up next time
+        self._fingerprints: Dict[str, str] = {}
+
+        self._db = sqlite3.connect(filename)
+
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if rebuild or version != SAMPLE_CACHE_VERSION:
+            if version not in (0, SAMPLE_CACHE_VERSION):
+                logger.info("Discarding sample cache %r from version %d", filename, version)
+            self._db.execute("DROP TABLE IF EXISTS samples")
+            self._db.execute(f"PRAGMA user_version = {SAMPLE_CACHE_VERSION}")
+
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS samples (base_dir TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, data BLOB NOT NULL)"
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def load(self, sample: SampleResults) -> bool:
+        """Fill in the parsed results of `sample` from the cache, returns False if it isn't cached or has changed"""
+        row = self._db.execute(
+            "SELECT fingerprint, data FROM samples WHERE base_dir = ?", (sample.base_dir,)
+        ).fetchone()
+
+        fingerprint = sample_fingerprint(sample)
+        if row is None or row[0] != fingerprint:
+            self._fingerprints[sample.base_dir] = fingerprint
+            self.misses += 1
+            return False
+
+        try:
+            data: Dict[str, Any] = pickle.loads(row[1])
+        except Exception as e:
+            logger.warning("Ignoring unreadable cache entry for %r: %s", sample.run_name, e)
+            self._fingerprints[sample.base_dir] = fingerprint
+            self.misses += 1
+            return False
+
+        # populate the cached properties directly
+        sample.__dict__.update(data)
+
+        self.hits += 1
+        logger.debug("Loaded %r from the sample cache", sample.run_name)
+
+        return True
+
+    def store(self, sample: SampleResults):
+        """Save the parsed results of `sample`, parsing anything not yet parsed"""
+        fingerprint = self._fingerprints.pop(sample.base_dir, None) or sample_fingerprint(sample)
+
+        data = {name: getattr(sample, name) for name in _CACHED_PROPERTIES}
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO samples (base_dir, fingerprint, data) VALUES (?, ?, ?)",
+            (sample.base_dir, fingerprint, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        )
+        self._db.commit()
+
+    def log_stats(self):
+        logger.info("Sample cache %r: %d hits, %d misses", self.filename, self.hits, self.misses)
+
+
+def open_sample_cache(output_folder: str, rebuild: bool = False) -> Optional[SampleCache]:
+    """The sample cache in `output_folder`, or None if it can't be opened"""
+    filename = os.path.join(output_folder, SAMPLE_CACHE_FILENAME)
+    try:
+        return SampleCache(filename, rebuild)
+    except sqlite3.Error as e:
+        logger.warning("Not caching samples, failed to open %r: %s", filename, e)
+        return None
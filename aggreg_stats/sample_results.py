@@ -13,26 +13,28 @@
 #  limitations under the License.
 import itertools
 import os
-import re
-import shutil
 import subprocess
-from distutils.dir_util import copy_tree
+from array import array
+from collections import Counter
+from collections.abc import Sequence
 
 try:
     from functools import cached_property
 except ImportError:
     # TODO FIXME
     cached_property = property
-from typing import List, Optional, Set, Tuple
-
-from analyse_times import Node, build_timing_tree, dump_timing_tree
-from constants import PERL_DIE_MSGS, PERL_WARNINGS, PAT_TAX_ID, PAT_TAG, PAT_TIME, TIME_CATEGORIES
-from tax_db import resolve_taxid
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from analyse_times import IterationCycle, Node, TimingTreeExtractors, build_timing_tree, dump_timing_tree
+from archiver import ArchivePolicy, archive_file, archive_tree
+from constants import PAT_PBS_THREADS, PAT_RUN_THREADS, PAT_TIME, TIME_CATEGORIES, VIRMAP_TAX_FLAGS
+from error_scanner import ErrorExtractor, ErrorHit
+from final_fa import FinalFaHeader, iter_final_fa_headers
+from log_scanner import LogScanner, RegexExtractor
+from pbs_log_index import get_pbs_log_index
+from tax_db import resolve_lineages
 from util import get_logger
 
-PAT_PBS_LOGFILE = re.compile(r"^.*\.o\d+$")
-PAT_VIRMAP_ARGS_OUTPUT = re.compile(r"Virmap called with: .*--outputDir ([^\s]+)")
-
 logger = get_logger(__name__)
 
 
@@ -44,17 +46,153 @@ def find_name(folder):
     return None
 
 
+def find_sample_dirs(samples_dir: str) -> List[str]:
+    """Run directories in `samples_dir` (those with a virmap_wrapper.sh log alongside them), in order"""
+    filenames = set(os.listdir(samples_dir))
+
+    return [
+        os.path.join(samples_dir, filename[:-4])
+        for filename in sorted(filenames)
+        if filename.endswith(".log") and filename[:-4] in filenames
+    ]
+
+
+def read_final_fa_taxids(folder: str) -> Set[int]:
+    """Collect the taxids referenced by the headers of a sample's final.fa, without resolving them"""
+    name = find_name(folder)
+    if name is None:
+        return set()
+
+    return {header.tax_id for header in iter_final_fa_headers(os.path.join(folder, f"{name}.final.fa"))}
+
+
+# Bit of each VirMap tax flag in SampleOutput.flag_masks
+TAX_FLAG_BITS = {flag: 1 << idx for idx, flag in enumerate(sorted(VIRMAP_TAX_FLAGS))}
+
+
+def flags_to_mask(flags: Iterable[str]) -> int:
+    """Bitmask of the VirMap tax flags in `flags`, anything else is dropped"""
+    mask = 0
+    for flag in flags:
+        mask |= TAX_FLAG_BITS.get(flag, 0)
+
+    return mask
+
+
+def mask_to_flags(mask: int) -> Set[str]:
+    return {flag for flag, bit in TAX_FLAG_BITS.items() if mask & bit}
+
+
 class VirmapOutputEntry(object):
-    def __init__(self, line: str, tax_match):
-        self.flags: Set[str] = set(PAT_TAG.findall(line))
-        self.tax_id: int = int(tax_match.group(1))
-        self.tax_size: int = int(tax_match.group(2))
-        self.taxonomy: List[str] = resolve_taxid(self.tax_id).split(' > ')
+    """View of a single entry of a SampleOutput"""
+    __slots__ = ("_output", "_idx")
+
+    def __init__(self, output: "SampleOutput", idx: int):
+        self._output = output
+        self._idx = idx
+
+    @property
+    def tax_id(self) -> int:
+        return self._output.tax_ids[self._idx]
+
+    @property
+    def tax_size(self) -> int:
+        return self._output.sizes[self._idx]
+
+    @property
+    def flag_mask(self) -> int:
+        return self._output.flag_masks[self._idx]
+
+    @property
+    def flags(self) -> Set[str]:
+        return mask_to_flags(self.flag_mask)
+
+    @property
+    def taxonomy(self) -> Tuple[str, ...]:
+        return self._output.lineages[self.tax_id]
 
     def __repr__(self) -> str:
         return f'VirmapOutputEntry(tax_id={self.tax_id}, tax_size={self.tax_size}, flags={self.flags}, taxonomy={self.taxonomy})'
 
 
+class SampleOutput(Sequence):
+    """
+    The tagged entries of a sample's final.fa, stored column by column
+
+    Tax ids and sizes are typed arrays, flags a bitmask per entry (see TAX_FLAG_BITS), and lineages are shared by every
+    entry with the same tax id. Indexing gives a VirmapOutputEntry view.
+    """
+
+    def __init__(self, tax_ids: array, sizes: array, flag_masks: array):
+        self.tax_ids = tax_ids
+        self.sizes = sizes
+        self.flag_masks = flag_masks
+
+        unique_tax_ids = sorted(set(tax_ids))
+        self.lineages: Dict[int, Tuple[str, ...]] = dict(zip(unique_tax_ids, resolve_lineages(unique_tax_ids)))
+
+    @classmethod
+    def from_headers(cls, headers: Iterable[FinalFaHeader]) -> "SampleOutput":
+        tax_ids = array("I")
+        sizes = array("Q")
+        flag_masks = array("H")
+        for header in headers:
+            tax_ids.append(header.tax_id)
+            sizes.append(header.tax_size)
+            flag_masks.append(flags_to_mask(header.flags))
+
+        return cls(tax_ids, sizes, flag_masks)
+
+    def __getstate__(self):
+        # lineages are resolved again when unpickled, in case the tax tree has changed
+        return self.tax_ids, self.sizes, self.flag_masks
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self) -> int:
+        return len(self.tax_ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [VirmapOutputEntry(self, i) for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+
+        return VirmapOutputEntry(self, idx)
+
+    def flag_counts(self) -> Counter:
+        """Number of entries with each of the VirMap tax flags"""
+        mask_counts = Counter(self.flag_masks)
+
+        return Counter({
+            flag: sum(count for mask, count in mask_counts.items() if mask & bit)
+            for flag, bit in TAX_FLAG_BITS.items()
+        })
+
+
+class SampleLogScan(object):
+    """Results of reading each of a sample's log and err files once"""
+
+    def __init__(self, sample: "SampleResults"):
+        scanner = LogScanner()
+
+        self.time = scanner.register(sample.virmap_log_filename, RegexExtractor(PAT_TIME), required=True)
+        self.timing_tree = TimingTreeExtractors(scanner, sample)
+
+        # strip the directory containing the sample from the displayed filenames
+        display_prefix = os.path.dirname(sample.base_dir) + "/"
+        self.errors = [
+            scanner.register(fn, ErrorExtractor(fn.replace(display_prefix, "")))
+            for fn in sample.log_filenames
+        ]
+
+        scanner.scan()
+
+
 class SampleResults(object):
     def __init__(self, base_dir: str):
         assert base_dir is not None
@@ -81,16 +219,43 @@ class SampleResults(object):
         logger.debug(f'  self.final_fa_filename={self.final_fa_filename}')
 
         logger.debug(f'  self.pbs_log_filename={self.pbs_log_filename}')
-        logger.debug(f'  self.simple_timing_info={self.simple_timing_info}')
 
-    def save(self, dest_dir: str):
+    def __getstate__(self):
+        # the raw scan holds regex matches, which can't be pickled
+        state = self.__dict__.copy()
+        state.pop("log_scan", None)
+
+        return state
+
+    def load(self):
+        """Parse everything up front, e.g. before handing the sample back from another process"""
+        # noinspection PyStatementEffect
+        self.final_output
+        # noinspection PyStatementEffect
+        self.simple_timing_info
+        # noinspection PyStatementEffect
+        self.detailed_timing_info
+        # noinspection PyStatementEffect
+        self.iteration_cycles
+        # noinspection PyStatementEffect
+        self.error_hits
+
+    def release(self):
+        """Drop the parsed logs and output, which are parsed again if needed"""
+        for name in (
+                "log_scan", "final_output", "error_hits", "warnings_and_errors", "detailed_timing_info",
+                "iteration_cycles",
+        ):
+            self.__dict__.pop(name, None)
+
+    def save(self, dest_dir: str, policy: Optional[ArchivePolicy] = None):
         logger.info("Saving extra info for %r", self.run_name)
 
         os.makedirs(dest_dir, exist_ok=True)
 
         # self.graph_cmd_io(self.pbs_log_fn)
 
-        self._copy_log_files(dest_dir)
+        self._copy_log_files(dest_dir, policy if policy is not None else ArchivePolicy())
 
         dump_timing_tree(dest_dir, self)
 
@@ -110,28 +275,28 @@ class SampleResults(object):
         if os.path.exists(wrapper_log_fn):
             return os.path.abspath(wrapper_log_fn)
 
-        # fallback to searching the parent directory for files that look like pbs log filenames
-        for fn in os.listdir(parent_dir):
-            fn = os.path.join(parent_dir, fn)
-            if not os.path.isfile(fn) or not PAT_PBS_LOGFILE.match(fn):
-                continue
-
-            # read the first 8KiB of the potential log file
-            with open(fn, "r") as f:
-                log_data = f.read(8192)
+        # fallback to the pbs log files in the parent directory which reference this run
+        pbs_log_fn = get_pbs_log_index(parent_dir).get(self.run_name)
+        if pbs_log_fn is not None:
+            return pbs_log_fn
 
-            log_output = PAT_VIRMAP_ARGS_OUTPUT.search(log_data)
-            if not log_output:
-                continue
+        logger.warning(f"Failed to find pbs log filename or virmap_wrapper.sh log file for {self.base_dir!r}")
 
-            # ensure this log file references this run
-            if os.path.basename(log_output.group(1)) == self.run_name:
-                # TODO
-                # shutil.copy(fn, self.out_dir)
+    @cached_property
+    def threads(self) -> Optional[int]:
+        """Threads the run was given, from the run name virmap_wrapper.sh chose or failing that the PBS log"""
+        match = PAT_RUN_THREADS.search(self.run_name)
+        if match:
+            return int(match.group(1))
 
-                return fn
+        if self.pbs_log_filename:
+            with open(self.pbs_log_filename, "r", errors="replace") as f:
+                for line in f:
+                    match = PAT_PBS_THREADS.search(line)
+                    if match:
+                        return int(match.group(1) or match.group(2))
 
-        logger.warning(f"Failed to find pbs log filename or virmap_wrapper.sh log file for {self.base_dir!r}")
+        logger.warning(f"Failed to find the thread count of {self.base_dir!r}")
 
     @property
     def virmap_log_filename(self) -> str:
@@ -142,24 +307,12 @@ class SampleResults(object):
         return build_timing_tree(self)
 
     @cached_property
-    def simple_timing_info(self) -> Tuple[List[Optional[float]], List[Optional[float]], List[Optional[float]]]:
-        # Extract times
-        walltimes = [None for _ in TIME_CATEGORIES]
-        cputimes = [None for _ in TIME_CATEGORIES]
-        cpuratios = [None for _ in TIME_CATEGORIES]
-
-        with open(self.virmap_log_filename, "r") as f:
-            for match in PAT_TIME.finditer(f.read()):
-                index = TIME_CATEGORIES.index(match.group(1))
-
-                walltimes[index] = float(match.group(2)) if match.group(2) else None
-                cputimes[index] = float(match.group(3)) if match.group(3) else None
-                cpuratios[index] = float(match.group(4)) if match.group(4) else None
-
-        return walltimes, cputimes, cpuratios
+    def iteration_cycles(self) -> List[IterationCycle]:
+        return self.log_scan.timing_tree.iterate_improve.cycles
 
     @cached_property
-    def warnings_and_errors(self) -> List[str]:
+    def log_filenames(self) -> List[str]:
+        """The PBS log, followed by every log, err and txt file in the output and tmp directories"""
         target_files = [self.pbs_log_filename] if self.pbs_log_filename else []
         for dirpath, dirnames, filenames in itertools.chain(
                 os.walk(self.target), os.walk(self.target_tmp)
@@ -170,66 +323,56 @@ class SampleResults(object):
                 if fn.rsplit(".", 1)[-1] in {"err", "txt", "log"}:
                     target_files.append(fn)
 
-        # # Dump the same results with matches highlighted to the terminal
-        # subprocess.check_call([
-        #     "grep",
-        #     "--color",
-        #     "-nF",
-        #     "\n".join(PERL_DIE_MSGS.union(PERL_WARNINGS)),
-        #     *target_files,
-        # ])
-
-        try:    
-            stdout = subprocess.check_output([
-                "grep",
-                "-nF",
-                "\n".join(PERL_DIE_MSGS.union(PERL_WARNINGS)),
-                *target_files,
-            ])
-        except subprocess.CalledProcessError as e:
-            if e.returncode != 1:
-                raise 
-            stdout = e.output
-
-        return (stdout
-                .replace(os.path.dirname(self.base_dir).encode() + b"/", b"")
-                .strip()
-                .decode('utf-8')
-                .split('\n'))
+        return target_files
+
+    @cached_property
+    def log_scan(self) -> SampleLogScan:
+        return SampleLogScan(self)
 
     @cached_property
-    def final_output(self) -> List[VirmapOutputEntry]:
-        results = []
+    def simple_timing_info(self) -> Tuple[List[Optional[float]], List[Optional[float]], List[Optional[float]]]:
+        # Extract times
+        walltimes = [None for _ in TIME_CATEGORIES]
+        cputimes = [None for _ in TIME_CATEGORIES]
+        cpuratios = [None for _ in TIME_CATEGORIES]
 
-        with open(self.final_fa_filename, "r") as f:
-            for line in f:
-                line = line.strip()
+        for match in self.log_scan.time.matches:
+            index = TIME_CATEGORIES.index(match.group(1))
 
-                tax_match = PAT_TAX_ID.search(line)
-                logger.debug(f'tax_match={tax_match}')
-                if tax_match:
-                    results.append(VirmapOutputEntry(line, tax_match))
+            walltimes[index] = float(match.group(2)) if match.group(2) else None
+            cputimes[index] = float(match.group(3)) if match.group(3) else None
+            cpuratios[index] = float(match.group(4)) if match.group(4) else None
 
-                    logger.debug(results[-1])
+        return walltimes, cputimes, cpuratios
+
+    @cached_property
+    def error_hits(self) -> List[ErrorHit]:
+        return [hit for extractor in self.log_scan.errors for hit in extractor.hits]
+
+    @cached_property
+    def warnings_and_errors(self) -> List[str]:
+        return [str(hit) for hit in self.error_hits]
+
+    @cached_property
+    def final_output(self) -> SampleOutput:
+        return SampleOutput.from_headers(iter_final_fa_headers(self.final_fa_filename))
 
-        return results
+    def _copy_log_files(self, dest_dir: str, policy: ArchivePolicy):
+        methods = Counter()
+        methods[archive_file(self.final_fa_filename, os.path.join(dest_dir, f"{self.name}.final.fa"), policy)] += 1
 
-    def _copy_log_files(self, dest_dir: str):
-        copy_tree(
+        methods += archive_tree(
             self.target,
             os.path.join(dest_dir, os.path.basename(self.target)),
+            policy,
+            skip={self.final_fa_filename},
         )
-        shutil.move(
-            os.path.join(
-                dest_dir, os.path.basename(self.target), f"{self.name}.final.fa"
-            ),
-            os.path.join(dest_dir, f"{self.name}.final.fa"),
-        )
-
-        copy_tree(
+        methods += archive_tree(
             self.target_tmp,
             os.path.join(dest_dir, os.path.basename(self.target_tmp)),
+            policy,
         )
+        logger.debug("Archived %r: %s", self.run_name, ", ".join(f"{count} {method}" for method, count in sorted(methods.items())))
 
         file_map_fn = os.path.join(dest_dir, "file_map.dot")
         if os.path.exists(file_map_fn):
@@ -0,0 +1,184 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from analyse_times.profile import percentile
+from constants import TIME_CATEGORIES
+
+# Thread counts considered when recommending one, up to a whole Gadi normal queue node
+CANDIDATE_THREADS = (1, 2, 4, 8, 12, 16, 24, 32, 48)
+# Smallest parallel efficiency of a whole run worth paying for the extra cores
+MIN_EFFICIENCY = 0.5
+# A thread count is as fast as the fastest when its predicted walltime is within this fraction of it
+WALLTIME_SLACK = 0.1
+# The stage covering the whole run, rather than a single stage of it
+OVERALL_STAGE = "Overall Virmap time"
+# A stage is a serial bottleneck when its median CPU ratio is at most this while given at least SERIAL_MIN_THREADS
+SERIAL_MAX_RATIO = 1.5
+SERIAL_MIN_THREADS = 8
+
+
+def fit_serial_fraction(points: Sequence[Tuple[int, float, float]]) -> Optional[float]:
+    """
+    Amdahl's law serial fraction best fitting (threads, walltime, CPU seconds) of runs of a stage
+
+    Taking a stage's CPU seconds as the work it would take on a single thread, Amdahl's law gives
+    walltime / CPU seconds = s + (1 - s) / threads, independent of the size of the input. `s` is fitted by least squares
+    over the runs. None if there are no runs on more than one thread.
+    """
+    numerator = 0.0
+    denominator = 0.0
+    for threads, walltime, cputime in points:
+        x = 1 / threads
+        y = walltime / cputime
+        numerator += (1 - x) * (y - x)
+        denominator += (1 - x) ** 2
+
+    if not denominator:
+        return None
+
+    return min(1.0, max(0.0, numerator / denominator))
+
+
+def idle_core_seconds(threads: int, walltime: Optional[float], cputime: Optional[float]) -> Optional[float]:
+    """Core seconds allocated to a stage but not used by it"""
+    if walltime is None or cputime is None:
+        return None
+
+    return max(0.0, threads * walltime - cputime)
+
+
+def amdahl_efficiency(serial_fraction: float, threads: int) -> float:
+    """Predicted speedup over a single thread, divided by the number of threads"""
+    return 1 / (serial_fraction * threads + 1 - serial_fraction)
+
+
+class StageScaling(NamedTuple):
+    """How well a stage scales with the number of threads"""
+    stage: str
+    runs: int
+    thread_counts: List[int]
+    serial_fraction: Optional[float]
+    # median CPU ratio / threads over the runs
+    observed_efficiency: Optional[float]
+
+    @property
+    def max_speedup(self) -> Optional[float]:
+        if self.serial_fraction is None:
+            return None
+
+        return 1 / self.serial_fraction if self.serial_fraction else float("inf")
+
+    def efficiency(self, threads: int) -> Optional[float]:
+        if self.serial_fraction is None:
+            return None
+
+        return amdahl_efficiency(self.serial_fraction, threads)
+
+
+class ThreadRecommendation(NamedTuple):
+    """Predicted walltimes of a run with a given amount of work in each stage, and the thread counts suiting it"""
+    # CPU seconds over every stage, i.e. the predicted walltime on a single thread
+    work: float
+    walltimes: Dict[int, float]
+    # work / (threads * walltime), i.e. how busy the threads are kept
+    efficiencies: Dict[int, float]
+    # the most threads still running at MIN_EFFICIENCY, the fewest threads always use the fewest core hours
+    max_efficient: int
+    # the fewest threads within WALLTIME_SLACK of the smallest walltime
+    fastest: int
+
+
+class ScalingModel(object):
+    """
+    Amdahl's law fitted to each of the TIME_CATEGORIES stages, over runs given different numbers of threads
+
+    Stages without a fit (e.g. only ever run on one thread) are predicted to be serial.
+    """
+
+    def __init__(self):
+        self._points: Dict[str, List[Tuple[int, float, float]]] = {stage: [] for stage in TIME_CATEGORIES}
+        self._stages: Optional[Dict[str, StageScaling]] = None
+
+    def add_run(self, threads: int, walltimes: Sequence[Optional[float]], cputimes: Sequence[Optional[float]]):
+        """Add a run's walltime and CPU seconds of each stage, in the order of TIME_CATEGORIES"""
+        for stage, walltime, cputime in zip(TIME_CATEGORIES, walltimes, cputimes):
+            if walltime and cputime:
+                self._points[stage].append((threads, walltime, cputime))
+        self._stages = None
+
+    @property
+    def stages(self) -> Dict[str, StageScaling]:
+        if self._stages is None:
+            self._stages = {
+                stage: StageScaling(
+                    stage,
+                    len(points),
+                    sorted({threads for threads, _, _ in points}),
+                    fit_serial_fraction(points),
+                    percentile([cputime / walltime / threads for threads, walltime, cputime in points], 50),
+                )
+                for stage, points in self._points.items()
+            }
+
+        return self._stages
+
+    @staticmethod
+    def run_work(cputimes: Sequence[Optional[float]]) -> Dict[str, float]:
+        """The CPU seconds of each stage of a run (other than OVERALL_STAGE), in the order of TIME_CATEGORIES"""
+        return {
+            stage: cputime
+            for stage, cputime in zip(TIME_CATEGORIES, cputimes)
+            if stage != OVERALL_STAGE and cputime
+        }
+
+    def predict_walltime(self, work: Dict[str, float], threads: int) -> float:
+        """Walltime of a run with `work` CPU seconds in each stage, as given by `run_work`"""
+        walltime = 0.0
+        for stage, cputime in work.items():
+            serial_fraction = self.stages[stage].serial_fraction
+            if serial_fraction is None:
+                serial_fraction = 1.0
+            walltime += cputime * (serial_fraction + (1 - serial_fraction) / threads)
+
+        return walltime
+
+    def recommend(
+            self,
+            work: Dict[str, float],
+            candidates: Sequence[int] = CANDIDATE_THREADS,
+            min_efficiency: float = MIN_EFFICIENCY,
+            walltime_slack: float = WALLTIME_SLACK,
+    ) -> Optional[ThreadRecommendation]:
+        """
+        Thread counts for a run with `work` CPU seconds in each stage, as given by `run_work`
+
+        None if there's no work, e.g. the run logged no CPU times, as every thread count would then look free.
+        """
+        total_work = sum(work.values())
+        if not total_work:
+            return None
+
+        walltimes = {threads: self.predict_walltime(work, threads) for threads in candidates}
+        efficiencies = {threads: total_work / (threads * walltime) for threads, walltime in walltimes.items()}
+        fastest_walltime = min(walltimes.values())
+
+        return ThreadRecommendation(
+            total_work,
+            walltimes,
+            efficiencies,
+            max([threads for threads in candidates if efficiencies[threads] >= min_efficiency], default=min(candidates)),
+            min(threads for threads in candidates if walltimes[threads] <= fastest_walltime * (1 + walltime_slack)),
+        )
@@ -0,0 +1,172 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from abundance_matrix import AbundanceMatrix
+from util import get_logger
+
+# Samples closer than this Bray-Curtis distance are put in the same cluster
+CLUSTER_MAX_DISTANCE = 0.3
+# A taxid is suspected of bleeding into a sample when its size there is at most this fraction of the largest size
+BLEED_MAX_RATIO = 0.01
+# A taxid is suspected of being a contaminant when it's in at least this fraction of the samples
+SHARED_MIN_FRACTION = 0.5
+
+logger = get_logger(__name__)
+
+
+class SharedTaxon(NamedTuple):
+    """A taxid shared across samples in a way suggesting contamination or index hopping"""
+    tax_id: int
+    reason: str
+    # the sample with the largest output for the taxid
+    source: str
+    source_size: int
+    samples: List[str]
+
+
+class SampleDistances(object):
+    """
+    Pairwise Bray-Curtis (by output size) and Jaccard (by taxid set) distances between the samples of a matrix
+
+    Only pairs of samples sharing at least one taxid are stored, as every other pair is at a distance of 1. These are
+    found a column at a time, so the work done is proportional to the number of samples sharing each taxid rather than
+    the square of the number of samples.
+    """
+
+    def __init__(self, matrix: AbundanceMatrix):
+        logger.info("Comparing %d samples", len(matrix.samples))
+        start_time = time.time()
+
+        self.matrix = matrix
+        num_samples = len(matrix.samples)
+        totals = matrix.row_totals()
+        counts = [matrix.indptr[row + 1] - matrix.indptr[row] for row in range(num_samples)]
+
+        # sum of the smaller size, and number of taxids, shared by each pair (keyed by row x * num_samples + row y, x < y)
+        shared_sizes: Dict[int, int] = {}
+        shared_counts: Dict[int, int] = {}
+        get_size = shared_sizes.get
+        get_count = shared_counts.get
+        for _, rows, sizes in matrix.iter_columns():
+            for x_idx in range(len(rows) - 1):
+                x_key = rows[x_idx] * num_samples
+                x_size = sizes[x_idx]
+                for y, y_size in zip(rows[x_idx + 1:], sizes[x_idx + 1:]):
+                    key = x_key + y
+                    shared_sizes[key] = get_size(key, 0) + (x_size if x_size < y_size else y_size)
+                    shared_counts[key] = get_count(key, 0) + 1
+
+        self._bray_curtis: Dict[int, float] = {}
+        self._jaccard: Dict[int, float] = {}
+        for key, shared_size in shared_sizes.items():
+            x, y = divmod(key, num_samples)
+            total = totals[x] + totals[y]
+            self._bray_curtis[key] = 1 - 2 * shared_size / total if total else 0.0
+            self._jaccard[key] = 1 - shared_counts[key] / (counts[x] + counts[y] - shared_counts[key])
+
+        logger.info(
+            f"Found {len(shared_sizes)} pairs of samples sharing taxids in {time.time() - start_time:.2f}s"
+        )
+
+    def _key(self, x: int, y: int) -> int:
+        if x > y:
+            x, y = y, x
+
+        return x * len(self.matrix.samples) + y
+
+    def bray_curtis(self, x: int, y: int) -> float:
+        return 0.0 if x == y else self._bray_curtis.get(self._key(x, y), 1.0)
+
+    def jaccard(self, x: int, y: int) -> float:
+        return 0.0 if x == y else self._jaccard.get(self._key(x, y), 1.0)
+
+    def nearest(self, x: int) -> Optional[int]:
+        """The sample closest to `x` by Bray-Curtis distance, or None if it shares no taxids with any other"""
+        nearest = None
+        nearest_distance = 1.0
+        for y in range(len(self.matrix.samples)):
+            if y != x and self.bray_curtis(x, y) < nearest_distance:
+                nearest = y
+                nearest_distance = self.bray_curtis(x, y)
+
+        return nearest
+
+    def clusters(self, max_distance: float = CLUSTER_MAX_DISTANCE) -> List[int]:
+        """
+        Cluster number of each sample, linking any samples within `max_distance`
+
+        Clusters are numbered by decreasing size, and samples without a close neighbour are clusters of their own.
+        """
+        num_samples = len(self.matrix.samples)
+        parents = list(range(num_samples))
+
+        def find(x):
+            while parents[x] != x:
+                parents[x] = parents[parents[x]]
+                x = parents[x]
+            return x
+
+        for key, distance in self._bray_curtis.items():
+            if distance <= max_distance:
+                x, y = map(find, divmod(key, num_samples))
+                if x != y:
+                    parents[max(x, y)] = min(x, y)
+
+        roots = [find(x) for x in range(num_samples)]
+        sizes: Dict[int, int] = {}
+        for root in roots:
+            sizes[root] = sizes.get(root, 0) + 1
+        numbers = {root: idx + 1 for idx, root in enumerate(sorted(sizes, key=lambda root: (-sizes[root], root)))}
+
+        return [numbers[root] for root in roots]
+
+
+def find_shared_taxa(
+        matrix: AbundanceMatrix,
+        bleed_max_ratio: float = BLEED_MAX_RATIO,
+        shared_min_fraction: float = SHARED_MIN_FRACTION,
+) -> List[SharedTaxon]:
+    """
+    Taxids shared by samples suspiciously
+
+    Taxids found at a tiny fraction of their largest size in some samples suggest index hopping or cross contamination
+    from the sample with the largest size. Taxids found in most of the samples of a batch suggest a reagent or
+    environmental contaminant.
+    """
+    num_samples = len(matrix.samples)
+    samples = matrix.samples
+
+    shared = []
+    for tax_id, rows, sizes in matrix.iter_columns():
+        if len(rows) < 2:
+            continue
+
+        source_idx = max(range(len(rows)), key=sizes.__getitem__)
+        source = samples[rows[source_idx]]
+        source_size = sizes[source_idx]
+
+        bled = [samples[row] for row, size in zip(rows, sizes) if size <= bleed_max_ratio * source_size]
+        if bled:
+            shared.append(SharedTaxon(tax_id, "possible bleed-through", source, source_size, bled))
+
+        if num_samples > 2 and len(rows) >= shared_min_fraction * num_samples:
+            shared.append(SharedTaxon(
+                tax_id, f"in {len(rows) / num_samples:.0%} of samples", source, source_size,
+                [samples[row] for row in rows],
+            ))
+
+    return sorted(shared, key=lambda taxon: (-len(taxon.samples), taxon.tax_id))
@@ -12,105 +12,608 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import hashlib
+import mmap
+import os
 import re
-from collections import defaultdict
+import struct
+import sys
+from array import array
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 from util import get_logger
 
 PAT_SEP = re.compile(r"\t\|[\t\n]")
 
+TAX_DUMP_FILES = ("merged.dmp", "nodes.dmp", "names.dmp")
+TAX_IMAGE_FILENAME = "aggreg_stats_taxonomy.img"
+# Smallest chunk of a dump file worth handing to another process
+TAX_DUMP_MIN_CHUNK_SIZE = 4 << 20
+
+# magic, fingerprint, number of taxid slots, rank table length, name blob length
+_IMAGE_MAGIC = b"VMTAXIMG"
+_IMAGE_VERSION = 2
+_IMAGE_HEADER = struct.Struct("<8s32sQQQ")
+
+# Maximum number of taxids kept in the lineage cache, least recently used entries are evicted first
+LINEAGE_CACHE_SIZE = 1 << 16
+
 logger = get_logger(__name__)
 
 parents = None
 ranks = None
 names = None
+# old merged id -> the id it was merged into, for the old ids aliased in `parents`
+merged = None
+
+_lineage_cache: "OrderedDict[int, Tuple[str, ...]]" = OrderedDict()
+
+
+class _ArrayTable(Mapping):
+    """Read-only dict-like view of a taxid indexed array, where 0 marks a missing taxid"""
+
+    def __init__(self, values, lookup=None):
+        self._values = values
+        self._lookup = lookup
+        self._len = None
+
+    def __getitem__(self, taxid: int):
+        if 0 <= taxid < len(self._values):
+            value = self._values[taxid]
+            if value:
+                return value if self._lookup is None else self._lookup[value]
+
+        raise KeyError(taxid)
+
+    def __contains__(self, taxid) -> bool:
+        return isinstance(taxid, int) and 0 <= taxid < len(self._values) and self._values[taxid] != 0
+
+    def __iter__(self):
+        return (taxid for taxid, value in enumerate(self._values) if value)
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for value in self._values if value)
+
+        return self._len
+
+
+class _NameTable(Mapping):
+    """Read-only dict-like view of the names stored in a string blob, delimited by an offsets array"""
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+        self._len = None
+
+    def __getitem__(self, taxid: int) -> str:
+        if 0 <= taxid < len(self._offsets) - 1:
+            start, end = self._offsets[taxid], self._offsets[taxid + 1]
+            if start != end:
+                return str(self._blob[start:end], "utf-8")
+
+        raise KeyError(taxid)
+
+    def __contains__(self, taxid) -> bool:
+        return (isinstance(taxid, int) and 0 <= taxid < len(self._offsets) - 1
+                and self._offsets[taxid] != self._offsets[taxid + 1])
+
+    def __iter__(self):
+        offsets = self._offsets
+        return (taxid for taxid in range(len(offsets) - 1) if offsets[taxid] != offsets[taxid + 1])
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+
+        return self._len
+
+
+def tax_dump_fingerprint(path: str) -> bytes:
+    """Digest of the size and mtime of each taxonomy dump file, used to detect a stale image"""
+    digest = hashlib.sha256(f"{_IMAGE_VERSION} {sys.byteorder}".encode())
+    for fn in TAX_DUMP_FILES:
+        st = os.stat(os.path.join(path, fn))
+        digest.update(f"\0{fn} {st.st_size} {st.st_mtime_ns}".encode())
+
+    return digest.digest()
+
+
+class TaxImage(NamedTuple):
+    """Raw taxid indexed tables stored in a compiled tax tree image"""
+    parent_values: Sequence[int]
+    rank_values: Sequence[int]
+    rank_table: List[str]
+    name_offsets: Sequence[int]
+    name_blob: bytes
+    # the id each aliased old merged id was merged into, 0 for every other taxid
+    merged_values: Sequence[int]
+
+
+def build_tax_image(
+        tax_parents: Mapping, tax_ranks: Mapping, tax_names: Mapping, tax_merged: Mapping
+) -> TaxImage:
+    """Pack dict-like parents, ranks, names and merged tables into taxid indexed arrays"""
+    num_slots = max(max(tax_parents, default=0), max(tax_names, default=0)) + 1
+
+    # index 0 is reserved to mark a missing rank
+    rank_table = [""] + sorted(set(tax_ranks.values()))
+    if len(rank_table) > 256:
+        raise ValueError(f"Too many distinct ranks ({len(rank_table)}) for the tax tree image")
+    rank_index = {rank: idx for idx, rank in enumerate(rank_table)}
+
+    parent_values = array("I", bytes(4 * num_slots))
+    rank_values = array("B", bytes(num_slots))
+    for taxid, parent in tax_parents.items():
+        parent_values[taxid] = parent
+        rank_values[taxid] = rank_index[tax_ranks[taxid]]
+
+    name_offsets = array("I", bytes(4 * (num_slots + 1)))
+    name_blob = bytearray()
+    for taxid in range(num_slots):
+        name_offsets[taxid] = len(name_blob)
+        name = tax_names.get(taxid)
+        if name is not None:
+            name_blob += name.encode("utf-8")
+    name_offsets[num_slots] = len(name_blob)
+
+    merged_values = array("I", bytes(4 * num_slots))
+    for old_id, new_id in tax_merged.items():
+        merged_values[old_id] = new_id
+
+    return TaxImage(parent_values, rank_values, rank_table, name_offsets, bytes(name_blob), merged_values)
+
+
+def write_tax_image(image_fn: str, fingerprint: bytes, image: TaxImage):
+    """
+    Atomically write out a tax tree image
+
+    Layout (native byte order, all arrays indexed by taxid):
+        header, rank table ("\n" joined), uint32 parents, uint8 rank indices, uint32 merged ids, uint32 name offsets,
+        name blob
+    """
+    num_slots = len(image.parent_values)
+    rank_blob = "\n".join(image.rank_table).encode("utf-8")
 
+    tmp_fn = f"{image_fn}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_fn, "wb") as f:
+            f.write(_IMAGE_HEADER.pack(_IMAGE_MAGIC, fingerprint, num_slots, len(rank_blob), len(image.name_blob)))
+            f.write(rank_blob)
+            f.write(bytes(-f.tell() % 4))
+            f.write(image.parent_values)
+            f.write(image.rank_values)
+            f.write(bytes(-f.tell() % 4))
+            f.write(image.merged_values)
+            f.write(image.name_offsets)
+            f.write(image.name_blob)
 
-def load_tax_tree(path: str):
-    global parents, names, ranks
+        os.replace(tmp_fn, image_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+
+
+def compile_tax_tree(path: str, image_fn: Optional[str] = None, jobs: Optional[int] = None) -> str:
+    """
+    Parse the taxonomy dump files in `path` and write them out as a binary image which can be mapped by
+    `load_tax_tree`
+    """
+    if image_fn is None:
+        image_fn = os.path.join(path, TAX_IMAGE_FILENAME)
+
+    logger.info("Compiling tax tree image %r", image_fn)
+    start_time = time.time()
+
+    fingerprint = tax_dump_fingerprint(path)
+    write_tax_image(image_fn, fingerprint, build_tax_image(*_parse_tax_dump(path, jobs)))
+
+    logger.info(f"Finished compiling tax tree image in {time.time() - start_time:.2f}s")
+
+    return image_fn
+
+
+def read_tax_image(image_fn: str, fingerprint: Optional[bytes] = None) -> Optional[TaxImage]:
+    """
+    Memory-map the tables of a compiled tax tree image
+
+    Returns None if the image doesn't exist, is corrupt or doesn't match `fingerprint`
+    """
+    if not os.path.exists(image_fn):
+        return None
+
+    with open(image_fn, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _IMAGE_HEADER.size:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, image_fingerprint, num_slots, rank_blob_len, name_blob_len = _IMAGE_HEADER.unpack_from(mm)
+    if magic != _IMAGE_MAGIC or (fingerprint is not None and image_fingerprint != fingerprint):
+        mm.close()
+        return None
+
+    offset = _IMAGE_HEADER.size
+    rank_table = str(mm[offset:offset + rank_blob_len], "utf-8").split("\n")
+    offset += rank_blob_len
+    offset += -offset % 4
+
+    parents_offset = offset
+    ranks_offset = parents_offset + 4 * num_slots
+    merged_offset = ranks_offset + num_slots
+    merged_offset += -merged_offset % 4
+    names_offset = merged_offset + 4 * num_slots
+    blob_offset = names_offset + 4 * (num_slots + 1)
+
+    if blob_offset + name_blob_len > len(mm):
+        logger.warning("Tax tree image %r is truncated", image_fn)
+        mm.close()
+        return None
+
+    view = memoryview(mm)
+
+    return TaxImage(
+        view[parents_offset:ranks_offset].cast("I"),
+        view[ranks_offset:ranks_offset + num_slots],
+        rank_table,
+        view[names_offset:blob_offset].cast("I"),
+        view[blob_offset:blob_offset + name_blob_len],
+        view[merged_offset:names_offset].cast("I"),
+    )
+
+
+def map_tax_image(
+        image_fn: str, fingerprint: Optional[bytes] = None
+) -> Optional[Tuple[Mapping, Mapping, Mapping, Mapping]]:
+    """
+    Map a compiled tax tree image, returning dict-like (parents, ranks, names, merged) views
+
+    Returns None if the image doesn't exist, is corrupt or doesn't match `fingerprint`
+    """
+    image = read_tax_image(image_fn, fingerprint)
+    if image is None:
+        return None
+
+    return (
+        _ArrayTable(image.parent_values),
+        _ArrayTable(image.rank_values, image.rank_table),
+        _NameTable(image.name_offsets, image.name_blob),
+        _ArrayTable(image.merged_values),
+    )
+
+
+def load_tax_tree(path: str, taxids: Optional[Iterable[int]] = None, jobs: Optional[int] = None):
+    """
+    Load the tax tree from the taxonomy dump files in `path`, via the compiled image where possible
+
+    If `taxids` is given and there isn't an up to date image, only the lineages of those taxids are loaded (and no
+    image is compiled) to keep small jobs quick and light on memory. Otherwise the dump files are parsed by `jobs`
+    processes.
+    """
+    global parents, names, ranks, merged
     if parents is not None:
         return
 
     logger.info("Loading tax tree")
     start_time = time.time()
 
-    merged = defaultdict(list)
-    with open(f"{path}/merged.dmp", "r") as f:
-        for line in f:
+    image_fn = os.path.join(path, TAX_IMAGE_FILENAME)
+    fingerprint = tax_dump_fingerprint(path)
+
+    tables = map_tax_image(image_fn, fingerprint)
+    if tables is None and taxids is not None:
+        tables = _parse_tax_dump_partial(path, taxids)
+    elif tables is None:
+        try:
+            compile_tax_tree(path, image_fn, jobs)
+            tables = map_tax_image(image_fn, fingerprint)
+        except OSError as e:
+            logger.warning("Failed to write tax tree image %r, falling back to parsing the dump files: %s", image_fn, e)
+
+    if tables is None:
+        tables = _parse_tax_dump(path, jobs)
+
+    parents, ranks, names, merged = tables
+    _lineage_cache.clear()
+
+    logger.info(f"Finished loading tax tree in {time.time() - start_time:.2f}s")
+
+
+def _chunk_ranges(filename: str, num_chunks: int) -> List[Tuple[int, int]]:
+    """Split `filename` into roughly `num_chunks` byte ranges, each starting at the beginning of a line"""
+    size = os.path.getsize(filename)
+
+    bounds = [0]
+    with open(filename, "rb") as f:
+        for idx in range(1, num_chunks):
+            offset = size * idx // num_chunks
+            if offset <= bounds[-1]:
+                continue
+
+            f.seek(offset - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _parse_dump_chunk(filename: str, start: int, end: int):
+    """
+    Parse the lines of one of the taxonomy dump files in the byte range [start, end)
+
+    Returns the columns needed from that file as compact arrays/lists, along with the CPU and wall time taken
+    """
+    start_cpu_time = time.process_time()
+    start_wall_time = time.time()
+
+    with open(filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").splitlines(True)
+
+    kind = os.path.basename(filename)
+    taxids = array("I")
+
+    if kind == "merged.dmp":
+        new_ids = array("I")
+        for line in lines:
             if line.endswith("\t|\n"):
                 line = line[:-3]
 
             old_id, new_id = PAT_SEP.split(line)
 
-            old_id = int(old_id)
-            new_id = int(new_id)
+            taxids.append(int(old_id))
+            new_ids.append(int(new_id))
+
+        result = (taxids, new_ids)
+    elif kind == "nodes.dmp":
+        parent_ids = array("I")
+        rank_values = []
+        for line in lines:
+            taxonomy_id, parent_taxonomy_id, taxonomy_rank = PAT_SEP.split(line, 3)[:3]
+
+            taxids.append(int(taxonomy_id))
+            parent_ids.append(int(parent_taxonomy_id))
+            rank_values.append(taxonomy_rank)
+
+        result = (taxids, parent_ids, rank_values)
+    elif kind == "names.dmp":
+        name_values = []
+        for line in lines:
+            if line.endswith("\t|\n"):
+                line = line[:-3]
+
+            (taxonomy_id, name_txt, unique_name, name_class,) = PAT_SEP.split(line)
+
+            if name_class != "scientific name":
+                continue
+
+            taxids.append(int(taxonomy_id))
+            name_values.append(name_txt)
+
+        result = (taxids, name_values)
+    else:
+        raise ValueError(f"Unknown taxonomy dump file {filename!r}")
 
-            merged[new_id].append(old_id)
+    return result, time.process_time() - start_cpu_time, time.time() - start_wall_time
+
+
+def _parse_tax_dump(
+        path: str, jobs: Optional[int] = None
+) -> Tuple[Dict[int, int], Dict[int, str], Dict[int, str], Dict[int, int]]:
+    """
+    Parse merged.dmp, nodes.dmp and names.dmp into (parents, ranks, names, merged) dicts
+
+    Each file is split into line aligned chunks which are parsed in a pool of `jobs` processes (defaulting to the
+    number of CPUs), and old merged ids are given the same parent, rank and name as the id they were merged into.
+    `merged` maps each old id given the parent of the id it was merged into to that id.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    start_time = time.time()
+
+    chunks = []
+    for fn in TAX_DUMP_FILES:
+        filename = os.path.join(path, fn)
+        num_chunks = max(1, min(jobs * 2, os.path.getsize(filename) // TAX_DUMP_MIN_CHUNK_SIZE))
+        chunks.extend((fn, filename, start, end) for start, end in _chunk_ranges(filename, num_chunks))
+
+    file_results = defaultdict(list)
+    file_cpu_times = defaultdict(float)
+    # time spent parsing the chunks of each file, which may have overlapped
+    file_wall_times = defaultdict(float)
+
+    def collect(chunk, chunk_result):
+        fn = chunk[0]
+        result, cpu_time, wall_time = chunk_result
+        file_results[fn].append(result)
+        file_cpu_times[fn] += cpu_time
+        file_wall_times[fn] += wall_time
+
+    if jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(_parse_dump_chunk, filename, start, end): (fn, filename, start, end)
+                for fn, filename, start, end in chunks
+            }
+            for future in as_completed(futures):
+                collect(futures[future], future.result())
+    else:
+        for chunk in chunks:
+            collect(chunk, _parse_dump_chunk(*chunk[1:]))
+
+    for fn in TAX_DUMP_FILES:
+        logger.info(
+            f"Parsed {fn} in {file_wall_times[fn]:.2f}s summed over {len(file_results[fn])} chunks "
+            f"({file_cpu_times[fn]:.2f}s CPU)"
+        )
+    logger.info(f"Parsed the taxonomy dump files in {time.time() - start_time:.2f}s")
+
+    merge_start_time = time.time()
+
+    merged_into = defaultdict(list)
+    for old_ids, new_ids in file_results.pop("merged.dmp", []):
+        for old_id, new_id in zip(old_ids, new_ids):
+            merged_into[new_id].append(old_id)
 
     parents = {}
     ranks = {}
+    for taxids, parent_ids, rank_values in file_results.pop("nodes.dmp", []):
+        parents.update(zip(taxids, parent_ids))
+        ranks.update(zip(taxids, rank_values))
+
     names = {}
+    for taxids, name_values in file_results.pop("names.dmp", []):
+        names.update(zip(taxids, name_values))
 
-    with open(f"{path}/nodes.dmp", "r") as f:
+    # an old id which still has its own entry keeps it
+    merged = {}
+    for new_id, old_ids in merged_into.items():
+        for old_id in old_ids:
+            if new_id in parents and old_id not in parents:
+                merged[old_id] = new_id
+                parents[old_id] = parents[new_id]
+                ranks[old_id] = ranks[new_id]
+            if new_id in names and old_id not in names:
+                names[old_id] = names[new_id]
+
+    logger.info(f"Merged tax tree tables in {time.time() - merge_start_time:.2f}s")
+
+    return parents, ranks, names, merged
+
+
+def _parse_tax_dump_partial(
+        path: str, taxids: Iterable[int]
+) -> Tuple[Dict[int, int], Dict[int, str], Dict[int, str], Dict[int, int]]:
+    """Load only the parents, ranks and names on the lineages of `taxids`, and which of them are merged ids"""
+    taxids = set(taxids)
+    logger.info("Loading lineages of %d taxids", len(taxids))
+
+    # old id -> new id
+    all_merged = {}
+    with open(f"{path}/merged.dmp", "r") as f:
         for line in f:
             if line.endswith("\t|\n"):
                 line = line[:-3]
 
-            (
-                taxonomy_id,
-                parent_taxonomy_id,
-                taxonomy_rank,
-                embl_code,
-                division_id,
-                is_inheriteddivision,
-                genetic_code_id,
-                is_inherited_genetic_code,
-                mitochondrial_genetic_code_id,
-                is_inherited_mitochondrial_genetic_code,
-                is_hidden_in_genbank,
-                is_subtree_hidden,
-                comments,
-            ) = PAT_SEP.split(line)
+            old_id, new_id = PAT_SEP.split(line)
+            all_merged[int(old_id)] = int(new_id)
+
+    # keep every parent in compact arrays, as we can't know which lineages we need until the whole file is read
+    all_parents = array("I")
+    all_ranks = array("B")
+    rank_index = {}
+    with open(f"{path}/nodes.dmp", "r") as f:
+        for line in f:
+            taxonomy_id, parent_taxonomy_id, taxonomy_rank = PAT_SEP.split(line, 3)[:3]
 
             taxonomy_id = int(taxonomy_id)
-            parent_taxonomy_id = int(parent_taxonomy_id)
+            if taxonomy_id >= len(all_parents):
+                grow_by = max(taxonomy_id + 1 - len(all_parents), len(all_parents))
+                all_parents.frombytes(bytes(4 * grow_by))
+                all_ranks.frombytes(bytes(grow_by))
 
-            parents[taxonomy_id] = parent_taxonomy_id
-            ranks[taxonomy_id] = taxonomy_rank
+            all_parents[taxonomy_id] = int(parent_taxonomy_id)
+            all_ranks[taxonomy_id] = rank_index.setdefault(taxonomy_rank, len(rank_index))
 
-            if taxonomy_id in merged:
-                for old_id in merged[taxonomy_id]:
-                    parents[old_id] = parent_taxonomy_id
-                    ranks[old_id] = taxonomy_rank
+    rank_table = sorted(rank_index, key=rank_index.get)
 
-    with open(f"{path}/names.dmp", "r") as f:
-        for line in f:
-            if line.endswith("\t|\n"):
-                line = line[:-3]
+    parents = {}
+    ranks = {}
+    for taxid in taxids:
+        node = all_merged.get(taxid, taxid)
+        while node not in parents:
+            if node >= len(all_parents) or not all_parents[node]:
+                logger.warning("Taxid %d isn't in the tax tree", taxid)
+                break
 
-            (taxonomy_id, name_txt, unique_name, name_class,) = PAT_SEP.split(line)
+            parents[node] = all_parents[node]
+            ranks[node] = rank_table[all_ranks[node]]
+            node = all_parents[node]
 
-            if name_class != "scientific name":
+    del all_parents, all_ranks
+
+    names = {}
+    with open(f"{path}/names.dmp", "r") as f:
+        for line in f:
+            if not line.endswith("\tscientific name\t|\n"):
                 continue
 
+            taxonomy_id, name_txt = PAT_SEP.split(line, 2)[:2]
+
             taxonomy_id = int(taxonomy_id)
-            names[taxonomy_id] = name_txt
+            if taxonomy_id in parents:
+                names[taxonomy_id] = name_txt
 
-            if taxonomy_id in merged:
-                for old_id in merged[taxonomy_id]:
-                    names[old_id] = name_txt
+    # alias the merged ids we were asked for
+    merged = {}
+    for taxid in taxids:
+        new_id = all_merged.get(taxid)
+        if new_id is not None and new_id in parents:
+            merged[taxid] = new_id
+            parents[taxid] = parents[new_id]
+            ranks[taxid] = ranks[new_id]
+            if new_id in names:
+                names[taxid] = names[new_id]
 
-    logger.info(f"Finished loading tax tree in {time.time() - start_time:.2f}s")
+    logger.info("Loaded %d lineage nodes", len(parents))
 
+    return parents, ranks, names, merged
+
+
+def resolve_lineage(taxid: int) -> Tuple[str, ...]:
+    """
+    Names of `taxid` and its ancestors (excluding the root), from the top of the tree down
+
+    Lineages are memoized, so repeated calls for the same taxid return the same tuple
+    """
+    lineage = _lineage_cache.get(taxid)
+    if lineage is not None:
+        _lineage_cache.move_to_end(taxid)
+        return lineage
 
-def resolve_taxid(taxid):
     if parents is None:
         raise ValueError('Tax tree not loaded!')
 
-    tax_names = []
-
+    # walk up the tree until we reach the root or an ancestor which has already been resolved
+    path = []
+    lineage = ()
     while taxid != 1:
-        tax_names.append(names[taxid])
+        cached = _lineage_cache.get(taxid)
+        if cached is not None:
+            lineage = cached
+            break
+
+        path.append(taxid)
         taxid = parents[taxid]
 
-    return " > ".join(reversed(tax_names))
+    # then extend the lineage back down, caching each ancestor on the way
+    for taxid in reversed(path):
+        lineage = lineage + (names[taxid],)
+        _lineage_cache[taxid] = lineage
+
+    while len(_lineage_cache) > LINEAGE_CACHE_SIZE:
+        _lineage_cache.popitem(last=False)
+
+    return lineage
+
+
+def resolve_lineages(taxids: Iterable[int]) -> List[Tuple[str, ...]]:
+    """Resolve the lineage of each of `taxids`, looking up each distinct taxid only once"""
+    taxids = list(taxids)
+    unique = {taxid: resolve_lineage(taxid) for taxid in set(taxids)}
+
+    return [unique[taxid] for taxid in taxids]
+
+
+def resolve_taxid(taxid):
+    return " > ".join(resolve_lineage(taxid))
+
+
+if __name__ == '__main__':
+    # e.g. python tax_db.py /path/to/taxonomy/database
+    for tax_path in sys.argv[1:]:
+        compile_tax_tree(tax_path)
@@ -0,0 +1,483 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import filecmp
+import logging
+import mmap
+import os
+import sys
+import time
+from array import array
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import tax_db
+from sample_results import find_name, read_final_fa_taxids
+from tax_db import PAT_SEP, TAX_IMAGE_FILENAME, TaxImage
+from util import get_logger
+
+logger = get_logger(__name__)
+
+
+class TaxDelta(NamedTuple):
+    """Changes between two taxonomy dumps"""
+    nodes: Set[int]
+    names: Set[int]
+    deleted: Set[int]
+    merged: Dict[int, int]
+
+
+class _UnsortedDump(Exception):
+    pass
+
+
+# Size of the blocks compared when skipping over identical parts of two dump files
+_DIFF_WINDOW = 1 << 20
+
+
+def _map_dump(filename: str):
+    """Read-only map of a dump file, or empty bytes if it's missing or empty"""
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return b""
+
+    with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _first_difference(old, old_pos: int, new, new_pos: int) -> int:
+    """Number of identical bytes in `old` and `new` from the given positions"""
+    same = 0
+    window = _DIFF_WINDOW
+    while window:
+        old_block = old[old_pos + same:old_pos + same + window]
+        if old_block and old_block == new[new_pos + same:new_pos + same + window]:
+            same += len(old_block)
+        else:
+            window //= 2
+
+    return same
+
+
+def _group_at(data, pos: int) -> Tuple[int, List[str], int]:
+    """The taxid and lines of the group of lines starting at `pos`, and the position after them"""
+    prefix = data[pos:data.find(b"\t", pos) + 1]
+
+    end = pos
+    while end < len(data) and data[end:end + len(prefix)] == prefix:
+        end = data.find(b"\n", end) + 1 or len(data)
+
+    return int(prefix), str(data[pos:end], "utf-8").splitlines(True), end
+
+
+def _group_start(data, pos: int, limit: int) -> int:
+    """Start of the group of lines containing `pos`, searching no further back than `limit`"""
+    line_start = data.rfind(b"\n", limit, pos) + 1 or limit
+    if line_start >= len(data):
+        return line_start
+
+    prefix = data[line_start:data.find(b"\t", line_start) + 1]
+
+    while line_start > limit:
+        previous = data.rfind(b"\n", limit, line_start - 1) + 1 or limit
+        if data[previous:previous + len(prefix)] != prefix:
+            break
+        line_start = previous
+
+    return line_start
+
+
+def _diff_sorted(old, new) -> Dict[int, Tuple[List[str], List[str]]]:
+    """
+    Compare two dump files sorted by taxid, skipping identical stretches block by block and only splitting the
+    differing parts into groups of lines per taxid
+    """
+    changes = {}
+    old_pos = new_pos = 0
+    last_old = last_new = -1
+
+    while old_pos < len(old) or new_pos < len(new):
+        same = _first_difference(old, old_pos, new, new_pos)
+        if old_pos + same >= len(old) and new_pos + same >= len(new):
+            break
+
+        # the bytes before the difference are identical, so both files agree on where its group starts. The differing
+        # line may have been added to or removed from the end of the previous line's group (even when the taxids of the
+        # lines share leading digits), so comparing starts from the group of the line before it
+        line_start = old.rfind(b"\n", old_pos, old_pos + same) + 1 or old_pos
+        group_start = _group_start(old, max(old_pos, line_start - 1), old_pos) - old_pos
+        old_pos += group_start
+        new_pos += group_start
+
+        # merge the differing groups until both files are back in step
+        while old_pos < len(old) or new_pos < len(new):
+            old_group = _group_at(old, old_pos) if old_pos < len(old) else None
+            new_group = _group_at(new, new_pos) if new_pos < len(new) else None
+
+            for group, last in ((old_group, last_old), (new_group, last_new)):
+                if group is not None and group[0] < last:
+                    raise _UnsortedDump()
+
+            if new_group is None or (old_group is not None and old_group[0] < new_group[0]):
+                changes[old_group[0]] = (old_group[1], [])
+                last_old = old_group[0]
+                old_pos = old_group[2]
+            elif old_group is None or new_group[0] < old_group[0]:
+                changes[new_group[0]] = ([], new_group[1])
+                last_new = new_group[0]
+                new_pos = new_group[2]
+            elif old_group[1] != new_group[1]:
+                changes[old_group[0]] = (old_group[1], new_group[1])
+                last_old = last_new = old_group[0]
+                old_pos, new_pos = old_group[2], new_group[2]
+            else:
+                old_pos, new_pos = old_group[2], new_group[2]
+                break
+
+    return changes
+
+
+def _read_all_groups(filename: str) -> Dict[int, List[str]]:
+    groups = {}
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            for line in f:
+                groups.setdefault(int(line.split("\t", 1)[0]), []).append(line)
+
+    return groups
+
+
+def _find_group(data, taxid: int) -> List[str]:
+    """Lines of `taxid` in a dump file sorted by taxid, found by bisecting over the lines of the file"""
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = data.rfind(b"\n", lo, mid) + 1 or lo
+        if int(data[start:data.find(b"\t", start)]) < taxid:
+            lo = data.find(b"\n", start) + 1 or len(data)
+        else:
+            hi = start
+
+    if lo < len(data) and data[lo:data.find(b"\t", lo)] == str(taxid).encode():
+        return _group_at(data, lo)[1]
+
+    return []
+
+
+def _diff_dump(old_fn: str, new_fn: str):
+    """
+    The changes between two versions of a dump file, and a function giving the lines of any taxid in the new version
+    """
+    new = _map_dump(new_fn)
+
+    def find_new_group(taxid: int) -> List[str]:
+        return _find_group(new, taxid)
+
+    if os.path.exists(old_fn) and os.path.exists(new_fn) and filecmp.cmp(old_fn, new_fn, shallow=False):
+        return {}, find_new_group
+
+    try:
+        return _diff_sorted(_map_dump(old_fn), new), find_new_group
+    except _UnsortedDump:
+        logger.warning("%r or %r isn't sorted by taxid, comparing in memory", old_fn, new_fn)
+
+    old_all = _read_all_groups(old_fn)
+    new_all = _read_all_groups(new_fn)
+
+    changes = {
+        taxid: (old_all.get(taxid, []), new_all.get(taxid, []))
+        for taxid in old_all.keys() | new_all.keys()
+        if old_all.get(taxid) != new_all.get(taxid)
+    }
+
+    return changes, lambda taxid: new_all.get(taxid, [])
+
+
+def diff_dump(old_fn: str, new_fn: str) -> Dict[int, Tuple[List[str], List[str]]]:
+    """
+    Lines of two versions of a dump file which differ, as {taxid: (old lines, new lines)}
+
+    NCBI dump files are sorted by taxid, so identical stretches are skipped without parsing them. Should that not
+    hold, both files are loaded into memory instead.
+    """
+    return _diff_dump(old_fn, new_fn)[0]
+
+
+def _scientific_name(lines: List[str]) -> Optional[str]:
+    for line in lines:
+        if line.endswith("\t|\n"):
+            line = line[:-3]
+
+        (taxonomy_id, name_txt, unique_name, name_class,) = PAT_SEP.split(line)
+        if name_class == "scientific name":
+            return name_txt
+
+    return None
+
+
+def _node_values(lines: List[str]) -> Tuple[int, str]:
+    taxonomy_id, parent_taxonomy_id, taxonomy_rank = PAT_SEP.split(lines[0], 3)[:3]
+
+    return int(parent_taxonomy_id), taxonomy_rank
+
+
+def _read_merged(filename: str) -> Dict[int, int]:
+    merged = {}
+    if not os.path.exists(filename):
+        return merged
+
+    with open(filename, "r") as f:
+        for line in f:
+            if line.endswith("\t|\n"):
+                line = line[:-3]
+
+            old_id, new_id = PAT_SEP.split(line)
+            merged[int(old_id)] = int(new_id)
+
+    return merged
+
+
+def _patch_names(image: TaxImage, name_updates: Dict[int, Optional[str]], num_slots: int) -> Tuple[array, bytes]:
+    """Rebuild the name offsets and blob, copying the runs of unchanged names in bulk"""
+    old_offsets = image.name_offsets
+    old_blob = image.name_blob
+    old_slots = len(old_offsets) - 1
+
+    offsets = array("I")
+    blob = bytearray()
+    position = 0
+    for taxid in sorted(name_updates) + [num_slots]:
+        run_end = min(taxid, old_slots)
+        if position < run_end:
+            start, end = old_offsets[position], old_offsets[run_end]
+            delta = len(blob) - start
+            run = old_offsets[position:run_end]
+            if delta:
+                offsets.extend(offset + delta for offset in run)
+            else:
+                offsets.extend(run)
+            blob += old_blob[start:end]
+
+        # slots past the end of the old image have no names
+        offsets.extend([len(blob)] * (taxid - max(position, run_end)))
+
+        if taxid == num_slots:
+            break
+
+        offsets.append(len(blob))
+        name = name_updates[taxid]
+        if name is not None:
+            blob += name.encode("utf-8")
+        position = taxid + 1
+
+    offsets.append(len(blob))
+
+    return offsets, bytes(blob)
+
+
+def update_tax_image(old_path: str, new_path: str, image_fn: Optional[str] = None) -> TaxDelta:
+    """
+    Apply the changes between the taxonomy dumps in `old_path` and `new_path` to the compiled image of the old dumps,
+    writing an image for the new dumps without reparsing them
+    """
+    if image_fn is None:
+        image_fn = os.path.join(new_path, TAX_IMAGE_FILENAME)
+
+    old_image_fn = os.path.join(old_path, TAX_IMAGE_FILENAME)
+    image = tax_db.read_tax_image(old_image_fn, tax_db.tax_dump_fingerprint(old_path))
+    if image is None:
+        raise ValueError(f"No up to date tax tree image in {old_path!r}, compile it with tax_db.py first")
+
+    start_time = time.time()
+    diffs = {}
+    find_new_groups = {}
+    for fn in ("nodes.dmp", "names.dmp", "merged.dmp", "delnodes.dmp"):
+        diffs[fn], find_new_groups[fn] = _diff_dump(os.path.join(old_path, fn), os.path.join(new_path, fn))
+        logger.info(f"{fn}: {len(diffs[fn])} changed taxids ({time.time() - start_time:.2f}s)")
+
+    old_merged = _read_merged(os.path.join(old_path, "merged.dmp"))
+    new_merged = _read_merged(os.path.join(new_path, "merged.dmp"))
+
+    num_slots = len(image.parent_values)
+    for diff in diffs.values():
+        num_slots = max(num_slots, max(diff, default=-1) + 1)
+    num_slots = max(num_slots, max(new_merged, default=-1) + 1)
+
+    parent_values = array("I")
+    parent_values.frombytes(memoryview(image.parent_values).cast("B"))
+    parent_values.frombytes(bytes(4 * (num_slots - len(parent_values))))
+    rank_values = array("B")
+    rank_values.frombytes(memoryview(image.rank_values).cast("B"))
+    rank_values.frombytes(bytes(num_slots - len(rank_values)))
+    merged_values = array("I")
+    merged_values.frombytes(memoryview(image.merged_values).cast("B"))
+    merged_values.frombytes(bytes(4 * (num_slots - len(merged_values))))
+    rank_table = list(image.rank_table)
+    rank_index = {rank: idx for idx, rank in enumerate(rank_table)}
+
+    def set_node(taxid: int, lines: List[str]):
+        if not lines:
+            parent_values[taxid] = 0
+            rank_values[taxid] = 0
+            return
+
+        parent, rank = _node_values(lines)
+        if rank not in rank_index:
+            rank_index[rank] = len(rank_table)
+            rank_table.append(rank)
+            if len(rank_table) > 256:
+                raise ValueError(f"Too many distinct ranks ({len(rank_table)}) for the tax tree image")
+
+        parent_values[taxid] = parent
+        rank_values[taxid] = rank_index[rank]
+
+    for taxid, (old_lines, new_lines) in diffs["nodes.dmp"].items():
+        set_node(taxid, new_lines)
+
+    name_updates = {
+        taxid: _scientific_name(new_lines)
+        for taxid, (old_lines, new_lines) in diffs["names.dmp"].items()
+    }
+
+    # Merged ids are aliases of the id they were merged into, unless they still have an entry of their own (as in
+    # tax_db._parse_tax_dump). Aliases are worked out again wherever the merge, the merged id's own entries or the
+    # entries of the id it was merged into changed, and dropped when the merge was removed.
+    changed = diffs["nodes.dmp"].keys() | diffs["names.dmp"].keys()
+    realias = {
+        old_id
+        for old_id in old_merged.keys() | new_merged.keys()
+        if old_id in changed or old_id in diffs["merged.dmp"] or new_merged.get(old_id) in changed
+    }
+    find_node = find_new_groups["nodes.dmp"]
+    find_names = find_new_groups["names.dmp"]
+    for old_id in sorted(realias):
+        new_id = new_merged.get(old_id)
+
+        node_lines = find_node(old_id)
+        merged_values[old_id] = 0
+        if not node_lines and new_id is not None:
+            node_lines = find_node(new_id)
+            if node_lines:
+                merged_values[old_id] = new_id
+        set_node(old_id, node_lines)
+
+        name = _scientific_name(find_names(old_id))
+        if name is None and new_id is not None:
+            name = _scientific_name(find_names(new_id))
+        name_updates[old_id] = name
+
+    # like a full parse, delnodes.dmp is only reported, deleted ids are gone from nodes.dmp and names.dmp already
+    deleted = {taxid for taxid, (old_lines, new_lines) in diffs["delnodes.dmp"].items() if new_lines}
+
+    name_offsets, name_blob = _patch_names(image, name_updates, num_slots)
+
+    tax_db.write_tax_image(
+        image_fn,
+        tax_db.tax_dump_fingerprint(new_path),
+        TaxImage(parent_values, rank_values, rank_table, name_offsets, name_blob, merged_values),
+    )
+
+    logger.info(f"Updated tax tree image {image_fn!r} in {time.time() - start_time:.2f}s")
+
+    new_merges = {taxid: new_merged[taxid] for taxid in diffs["merged.dmp"] if taxid in new_merged}
+
+    return TaxDelta(set(diffs["nodes.dmp"]), set(name_updates), deleted, new_merges)
+
+
+def _lineage_ids(parents, taxid: int) -> Tuple[int, ...]:
+    lineage = []
+    while taxid in parents and taxid != 1:
+        lineage.append(taxid)
+        taxid = parents[taxid]
+
+    return tuple(lineage)
+
+
+def report_remapped(
+        old_path: str, new_path: str, delta: TaxDelta, sample_dirs: List[str]
+) -> List[Tuple[str, int, str, str]]:
+    """Taxids referenced by the samples which were merged, deleted or moved within the tree"""
+    old_parents = tax_db.map_tax_image(os.path.join(old_path, TAX_IMAGE_FILENAME))[0]
+    new_parents = tax_db.map_tax_image(os.path.join(new_path, TAX_IMAGE_FILENAME))[0]
+
+    rows = []
+    for sample_dir in sample_dirs:
+        run_name = os.path.basename(os.path.abspath(sample_dir))
+        try:
+            taxids = read_final_fa_taxids(sample_dir)
+        except OSError as e:
+            logger.warning("Failed to read taxids from %r: %s", sample_dir, e)
+            continue
+
+        for taxid in sorted(taxids):
+            if taxid in delta.merged:
+                rows.append((run_name, taxid, "merged", str(delta.merged[taxid])))
+            elif taxid in delta.deleted:
+                rows.append((run_name, taxid, "deleted", ""))
+            else:
+                old_lineage = _lineage_ids(old_parents, taxid)
+                new_lineage = _lineage_ids(new_parents, taxid)
+                if old_lineage != new_lineage:
+                    rows.append((run_name, taxid, "lineage changed", " > ".join(map(str, reversed(new_lineage)))))
+
+    return rows
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Update the compiled tax tree image for a new NCBI taxdump from the image of an older one"
+    )
+    parser.add_argument('--old', type=str, help='Directory containing the previous taxonomy files and their image', required=True)
+    parser.add_argument('--new', type=str, help='Directory containing the new taxonomy files', required=True)
+    exclusive = parser.add_mutually_exclusive_group()
+    exclusive.add_argument('-d', '--samples-dir', type=str, help='Report taxids remapped in the samples in this directory')
+    exclusive.add_argument('-s', '--sample', nargs='+', type=str, help='Report taxids remapped in these sample output directories')
+    parser.add_argument('-r', '--report', type=str, help='Filename for the remapped taxids report (default: stdout)')
+    parser.add_argument('-v', '--verbose', action='store_const', const=True, help='Show DEBUG level log messages')
+
+    parsed = parser.parse_args(args)
+    if parsed.verbose:
+        from util import console_handler
+        console_handler.setLevel(logging.DEBUG)
+
+    delta = update_tax_image(parsed.old, parsed.new)
+    logger.info(
+        f"{len(delta.nodes)} nodes changed, {len(delta.names)} names changed, "
+        f"{len(delta.deleted)} taxids deleted, {len(delta.merged)} taxids merged"
+    )
+
+    sample_dirs = parsed.sample or []
+    if parsed.samples_dir:
+        for filename in sorted(os.listdir(parsed.samples_dir)):
+            sample_dir = os.path.join(parsed.samples_dir, filename)
+            if os.path.isdir(sample_dir) and find_name(sample_dir) is not None:
+                sample_dirs.append(sample_dir)
+
+    if not sample_dirs:
+        return
+
+    rows = report_remapped(parsed.old, parsed.new, delta, sample_dirs)
+    logger.info("%d remapped taxids in %d samples", len(rows), len({row[0] for row in rows}))
+
+    out = open(parsed.report, "w") if parsed.report else sys.stdout
+    try:
+        out.write("sample\ttaxid\tchange\tnew\n")
+        for row in rows:
+            out.write("\t".join(map(str, row)) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,240 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import tax_db
+from util import get_logger
+
+# Ranks the per-sample abundances are rolled up to by default
+ROLLUP_RANKS = ("genus", "family", "order")
+# Pseudo-taxid used for entries with no ancestor at the requested rank
+UNASSIGNED = 0
+
+logger = get_logger(__name__)
+
+tax_index = None
+
+
+class TaxIndex:
+    """
+    Ancestor index over the tax tree
+
+    An Euler tour of the tree gives each taxid an entry/exit interval, so "is X an ancestor of Y" is an O(1) interval
+    test. Per-rank ancestor tables make "ancestor of Y at rank R" O(1) once built, and a binary lifting table over the
+    (shallow) tree depth gives the LCA in O(log depth).
+
+    Old merged ids in `merged` (aliased in `parents` by tax_db) aren't nodes of their own, they share the slot of the id
+    they were merged into: the same interval, depth and rank ancestors, and the LCA and roll-ups report the new id.
+    """
+
+    def __init__(self, parents: Mapping, ranks: Mapping, merged: Optional[Mapping] = None):
+        logger.info("Building tax tree index")
+        start_time = time.time()
+
+        self.source = parents
+        num_slots = max(max(parents, default=0), max(parents.values(), default=0)) + 1
+        self._merged = {} if merged is None else {
+            old_id: new_id for old_id, new_id in merged.items() if old_id in parents and new_id in parents
+        }
+
+        self._parents = array("I", bytes(4 * num_slots))
+        rank_index = {}
+        self._ranks = array("B", bytes(num_slots))
+        child_counts = array("I", bytes(4 * (num_slots + 1)))
+        for taxid, parent in parents.items():
+            self._parents[taxid] = parent
+            self._ranks[taxid] = rank_index.setdefault(ranks[taxid], len(rank_index))
+            if taxid != parent and taxid not in self._merged:
+                child_counts[parent + 1] += 1
+
+        self._rank_index = rank_index
+
+        # children of each taxid, stored contiguously
+        child_start = child_counts
+        for idx in range(1, num_slots + 1):
+            child_start[idx] += child_start[idx - 1]
+        children = array("I", bytes(4 * child_start[num_slots]))
+        fill = array("I", child_start)
+        for taxid, parent in parents.items():
+            if taxid != parent and taxid not in self._merged:
+                children[fill[parent]] = taxid
+                fill[parent] += 1
+        del fill
+
+        # iterative Euler tour from the root, taxids unreachable from the root keep an entry time of 0
+        self._entry = array("I", bytes(4 * num_slots))
+        self._exit = array("I", bytes(4 * num_slots))
+        self._depth = array("H", bytes(2 * num_slots))
+        self._preorder = array("I")
+
+        clock = 0
+        max_depth = 0
+        if num_slots > 1:
+            stack = [(1, False)]
+            while stack:
+                taxid, leaving = stack.pop()
+                clock += 1
+                if leaving:
+                    self._exit[taxid] = clock
+                    continue
+
+                self._entry[taxid] = clock
+                self._preorder.append(taxid)
+                stack.append((taxid, True))
+
+                depth = self._depth[taxid] + 1
+                for child in children[child_start[taxid]:child_start[taxid + 1]]:
+                    self._depth[child] = depth
+                    stack.append((child, False))
+                max_depth = max(max_depth, depth)
+
+        for old_id, new_id in self._merged.items():
+            self._entry[old_id] = self._entry[new_id]
+            self._exit[old_id] = self._exit[new_id]
+            self._depth[old_id] = self._depth[new_id]
+
+        self._max_depth = max_depth
+        self._lifting: Optional[List[array]] = None
+        self._rank_ancestors: Dict[str, array] = {}
+
+        logger.info(f"Finished building tax tree index in {time.time() - start_time:.2f}s")
+
+    def __contains__(self, taxid) -> bool:
+        return isinstance(taxid, int) and 0 < taxid < len(self._entry) and self._entry[taxid] != 0
+
+    def is_ancestor(self, ancestor: int, taxid: int) -> bool:
+        """Whether `ancestor` is `taxid` or one of its ancestors"""
+        if ancestor not in self or taxid not in self:
+            return False
+
+        return self._entry[ancestor] <= self._entry[taxid] and self._exit[taxid] <= self._exit[ancestor]
+
+    def depth(self, taxid: int) -> int:
+        if taxid not in self:
+            raise KeyError(taxid)
+
+        return self._depth[taxid]
+
+    def ancestor_at_rank(self, taxid: int, rank: str) -> int:
+        """The ancestor (or self) of `taxid` with the given rank, or UNASSIGNED if there isn't one"""
+        if taxid not in self:
+            raise KeyError(taxid)
+
+        return self.rank_ancestors(rank)[taxid]
+
+    def rank_ancestors(self, rank: str) -> array:
+        """Table mapping every taxid to its ancestor (or self) at `rank`, built on first use"""
+        table = self._rank_ancestors.get(rank)
+        if table is not None:
+            return table
+
+        table = array("I", bytes(4 * len(self._entry)))
+        rank_id = self._rank_index.get(rank)
+        if rank_id is not None:
+            parents = self._parents
+            node_ranks = self._ranks
+            # parents are always visited before their children
+            for taxid in self._preorder:
+                if node_ranks[taxid] == rank_id:
+                    table[taxid] = taxid
+                else:
+                    table[taxid] = table[parents[taxid]]
+            for old_id, new_id in self._merged.items():
+                table[old_id] = table[new_id]
+
+        self._rank_ancestors[rank] = table
+
+        return table
+
+    def lca(self, x: int, y: int) -> int:
+        """Lowest common ancestor of `x` and `y`"""
+        if x not in self:
+            raise KeyError(x)
+        if y not in self:
+            raise KeyError(y)
+
+        x = self._merged.get(x, x)
+        y = self._merged.get(y, y)
+        if self.is_ancestor(x, y):
+            return x
+        if self.is_ancestor(y, x):
+            return y
+
+        lifting = self._build_lifting()
+        for level in reversed(lifting):
+            ancestor = level[x]
+            if not self.is_ancestor(ancestor, y):
+                x = ancestor
+
+        return self._parents[x]
+
+    def _build_lifting(self) -> List[array]:
+        if self._lifting is None:
+            # the root is its own parent, so jumping past it stays at the root
+            lifting = [self._parents]
+            for _ in range(1, max(1, self._max_depth.bit_length())):
+                previous = lifting[-1]
+                lifting.append(array("I", (previous[ancestor] for ancestor in previous)))
+            self._lifting = lifting
+
+        return self._lifting
+
+    def rollup(self, taxids: Sequence[int], sizes: Sequence[int], rank: str) -> Counter:
+        """Sum `sizes` by the ancestor of each of `taxids` at `rank`"""
+        table = self.rank_ancestors(rank)
+        num_slots = len(table)
+
+        totals = Counter()
+        for taxid, size in zip(taxids, sizes):
+            totals[table[taxid] if 0 <= taxid < num_slots else UNASSIGNED] += size
+
+        return totals
+
+
+def get_tax_index() -> TaxIndex:
+    """Index over the loaded tax tree, built on first use"""
+    global tax_index
+
+    if tax_db.parents is None:
+        raise ValueError('Tax tree not loaded!')
+
+    if tax_index is None or tax_index.source is not tax_db.parents:
+        tax_index = TaxIndex(tax_db.parents, tax_db.ranks, tax_db.merged)
+
+    return tax_index
+
+
+def rollup_sample(sample, ranks: Iterable[str] = ROLLUP_RANKS) -> Dict[str, Counter]:
+    """Total output size of a sample's `final_output` by ancestor at each of `ranks`"""
+    index = get_tax_index()
+    output = sample.final_output
+
+    return {rank: index.rollup(output.tax_ids, output.sizes, rank) for rank in ranks}
+
+
+def rollup_samples(samples, ranks: Iterable[str] = ROLLUP_RANKS) -> Dict[str, Dict[str, Counter]]:
+    """Per-rank abundance tables for each of `samples`, as {rank: {run name: {ancestor taxid: total size}}}"""
+    ranks = tuple(ranks)
+    tables = {rank: {} for rank in ranks}
+
+    for sample in samples:
+        for rank, totals in rollup_sample(sample, ranks).items():
+            tables[rank][sample.run_name] = totals
+
+    return tables
@@ -0,0 +1,89 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import struct
+import types
+import zipfile
+from array import array
+
+import abundance_matrix
+from abundance_matrix import AbundanceMatrix, AbundanceMatrixBuilder, _npy_array, _read_npy
+from sample_results import TAX_FLAG_BITS
+
+
+def build_matrix():
+    builder = AbundanceMatrixBuilder()
+    builder.add_row("A", [12, 5, 12], [3, 4, 5], [TAX_FLAG_BITS["weak"], 0, TAX_FLAG_BITS["merged"]])
+    # a sample without any output
+    builder.add_row("B", [], [], [])
+    builder.add_row("Ĉ long name", [7, 5], [1 << 40, 2], [0, TAX_FLAG_BITS["HighOthers"] | TAX_FLAG_BITS["weak"]])
+
+    return builder.build()
+
+
+def matrix_tables(matrix):
+    return (
+        list(matrix.samples), list(matrix.tax_ids), list(matrix.indptr), list(matrix.indices), list(matrix.data),
+        list(matrix.flag_masks),
+    )
+
+
+def test_round_trip(tmp_path):
+    matrix = build_matrix()
+    fn = str(tmp_path / "matrix.npz")
+    matrix.save(fn)
+    loaded = AbundanceMatrix.load(fn)
+
+    assert matrix_tables(loaded) == matrix_tables(matrix)
+    assert loaded.row("B") == {}
+    assert loaded.row("A") == {5: 4, 12: 8}
+    assert list(loaded.indptr) == [0, 2, 2, 4]
+
+    with zipfile.ZipFile(fn) as f:
+        for name in f.namelist():
+            data = f.read(name)
+            header_len, = struct.unpack_from("<H", data, 8)
+            # numpy expects the data to start 64 byte aligned
+            assert (10 + header_len) % 64 == 0
+        assert _read_npy(f.read("shape.npy")) == array("q", [3, 3])
+        # always little endian
+        assert f.read("data.npy")[-8:] == struct.pack("<Q", 1 << 40)
+
+
+def test_big_endian(monkeypatch):
+    values = array("Q", [1, 1 << 40, 7])
+    little = _npy_array(values)
+    # the same values as a big endian machine holds them
+    native = array("Q", values)
+    native.byteswap()
+
+    monkeypatch.setattr(abundance_matrix, "sys", types.SimpleNamespace(byteorder="big"))
+    assert _npy_array(native) == little
+    assert _read_npy(little) == native
+
+
+def test_changed_flag_bits(tmp_path, monkeypatch):
+    matrix = build_matrix()
+    fn = str(tmp_path / "matrix.npz")
+    matrix.save(fn)
+
+    # "merged" is no longer known and "atypical" is new, shifting the bits of the flags after it
+    flags = sorted({*TAX_FLAG_BITS, "atypical"} - {"merged"})
+    new_bits = {flag: 1 << idx for idx, flag in enumerate(flags)}
+    monkeypatch.setattr(abundance_matrix, "TAX_FLAG_BITS", new_bits)
+    loaded = AbundanceMatrix.load(fn)
+
+    # cells in taxid order within each row, and "merged" dropped from taxid 12 of A
+    assert list(loaded.flag_masks) == [0, new_bits["weak"], new_bits["HighOthers"] | new_bits["weak"], 0]
+    assert list(loaded.data) == list(matrix.data)
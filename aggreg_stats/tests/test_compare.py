@@ -0,0 +1,33 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import compare
+
+
+def test_min_pairs_for_alpha():
+    assert compare.min_pairs_for_alpha(0.05) == 6
+    assert compare.min_pairs_for_alpha(0.01) == 8
+    assert compare.wilcoxon_signed_rank([1.0, 2.0, 3.0, 4.0, 5.0]) >= 0.05
+    assert compare.wilcoxon_signed_rank([1.0, 2.0, 3.0, 4.0, 5.0, 6.0]) < 0.05
+
+
+def test_too_few_pairs_noted():
+    # ties use the normal approximation, which would call this significant on 5 pairs
+    comparison = compare.compare_stage("stage", "walltime", [(1.0, 2.0)] * 5)
+    assert comparison.verdict == ""
+    assert comparison.note
+
+    comparison = compare.compare_stage("stage", "walltime", [(1.0, 2.0 + i / 10) for i in range(6)])
+    assert comparison.verdict == "slower"
+    assert comparison.note == ""
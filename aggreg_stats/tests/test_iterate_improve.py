@@ -0,0 +1,100 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import re
+
+from analyse_times.iterate_improve import IterateImproveExtractor
+from log_scanner import LogScanner
+
+# the whole-file parser IterateImproveExtractor replaced, kept as the reference
+PAT_ITER_CYCLES = re.compile(
+    r"(^Cycle (\d+) started(?:.*\n)*(\d+) seconds for cycle \2)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+PAT_TIME_SECONDS = re.compile(r"(.*?):?[\t ]*([\d.]+) seconds", re.IGNORECASE)
+CYCLE_TIMINGS = {"finished reading SAM after", "Total time", "THREADING took", "Overall pileup time"}
+
+LOG = """\
+Reading reference contigs
+Loaded 52 contigs in 1.5 seconds
+Cycle 1 started
+finished reading SAM after 3.25 seconds
+52 contigs remaining
+mapping took 8 seconds
+THREADING took 2 seconds
+Overall pileup time: 4.5 seconds
+Total time: 9 seconds
+17 seconds for cycle 1
+Cycle 2 started
+finished reading SAM after 2 seconds
+40 contigs remaining
+3 contigs merged
+THREADING took 1.75 seconds
+Overall pileup time:\t3 seconds
+Total time: 7 seconds
+11 seconds for cycle 2
+Cycle 3 started
+finished reading SAM after 2 seconds
+38 contigs remaining
+THREADING took 1 seconds
+Overall pileup time: 3 seconds
+"""
+
+
+def reference_cycles(text):
+    cycles = []
+    for cycle in PAT_ITER_CYCLES.finditer(text):
+        timings = [
+            (match.group(1), match.group(2))
+            for match in PAT_TIME_SECONDS.finditer(cycle.group(1))
+            if match.group(1) in CYCLE_TIMINGS
+        ]
+        cycles.append((f"Cycle {cycle.group(2)}", cycle.group(3), timings))
+
+    return cycles
+
+
+def scan(tmp_path, text):
+    log_fn = tmp_path / "sample.iterateImprove.err"
+    log_fn.write_text(text)
+    scanner = LogScanner(threads=1)
+    extractor = scanner.register(str(log_fn), IterateImproveExtractor())
+    scanner.scan()
+
+    return extractor
+
+
+def test_matches_reference_parser(tmp_path):
+    for text in (LOG, LOG + "Overall improve time: 40 seconds\n"):
+        extractor = scan(tmp_path, text)
+
+        cycles = [(f"Cycle {cycle.number}", cycle.time, cycle.timings) for cycle in extractor.cycles]
+        assert cycles == reference_cycles(text)
+        # the truncated last cycle is dropped by both
+        assert [cycle.number for cycle in extractor.cycles] == [1, 2]
+
+    assert extractor.total_time == "40"
+
+
+def test_counts_kept_per_cycle(tmp_path):
+    extractor = scan(tmp_path, LOG)
+
+    assert extractor.cycles[0].counts == {"contigs remaining": 52}
+    assert extractor.cycles[1].counts == {"contigs remaining": 40, "contigs merged": 3}
+
+
+def test_fractional_cycle_time(tmp_path):
+    extractor = scan(tmp_path, "Cycle 1 started\nTotal time: 9 seconds\n9.5 seconds for cycle 1\n")
+
+    assert [(cycle.number, cycle.time) for cycle in extractor.cycles] == [(1, "9.5")]
@@ -0,0 +1,30 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from scaling import ScalingModel
+
+
+def test_no_work_gives_no_recommendation():
+    assert ScalingModel().recommend({}) is None
+    assert ScalingModel.run_work([None, 0.0]) == {}
+
+
+def test_serial_stage_recommends_one_thread():
+    # stages without a fit are predicted to be serial, so extra threads only lower the efficiency
+    recommendation = ScalingModel().recommend({"diamond to virus": 100.0})
+
+    assert recommendation.walltimes[1] == recommendation.walltimes[48] == 100.0
+    # two threads on a serial run are exactly MIN_EFFICIENCY busy
+    assert recommendation.max_efficient == 2
+    assert recommendation.fastest == 1
@@ -0,0 +1,37 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+import tax_db
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_empty_merged_dump(tmp_path, jobs):
+    (tmp_path / "nodes.dmp").write_text(
+        "1\t|\t1\t|\tno rank\t|\t\t|\n"
+        "2\t|\t1\t|\tsuperkingdom\t|\t\t|\n"
+    )
+    (tmp_path / "names.dmp").write_text(
+        "1\t|\troot\t|\t\t|\tscientific name\t|\n"
+        "2\t|\tViruses\t|\t\t|\tscientific name\t|\n"
+    )
+    (tmp_path / "merged.dmp").write_text("")
+
+    parents, ranks, names, merged = tax_db.map_tax_image(tax_db.compile_tax_tree(str(tmp_path), jobs=jobs))
+
+    assert dict(parents) == {1: 1, 2: 1}
+    assert dict(ranks) == {1: "no rank", 2: "superkingdom"}
+    assert dict(names) == {1: "root", 2: "Viruses"}
+    assert dict(merged) == {}
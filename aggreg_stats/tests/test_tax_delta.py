@@ -0,0 +1,181 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+
+import pytest
+
+import tax_db
+from tax_delta import diff_dump, update_tax_image
+
+NODES = {
+    1: (1, "no rank"),
+    2: (1, "superkingdom"),
+    3: (2, "family"),
+    4: (3, "genus"),
+    5: (4, "species"),
+    6: (4, "species"),
+    7: (3, "genus"),
+    8: (7, "species"),
+    # an old merged id which still has an entry of its own
+    9: (7, "species"),
+}
+
+NAMES = {
+    1: [("root", "scientific name")],
+    2: [("Viruses", "scientific name")],
+    3: [("FamilyA", "scientific name")],
+    4: [("GenusA", "scientific name"), ("genus a", "synonym")],
+    5: [("Species five", "scientific name"), ("sp. 5", "synonym")],
+    6: [("Species six", "scientific name"), ("sp. 6", "synonym"), ("six", "common name")],
+    7: [("GenusB", "scientific name"), ("genus b", "synonym"), ("gen. b", "equivalent name")],
+    8: [("Species eight", "scientific name")],
+    9: [("Species nine", "scientific name")],
+}
+
+MERGED = {10: 5, 11: 8, 9: 8}
+
+
+def write_dumps(path, nodes, names, merged, deleted=()):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "nodes.dmp"), "w") as f:
+        for taxid, (parent, rank) in sorted(nodes.items()):
+            f.write(f"{taxid}\t|\t{parent}\t|\t{rank}\t|\t\t|\t0\t|\n")
+    with open(os.path.join(path, "names.dmp"), "w") as f:
+        for taxid, taxid_names in sorted(names.items()):
+            for name, name_class in taxid_names:
+                f.write(f"{taxid}\t|\t{name}\t|\t\t|\t{name_class}\t|\n")
+    with open(os.path.join(path, "merged.dmp"), "w") as f:
+        for old_id, new_id in sorted(merged.items()):
+            f.write(f"{old_id}\t|\t{new_id}\t|\n")
+    with open(os.path.join(path, "delnodes.dmp"), "w") as f:
+        for taxid in sorted(deleted):
+            f.write(f"{taxid}\t|\n")
+
+
+def image_tables(image_fn):
+    parents, ranks, names, merged = tax_db.map_tax_image(image_fn)
+
+    return dict(parents), dict(ranks), dict(names), dict(merged)
+
+
+def check_update(tmp_path, nodes=NODES, names=NAMES, merged=MERGED, deleted=()):
+    """The image patched from the old dumps' image is the image compiled from the new dumps"""
+    old_path = str(tmp_path / "old")
+    new_path = str(tmp_path / "new")
+    write_dumps(old_path, NODES, NAMES, MERGED)
+    write_dumps(new_path, nodes, names, merged, deleted)
+
+    tax_db.compile_tax_tree(old_path, jobs=1)
+    delta_fn = str(tmp_path / "delta.img")
+    delta = update_tax_image(old_path, new_path, delta_fn)
+    full_fn = tax_db.compile_tax_tree(new_path, jobs=1)
+
+    assert image_tables(delta_fn) == image_tables(full_fn)
+
+    return delta, image_tables(delta_fn)
+
+
+def test_synonym_appended(tmp_path):
+    names = {**NAMES, 4: NAMES[4] + [("genus alpha", "synonym")]}
+    delta, (parents, ranks, tax_names, tax_merged) = check_update(tmp_path, names=names)
+
+    assert tax_names[4] == "GenusA"
+    # 9 has an entry of its own, and 11 was merged into 8
+    assert tax_merged == {10: 5, 11: 8}
+    assert diff_dump(str(tmp_path / "old" / "names.dmp"), str(tmp_path / "new" / "names.dmp")) == {
+        4: (
+            ["4\t|\tGenusA\t|\t\t|\tscientific name\t|\n", "4\t|\tgenus a\t|\t\t|\tsynonym\t|\n"],
+            [
+                "4\t|\tGenusA\t|\t\t|\tscientific name\t|\n", "4\t|\tgenus a\t|\t\t|\tsynonym\t|\n",
+                "4\t|\tgenus alpha\t|\t\t|\tsynonym\t|\n",
+            ],
+        ),
+    }
+
+
+def test_synonym_appended_to_last_group(tmp_path):
+    names = {**NAMES, 9: NAMES[9] + [("sp. 9", "synonym")]}
+    _, (_, _, tax_names, _) = check_update(tmp_path, names=names)
+
+    assert tax_names[9] == "Species nine"
+
+
+@pytest.mark.parametrize("taxid", [4, 6, 7])
+def test_line_removed(tmp_path, taxid):
+    names = {**NAMES, taxid: NAMES[taxid][:1]}
+    _, (_, _, tax_names, _) = check_update(tmp_path, names=names)
+
+    assert tax_names[taxid] == NAMES[taxid][0][0]
+
+
+def test_lines_reordered(tmp_path):
+    names = {**NAMES, 6: NAMES[6][::-1], 7: NAMES[7][1:] + NAMES[7][:1]}
+    _, (_, _, tax_names, _) = check_update(tmp_path, names=names)
+
+    assert tax_names[6] == "Species six"
+    assert tax_names[7] == "GenusB"
+
+
+def test_scientific_name_changed(tmp_path):
+    names = {**NAMES, 5: [("Species V", "scientific name")] + NAMES[5][1:]}
+    _, (_, _, tax_names, _) = check_update(tmp_path, names=names)
+
+    # the merged id follows the id it was merged into
+    assert tax_names[5] == tax_names[10] == "Species V"
+
+
+def test_merge_removed(tmp_path):
+    merged = {old_id: new_id for old_id, new_id in MERGED.items() if old_id != 10}
+    _, (parents, _, tax_names, tax_merged) = check_update(tmp_path, merged=merged)
+
+    assert 10 not in parents
+    assert 10 not in tax_names
+    assert 10 not in tax_merged
+
+
+def test_merged_id_keeps_own_entry(tmp_path):
+    _, (parents, _, tax_names, tax_merged) = check_update(tmp_path, merged={**MERGED, 9: 5})
+
+    assert parents[9] == 7
+    assert tax_names[9] == "Species nine"
+    assert 9 not in tax_merged
+
+
+def test_node_merged_away(tmp_path):
+    nodes = {taxid: node for taxid, node in NODES.items() if taxid != 6}
+    names = {taxid: taxid_names for taxid, taxid_names in NAMES.items() if taxid != 6}
+    delta, (parents, ranks, tax_names, tax_merged) = check_update(
+        tmp_path, nodes=nodes, names=names, merged={**MERGED, 6: 5}
+    )
+
+    assert delta.merged == {6: 5}
+    assert parents[6] == 4
+    assert tax_names[6] == "Species five"
+    assert tax_merged[6] == 5
+
+
+def test_node_moved_and_deleted(tmp_path):
+    nodes = {taxid: node for taxid, node in NODES.items() if taxid != 8}
+    nodes[5] = (7, "species")
+    nodes[12] = (7, "no rank")
+    names = {taxid: taxid_names for taxid, taxid_names in NAMES.items() if taxid != 8}
+    names[12] = [("Unranked twelve", "scientific name")]
+    delta, (parents, ranks, tax_names, tax_merged) = check_update(tmp_path, nodes=nodes, names=names, deleted={8})
+
+    assert delta.deleted == {8}
+    assert parents[5] == 7
+    assert ranks[12] == "no rank"
+    assert 8 not in parents and 11 not in parents
+    assert 11 not in tax_merged
@@ -0,0 +1,49 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+import tax_db
+from tax_index import TaxIndex
+from test_tax_delta import MERGED, NAMES, NODES, write_dumps
+
+# a genus merged into another
+MERGED_GENUS = {**MERGED, 20: 4}
+
+
+@pytest.fixture(params=["image", "partial"])
+def index(request, tmp_path):
+    write_dumps(str(tmp_path), NODES, NAMES, MERGED_GENUS)
+    if request.param == "image":
+        tables = tax_db.map_tax_image(tax_db.compile_tax_tree(str(tmp_path), jobs=1))
+    else:
+        tables = tax_db._parse_tax_dump_partial(str(tmp_path), [5, 6, 8, 10, 20])
+    parents, ranks, names, merged = tables
+
+    return TaxIndex(parents, ranks, merged)
+
+
+def test_merged_ids_share_their_targets_slot(index):
+    assert index.depth(20) == index.depth(4)
+    assert index.is_ancestor(20, 5) and index.is_ancestor(4, 20)
+    assert index.lca(20, 4) == 4
+    assert index.lca(20, 8) == 3
+    assert index.lca(10, 6) == 4
+    assert index.ancestor_at_rank(20, "genus") == 4
+    assert index.ancestor_at_rank(10, "species") == 5
+
+
+def test_merged_ids_roll_up_with_their_targets(index):
+    assert index.rollup([4, 20, 5, 10, 8], [1, 2, 4, 8, 16], "genus") == {4: 15, 7: 16}
+    assert index.rollup([5, 10], [1, 2], "species") == {5: 3}
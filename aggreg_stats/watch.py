@@ -0,0 +1,281 @@
+#  Copyright 2020 University of New South Wales
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+from constants import PAT_TIME
+from sample_results import SampleResults, find_name
+from util import get_logger
+
+# Seconds without any change in the samples directory before the workbook is regenerated
+DEFAULT_DEBOUNCE = 30.0
+# Longest wait for changes to stop, as a multiple of the debounce interval, so a busy directory is still refreshed
+DEBOUNCE_MAX_FACTOR = 10
+# Seconds between scans of the samples directory when polling
+DEFAULT_POLL_INTERVAL = 60.0
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_ISDIR = 0x40000000
+_IN_EVENT = struct.Struct("iIII")
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+logger = get_logger(__name__)
+
+
+class PollingWatcher(object):
+    """Waits out the poll interval, for filesystems without inotify support (e.g. Lustre or NFS clients)"""
+
+    def __init__(self, directory: str, interval: float = DEFAULT_POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """
+        Sleeps for the poll interval when waiting indefinitely, after which anything may have changed
+
+        Polling can't tell when changes stop, so waits with a timeout return straight away.
+        """
+        if timeout is not None:
+            return False
+
+        time.sleep(self.interval)
+
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Waits for changes to a samples directory, or any run directory in it, using inotify"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._watches: Dict[int, str] = {}
+        self._watch(directory)
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                self._watch(entry.path)
+
+    def _watch(self, path: str):
+        wd = self._add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if path == self.directory:
+                raise OSError(errno, f"inotify_add_watch failed for {path!r}")
+
+            logger.debug("Failed to watch %r: %s", path, os.strerror(errno))
+            return
+
+        self._watches[wd] = path
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Whether something changed within `timeout` seconds (None to wait indefinitely)"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return False
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = _IN_EVENT.unpack_from(data, offset)
+            name = data[offset + _IN_EVENT.size:offset + _IN_EVENT.size + name_len].rstrip(b"\0")
+            offset += _IN_EVENT.size + name_len
+
+            # start watching new run directories
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO) and self._watches.get(wd) == self.directory:
+                self._watch(os.path.join(self.directory, os.fsdecode(name)))
+
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+def last_time_stage(run_dir: str) -> Optional[str]:
+    """The last TIME stage logged by an in-flight run, if any"""
+    try:
+        name = find_name(run_dir)
+    except OSError:
+        return None
+    if name is None:
+        return None
+
+    stage = None
+    try:
+        with open(os.path.join(run_dir, f"{name}.log"), "r", errors="replace") as f:
+            for line in f:
+                match = PAT_TIME.search(line)
+                if match:
+                    stage = match.group(1)
+    except OSError:
+        return None
+
+    return stage
+
+
+def _stat_key(fn: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(fn)
+    except FileNotFoundError:
+        return None
+
+    return st.st_size, st.st_mtime_ns
+
+
+class SamplesDirWatcher(object):
+    """
+    Keeps the aggregated results of a samples directory up to date as VirMap runs complete
+
+    A run is complete once its wrapper `.log` and `final.fa` both exist, and is parsed again whenever either changes.
+    """
+
+    def __init__(self, agg, samples_dir: str, per_sample_output: Optional[str] = None):
+        self.agg = agg
+        self.samples_dir = os.path.abspath(samples_dir)
+        self.per_sample_output = per_sample_output
+
+        self.loaded: Dict[str, SampleResults] = {}
+        # (wrapper log, final.fa) size and mtime of each complete run when it was last loaded
+        self._seen: Dict[str, Tuple] = {}
+        self.in_flight: Dict[str, Optional[str]] = {}
+        self._reported = None
+
+    def scan(self) -> bool:
+        """
+        Load any new or changed complete runs, returns whether the aggregated results (or the progress of the runs in
+        flight) changed
+        """
+        filenames = set(os.listdir(self.samples_dir))
+        run_names = sorted(fn[:-4] for fn in filenames if fn.endswith(".log") and fn[:-4] in filenames)
+
+        changed: List[str] = []
+        keys = {}
+        previous_in_flight = self.in_flight
+        self.in_flight = {}
+        for run_name in run_names:
+            run_dir = os.path.join(self.samples_dir, run_name)
+            try:
+                name = find_name(run_dir)
+            except OSError:
+                name = None
+            final_fa_key = _stat_key(os.path.join(run_dir, f"{name}.final.fa")) if name else None
+            if final_fa_key is None:
+                self.in_flight[run_dir] = last_time_stage(run_dir)
+                continue
+
+            keys[run_dir] = (_stat_key(f"{run_dir}.log"), final_fa_key)
+            if self._seen.get(run_dir) != keys[run_dir]:
+                changed.append(run_dir)
+
+        removed = [run_dir for run_dir in self.loaded if run_dir not in keys]
+        for run_dir in removed:
+            del self.loaded[run_dir]
+            self._seen.pop(run_dir, None)
+
+        if changed:
+            for run_dir in changed:
+                self.loaded.pop(run_dir, None)
+
+            added = self.agg.add_samples(changed)
+            for sample in added:
+                self.loaded[sample.base_dir] = sample
+
+            if self.per_sample_output:
+                self.agg.save_samples(self.per_sample_output, added)
+
+            # runs which failed to load aren't retried until they change
+            for run_dir in changed:
+                self._seen[run_dir] = keys[run_dir]
+
+        self.agg.samples = [self.loaded[run_dir] for run_dir in sorted(self.loaded)]
+        self.agg.in_flight = {os.path.basename(run_dir): stage for run_dir, stage in self.in_flight.items()}
+
+        return bool(changed or removed or self.in_flight != previous_in_flight)
+
+    def report(self):
+        """Log the number of complete runs and the progress of those in flight, if either has changed"""
+        status = (len(self.loaded), self.in_flight)
+        if status == self._reported:
+            return
+        self._reported = status
+
+        logger.info("%d complete runs, %d in flight", len(self.loaded), len(self.in_flight))
+        for run_dir, stage in sorted(self.in_flight.items()):
+            logger.info("  %s: %s", os.path.basename(run_dir), stage or "no stage completed yet")
+
+    def regenerate(self):
+        """Write the outputs, each replacing the previous one only once it's complete"""
+        self.agg.execute()
+
+    def run(self, debounce: float = DEFAULT_DEBOUNCE, poll: bool = False, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """Watch the samples directory until interrupted"""
+        watcher = None
+        if not poll:
+            try:
+                watcher = InotifyWatcher(self.samples_dir)
+            except (OSError, AttributeError) as e:
+                logger.warning("inotify unavailable, polling %r instead: %s", self.samples_dir, e)
+        if watcher is None:
+            watcher = PollingWatcher(self.samples_dir, poll_interval)
+
+        logger.info("Watching %r, press Ctrl+C to stop", self.samples_dir)
+        try:
+            if self.scan():
+                self.regenerate()
+            self.report()
+
+            while True:
+                if not watcher.wait(None):
+                    continue
+
+                # wait for the changes to stop for the debounce interval before refreshing, but no longer than
+                # DEBOUNCE_MAX_FACTOR intervals in all
+                now = time.monotonic()
+                max_deadline = now + debounce * DEBOUNCE_MAX_FACTOR
+                settle_deadline = now + debounce
+                while now < settle_deadline and watcher.wait(settle_deadline - now):
+                    now = time.monotonic()
+                    settle_deadline = min(now + debounce, max_deadline)
+
+                if self.scan():
+                    self.regenerate()
+                self.report()
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %r", self.samples_dir)
+        finally:
+            watcher.close()